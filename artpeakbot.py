@@ -1,8 +1,18 @@
+import contextlib
+import contextvars
+import functools
+import hashlib
+import json
 import logging
+import multiprocessing
+import os
+import sys
 import sqlite3
+import tempfile
 import re
-import torch
-import clip
+import queue
+import threading
+import time
 from PIL import Image
 from io import BytesIO
 import telegram
@@ -16,9 +26,10 @@ from telegram import (
     ReplyKeyboardMarkup,
     KeyboardButton
 )
-from telegram.error import TimedOut, NetworkError, BadRequest
+from telegram.error import TimedOut, NetworkError, BadRequest, RetryAfter
 from telegram.ext import (
     Application,
+    BaseRateLimiter,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
@@ -26,6 +37,11 @@ from telegram.ext import (
     ContextTypes
 )
 import asyncio
+import bisect
+import heapq
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime, timedelta
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -77,21 +93,981 @@ def get_persistent_menu():
         one_time_keyboard=False
     )
 
-def init_db():
-    conn = sqlite3.connect('database.db', check_same_thread=False)
-    cur = conn.cursor()
-
+# ========== ПЛАНИРОВЩИК ИСХОДЯЩИХ ЗАПРОСОВ К TELEGRAM ==========
+# Все запросы бота, адресованные чату, проходят через общий лимитер: глобальное
+# ведро токенов и ведро на каждый чат. Фоновые рассылки (напоминания, жалобы,
+# обновление карточек) не могут забрать последние TELEGRAM_BACKGROUND_RESERVE
+# глобальных токенов, поэтому ответы пользователям не ждут за ними в очереди.
+
+TELEGRAM_GLOBAL_RATE = 30  # Запросов в секунду на весь бот
+TELEGRAM_CHAT_RATE = 1  # Запросов в секунду в личный чат
+TELEGRAM_GROUP_RATE = 20 / 60  # Запросов в секунду в группу
+TELEGRAM_CHAT_BURST = 3  # Сколько запросов в чат можно отправить подряд
+TELEGRAM_BACKGROUND_RESERVE = 10  # Глобальных токенов, недоступных фоновой полосе
+TELEGRAM_MAX_RETRY_AFTER = 3  # Сколько раз повторяем запрос после 429 RetryAfter
+TELEGRAM_CHAT_BUCKETS_LIMIT = 10000
+
+OUTBOUND_LANES = ('interactive', 'background')
+outbound_lane = contextvars.ContextVar('outbound_lane', default='interactive')
+
+@contextlib.contextmanager
+def background_lane():
+    """Запросы к Bot API внутри блока идут в фоновой полосе"""
+    token = outbound_lane.set('background')
     try:
-        cur.execute("PRAGMA table_info(reactions)")
-        columns = [row[1] for row in cur.fetchall()]
-        if 'timestamp' not in columns:
-            logging.info("Обнаружена старая схема БД. Добавляем 'timestamp' в таблицу 'reactions'...")
-            cur.execute("ALTER TABLE reactions ADD COLUMN timestamp DATETIME DEFAULT CURRENT_TIMESTAMP")
-            conn.commit()
-            logging.info("Таблица 'reactions' успешно обновлена.")
-    except sqlite3.OperationalError:
+        yield
+    finally:
+        outbound_lane.reset(token)
+
+def in_background_lane(func):
+    """Декоратор для корутин, рассылающих фоновые уведомления"""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        with background_lane():
+            return await func(*args, **kwargs)
+    return wrapper
+
+class TokenBucket:
+    """Ведро токенов: пополняется со скоростью rate в секунду, вмещает не больше capacity"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self, now, reserve=0):
+        """Сколько секунд ждать, пока в ведре окажется токен сверх reserve"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return max(0.0, (1 + reserve - self.tokens) / self.rate)
+
+    def take(self):
+        self.tokens -= 1
+
+class OutboundRateLimiter(BaseRateLimiter):
+    """
+    Лимитер исходящих запросов для Application: ведра токенов на бота и на чат,
+    приоритетные полосы и пауза всех отправок после 429 RetryAfter.
+    Полоса берётся из rate_limit_args={'lane': ...} или из контекста (background_lane).
+    """
+
+    def __init__(self):
+        self._global = TokenBucket(TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_RATE)
+        self._chats = {}
+        self._paused_until = 0.0
+        self.stats = {
+            lane: {'waiting': 0, 'sent': 0, 'failed': 0, 'retry_after': 0,
+                   'wait_total': 0.0, 'wait_max': 0.0}
+            for lane in OUTBOUND_LANES
+        }
+
+    async def initialize(self):
         pass
 
+    async def shutdown(self):
+        pass
+
+    def _chat_bucket(self, chat_id, now):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= TELEGRAM_CHAT_BUCKETS_LIMIT:
+                # Полные ведра ничем не отличаются от новых, их можно забыть
+                self._chats = {
+                    key: value for key, value in self._chats.items()
+                    if value.wait_time(now, reserve=value.capacity - 1) > 0
+                }
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            rate = TELEGRAM_GROUP_RATE if is_group else TELEGRAM_CHAT_RATE
+            bucket = self._chats[chat_id] = TokenBucket(rate, TELEGRAM_CHAT_BURST)
+        return bucket
+
+    async def _acquire(self, chat_id, lane):
+        reserve = TELEGRAM_BACKGROUND_RESERVE if lane == 'background' else 0
+        while True:
+            now = time.monotonic()
+            bucket = self._chat_bucket(chat_id, now)
+            wait = max(
+                self._paused_until - now,
+                self._global.wait_time(now, reserve),
+                bucket.wait_time(now)
+            )
+            if wait <= 0:
+                self._global.take()
+                bucket.take()
+                return
+            await asyncio.sleep(wait)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get('chat_id')
+        if chat_id is None:
+            # answerCallbackQuery, getFile и т.п. не считаются сообщениями в чат
+            return await callback(*args, **kwargs)
+        
+        lane = (rate_limit_args or {}).get('lane') or outbound_lane.get()
+        stats = self.stats[lane]
+        for attempt in range(TELEGRAM_MAX_RETRY_AFTER + 1):
+            started_at = time.monotonic()
+            stats['waiting'] += 1
+            try:
+                await self._acquire(chat_id, lane)
+            finally:
+                stats['waiting'] -= 1
+            waited = time.monotonic() - started_at
+            stats['wait_total'] += waited
+            stats['wait_max'] = max(stats['wait_max'], waited)
+            
+            try:
+                result = await callback(*args, **kwargs)
+            except RetryAfter as e:
+                stats['retry_after'] += 1
+                retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                logging.warning(f"Telegram просит подождать {retry_after}с ({endpoint}, чат {chat_id}), попытка {attempt + 1}")
+                if attempt == TELEGRAM_MAX_RETRY_AFTER:
+                    stats['failed'] += 1
+                    raise
+                continue
+            except Exception:
+                stats['failed'] += 1
+                raise
+            stats['sent'] += 1
+            return result
+
+    def get_stats(self):
+        snapshot = {}
+        for lane, stats in self.stats.items():
+            sent = stats['sent'] + stats['failed']
+            snapshot[lane] = {
+                'waiting': stats['waiting'],
+                'sent': stats['sent'],
+                'failed': stats['failed'],
+                'retry_after': stats['retry_after'],
+                'avg_wait_ms': stats['wait_total'] / sent * 1000 if sent else 0.0,
+                'max_wait_ms': stats['wait_max'] * 1000,
+            }
+        snapshot['paused_for'] = max(0.0, self._paused_until - time.monotonic())
+        snapshot['chats'] = len(self._chats)
+        return snapshot
+
+outbound_rate_limiter = OutboundRateLimiter()
+
+# ========== ПУЛ СОЕДИНЕНИЙ С БАЗОЙ ДАННЫХ ==========
+
+DB_PATH = 'database.db'
+DB_POOL_SIZE = 8  # Сколько простаивающих соединений держим открытыми
+DB_STATEMENT_CACHE_SIZE = 256  # Кэш подготовленных запросов на каждое соединение
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-16000",  # ~16 МБ страничного кэша
+    "PRAGMA mmap_size=268435456",  # 256 МБ
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=5000",
+)
+
+class PooledConnection(sqlite3.Connection):
+    """Соединение из пула: close() возвращает его в пул, а не закрывает файл"""
+
+    def close(self):
+        release_db_connection(self)
+
+_db_pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+
+def _open_db_connection():
+    conn = sqlite3.connect(
+        DB_PATH,
+        factory=PooledConnection,
+        check_same_thread=False,
+        cached_statements=DB_STATEMENT_CACHE_SIZE,
+        timeout=5
+    )
+    for pragma in DB_PRAGMAS:
+        conn.execute(pragma)
+    conn.in_pool = False
+    return conn
+
+def get_db_connection():
+    """
+    Выдает долгоживущее соединение из пула (WAL, настроенные PRAGMA, кэш запросов).
+    Если свободных соединений нет - открывает новое, лишние закрываются при возврате.
+    """
+    try:
+        conn = _db_pool.get_nowait()
+    except queue.Empty:
+        return _open_db_connection()
+    conn.in_pool = False
+    return conn
+
+def release_db_connection(conn):
+    """Возвращает соединение в пул, откатывая незафиксированные изменения"""
+    if conn.in_pool:
+        return
+    try:
+        if conn.in_transaction:
+            conn.rollback()
+    except sqlite3.Error as e:
+        logging.warning(f"Соединение с БД повреждено и будет закрыто: {e}")
+        sqlite3.Connection.close(conn)
+        return
+    conn.in_pool = True
+    try:
+        _db_pool.put_nowait(conn)
+    except queue.Full:
+        sqlite3.Connection.close(conn)
+
+def close_db_pool():
+    """Закрывает все простаивающие соединения пула (при остановке бота)"""
+    while True:
+        try:
+            conn = _db_pool.get_nowait()
+        except queue.Empty:
+            break
+        sqlite3.Connection.close(conn)
+
+# ========== АСИНХРОННЫЙ ДОСТУП К БАЗЕ ДАННЫХ ==========
+
+DB_READER_THREADS = 4
+
+# Все записи идут через один поток, чтобы писатели не конкурировали за блокировку файла,
+# чтения выполняются параллельно в отдельном пуле (WAL позволяет читать во время записи)
+_db_writer_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+_db_reader_executor = ThreadPoolExecutor(max_workers=DB_READER_THREADS, thread_name_prefix='db-reader')
+_db_stats_lock = threading.Lock()
+db_executor_stats = {
+    kind: {'queued': 0, 'running': 0, 'completed': 0, 'failed': 0,
+           'wait_total': 0.0, 'wait_max': 0.0, 'run_total': 0.0}
+    for kind in ('read', 'write')
+}
+
+def _run_timed_db_call(kind, submitted_at, func, args, kwargs):
+    started_at = time.perf_counter()
+    wait_time = started_at - submitted_at
+    stats = db_executor_stats[kind]
+    with _db_stats_lock:
+        stats['queued'] -= 1
+        stats['running'] += 1
+        stats['wait_total'] += wait_time
+        stats['wait_max'] = max(stats['wait_max'], wait_time)
+    failed = False
+    try:
+        return func(*args, **kwargs)
+    except Exception:
+        failed = True
+        raise
+    finally:
+        with _db_stats_lock:
+            stats['running'] -= 1
+            stats['completed'] += 1
+            stats['failed'] += failed
+            stats['run_total'] += time.perf_counter() - started_at
+
+async def _submit_db_call(kind, executor, func, args, kwargs):
+    with _db_stats_lock:
+        db_executor_stats[kind]['queued'] += 1
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        executor, _run_timed_db_call, kind, time.perf_counter(), func, args, kwargs
+    )
+
+async def db_read(func, *args, **kwargs):
+    """Выполняет читающую функцию БД в пуле потоков-читателей, не блокируя event loop"""
+    return await _submit_db_call('read', _db_reader_executor, func, args, kwargs)
+
+async def db_write(func, *args, **kwargs):
+    """Выполняет изменяющую функцию БД в единственном потоке-писателе"""
+    return await _submit_db_call('write', _db_writer_executor, func, args, kwargs)
+
+def get_db_executor_stats():
+    """Снимок метрик: глубина очередей, время ожидания и выполнения запросов"""
+    snapshot = {}
+    with _db_stats_lock:
+        for kind, stats in db_executor_stats.items():
+            completed = stats['completed']
+            snapshot[kind] = {
+                'queued': stats['queued'],
+                'running': stats['running'],
+                'completed': completed,
+                'failed': stats['failed'],
+                'avg_wait_ms': stats['wait_total'] / completed * 1000 if completed else 0.0,
+                'max_wait_ms': stats['wait_max'] * 1000,
+                'avg_run_ms': stats['run_total'] / completed * 1000 if completed else 0.0,
+            }
+    return snapshot
+
+def shutdown_db_executors():
+    """Дожидается завершения запросов в очередях и останавливает потоки БД"""
+    _db_writer_executor.shutdown(wait=True)
+    _db_reader_executor.shutdown(wait=True)
+
+# ========== МИГРАЦИИ СХЕМЫ БАЗЫ ДАННЫХ ==========
+# init_db создаёт базовую схему, а все последующие изменения описываются
+# пронумерованными шагами. Номер последнего применённого шага хранится в
+# таблице schema_version, поэтому каждый шаг выполняется ровно один раз.
+
+def _add_column_if_missing(cur, table, column, definition):
+    """Добавляет колонку в таблицу, созданную до появления миграций"""
+    cur.execute(f"PRAGMA table_info({table})")
+    if column not in [row[1] for row in cur.fetchall()]:
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+def _migrate_reactions_timestamp(cur):
+    _add_column_if_missing(cur, 'reactions', 'timestamp', 'DATETIME DEFAULT CURRENT_TIMESTAMP')
+
+def _migrate_users_profile_columns(cur):
+    _add_column_if_missing(cur, 'users', 'nickname', 'TEXT')
+    _add_column_if_missing(cur, 'users', 'bio', 'TEXT')
+    _add_column_if_missing(cur, 'users', 'profile_avatar_file_id', 'TEXT')
+    _add_column_if_missing(cur, 'users', 'is_profile_public', 'BOOLEAN DEFAULT TRUE')
+
+def _migrate_hot_path_indexes(cur):
+    # reactions(user_id, art_id) и viewed_reactions(user_id, reaction_type, reaction_id)
+    # уже покрыты индексами ограничений UNIQUE, profile_followers(follower_id) - первичным ключом
+    for statement in (
+        'CREATE INDEX IF NOT EXISTS idx_arts_owner ON arts (owner_id, timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_arts_timestamp ON arts (timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_arts_likes ON arts (likes DESC, timestamp DESC)',
+        'CREATE INDEX IF NOT EXISTS idx_hashtags_art ON hashtags (art_id)',
+        'CREATE INDEX IF NOT EXISTS idx_hashtags_text ON hashtags (LOWER(hashtag), art_id)',
+        'CREATE INDEX IF NOT EXISTS idx_reactions_art ON reactions (art_id, type)',
+        'CREATE INDEX IF NOT EXISTS idx_comments_art ON comments (art_id)',
+        'CREATE INDEX IF NOT EXISTS idx_profile_followers_following ON profile_followers (following_id, timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_active_messages_art ON active_messages (art_id)',
+        'CREATE INDEX IF NOT EXISTS idx_active_messages_updated ON active_messages (last_updated)',
+        'CREATE INDEX IF NOT EXISTS idx_appeals_user ON appeals (user_id, submitted_at)',
+    ):
+        cur.execute(statement)
+    cur.execute('ANALYZE')
+
+def _migrate_feed_scores(cur):
+    # Формула рейтинга зашита в триггеры: при изменении FEED_RECENCY_SCALE или
+    # FEED_LIKE_WEIGHT нужна новая миграция, пересоздающая триггеры и пересчитывающая рейтинг
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS feed_scores (
+            art_id INTEGER PRIMARY KEY,
+            owner_id INTEGER,
+            score REAL,
+            FOREIGN KEY (art_id) REFERENCES arts (art_id)
+        )
+    ''')
+    cur.execute(f'''
+        INSERT OR REPLACE INTO feed_scores (art_id, owner_id, score)
+        SELECT art_id, owner_id, {feed_score_sql('arts')} FROM arts
+    ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_feed_scores_score ON feed_scores (score)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_feed_scores_owner ON feed_scores (owner_id, score)')
+    cur.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_feed_scores_art_insert AFTER INSERT ON arts
+        BEGIN
+            INSERT OR REPLACE INTO feed_scores (art_id, owner_id, score)
+            VALUES (NEW.art_id, NEW.owner_id, {feed_score_sql('NEW')});
+        END
+    ''')
+    cur.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_feed_scores_art_update AFTER UPDATE OF likes, dislikes, timestamp ON arts
+        BEGIN
+            UPDATE feed_scores SET score = {feed_score_sql('NEW')} WHERE art_id = NEW.art_id;
+        END
+    ''')
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_feed_scores_art_delete AFTER DELETE ON arts
+        BEGIN
+            DELETE FROM feed_scores WHERE art_id = OLD.art_id;
+        END
+    ''')
+
+def _migrate_moderation_verdicts(cur):
+    # dHash хранится целиком и четырьмя 16-битными полосами: у хэшей на расстоянии
+    # Хэмминга не больше 3 хотя бы одна полоса совпадает, и её ищем по индексу
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS moderation_verdicts (
+            file_unique_id TEXT PRIMARY KEY,
+            dhash INTEGER,
+            band0 INTEGER,
+            band1 INTEGER,
+            band2 INTEGER,
+            band3 INTEGER,
+            scores TEXT,
+            is_safe BOOLEAN,
+            message TEXT,
+            basic_ok BOOLEAN,
+            basic_message TEXT,
+            created_at REAL,
+            last_hit_at REAL
+        )
+    ''')
+    for band in range(4):
+        cur.execute(f'CREATE INDEX IF NOT EXISTS idx_moderation_verdicts_band{band} '
+                    f'ON moderation_verdicts (band{band})')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_moderation_verdicts_last_hit ON moderation_verdicts (last_hit_at)')
+
+def _migrate_upload_jobs(cur):
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS upload_jobs (
+            job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            chat_id INTEGER,
+            status_message_id INTEGER,
+            photos TEXT,
+            caption TEXT,
+            stage TEXT DEFAULT 'queued',
+            attempts INTEGER DEFAULT 0,
+            stage_timings TEXT,
+            art_id INTEGER,
+            pending_id INTEGER,
+            error TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_upload_jobs_stage ON upload_jobs (stage, job_id)')
+
+def _migrate_active_messages_rendered_hash(cur):
+    _add_column_if_missing(cur, 'active_messages', 'rendered_hash', 'TEXT')
+
+def _migrate_reaction_inbox(cur):
+    # reaction_inbox - непросмотренные автором лайки и комментарии, reaction_unread_counts -
+    # их число на автора. Обе таблицы ведут триггеры в той же транзакции, что и запись
+    # реакции/комментария, поэтому их не обходит ни один путь удаления арта или пользователя
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS reaction_inbox (
+            reaction_type TEXT,
+            reaction_id INTEGER,
+            owner_id INTEGER,
+            art_id INTEGER,
+            user_id INTEGER,
+            timestamp DATETIME,
+            PRIMARY KEY (reaction_type, reaction_id)
+        )
+    ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_reaction_inbox_owner ON reaction_inbox (owner_id, timestamp)')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS reaction_unread_counts (
+            owner_id INTEGER PRIMARY KEY,
+            unread INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    
+    cur.execute('''
+        INSERT OR IGNORE INTO reaction_inbox (reaction_type, reaction_id, owner_id, art_id, user_id, timestamp)
+        SELECT 'like', r.reaction_id, a.owner_id, r.art_id, r.user_id, r.timestamp
+        FROM reactions r
+        JOIN arts a ON r.art_id = a.art_id
+        WHERE r.type = 'like'
+        AND NOT EXISTS (
+            SELECT 1 FROM viewed_reactions vr
+            WHERE vr.user_id = a.owner_id AND vr.reaction_type = 'like' AND vr.reaction_id = r.reaction_id
+        )
+    ''')
+    cur.execute('''
+        INSERT OR IGNORE INTO reaction_inbox (reaction_type, reaction_id, owner_id, art_id, user_id, timestamp)
+        SELECT 'comment', c.comment_id, a.owner_id, c.art_id, c.user_id, c.timestamp
+        FROM comments c
+        JOIN arts a ON c.art_id = a.art_id
+        WHERE NOT EXISTS (
+            SELECT 1 FROM viewed_reactions vr
+            WHERE vr.user_id = a.owner_id AND vr.reaction_type = 'comment' AND vr.reaction_id = c.comment_id
+        )
+    ''')
+    cur.execute('DELETE FROM reaction_unread_counts')
+    cur.execute('''
+        INSERT INTO reaction_unread_counts (owner_id, unread)
+        SELECT owner_id, COUNT(*) FROM reaction_inbox GROUP BY owner_id
+    ''')
+    
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_reaction_inbox_insert AFTER INSERT ON reaction_inbox
+        BEGIN
+            INSERT OR IGNORE INTO reaction_unread_counts (owner_id, unread) VALUES (NEW.owner_id, 0);
+            UPDATE reaction_unread_counts SET unread = unread + 1 WHERE owner_id = NEW.owner_id;
+        END
+    ''')
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_reaction_inbox_delete AFTER DELETE ON reaction_inbox
+        BEGIN
+            UPDATE reaction_unread_counts SET unread = unread - 1 WHERE owner_id = OLD.owner_id;
+        END
+    ''')
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_reaction_inbox_like_insert AFTER INSERT ON reactions
+        WHEN NEW.type = 'like'
+        BEGIN
+            INSERT OR IGNORE INTO reaction_inbox (reaction_type, reaction_id, owner_id, art_id, user_id, timestamp)
+            SELECT 'like', NEW.reaction_id, owner_id, NEW.art_id, NEW.user_id, NEW.timestamp
+            FROM arts WHERE art_id = NEW.art_id;
+        END
+    ''')
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_reaction_inbox_like_update AFTER UPDATE OF type ON reactions
+        BEGIN
+            DELETE FROM reaction_inbox WHERE reaction_type = 'like' AND reaction_id = OLD.reaction_id;
+            INSERT OR IGNORE INTO reaction_inbox (reaction_type, reaction_id, owner_id, art_id, user_id, timestamp)
+            SELECT 'like', NEW.reaction_id, a.owner_id, NEW.art_id, NEW.user_id, NEW.timestamp
+            FROM arts a
+            WHERE a.art_id = NEW.art_id AND NEW.type = 'like'
+            AND NOT EXISTS (
+                SELECT 1 FROM viewed_reactions vr
+                WHERE vr.user_id = a.owner_id AND vr.reaction_type = 'like' AND vr.reaction_id = NEW.reaction_id
+            );
+        END
+    ''')
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_reaction_inbox_like_delete AFTER DELETE ON reactions
+        BEGIN
+            DELETE FROM reaction_inbox WHERE reaction_type = 'like' AND reaction_id = OLD.reaction_id;
+        END
+    ''')
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_reaction_inbox_comment_insert AFTER INSERT ON comments
+        BEGIN
+            INSERT OR IGNORE INTO reaction_inbox (reaction_type, reaction_id, owner_id, art_id, user_id, timestamp)
+            SELECT 'comment', NEW.comment_id, owner_id, NEW.art_id, NEW.user_id, NEW.timestamp
+            FROM arts WHERE art_id = NEW.art_id;
+        END
+    ''')
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_reaction_inbox_comment_delete AFTER DELETE ON comments
+        BEGIN
+            DELETE FROM reaction_inbox WHERE reaction_type = 'comment' AND reaction_id = OLD.comment_id;
+        END
+    ''')
+
+def _migrate_reminder_runs(cur):
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS reminder_runs (
+            run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            last_owner_id INTEGER DEFAULT 0,
+            owners_done INTEGER DEFAULT 0,
+            owners_total INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            started_at REAL,
+            finished_at REAL
+        )
+    ''')
+
+def _migrate_leaderboards(cur):
+    # artist_stats - подписчики, число артов и сумма лайков автора, hashtag_top - арты
+    # каждого хэштега с их лайками. Таблицы ведут триггеры на arts, hashtags и
+    # profile_followers, поэтому загрузка, реакции, подписки, удаление и блокировка
+    # обновляют их в своей транзакции. Общий топ артов читает индекс idx_arts_likes
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS artist_stats (
+            owner_id INTEGER PRIMARY KEY,
+            followers INTEGER NOT NULL DEFAULT 0,
+            art_count INTEGER NOT NULL DEFAULT 0,
+            total_likes INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS idx_artist_stats_top
+        ON artist_stats (followers DESC, total_likes DESC) WHERE art_count > 0
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS hashtag_top (
+            hashtag TEXT,
+            art_id INTEGER,
+            likes INTEGER,
+            timestamp DATETIME,
+            PRIMARY KEY (hashtag, art_id)
+        )
+    ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_hashtag_top_rank ON hashtag_top (hashtag, likes DESC, timestamp DESC)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_hashtag_top_art ON hashtag_top (art_id)')
+    
+    cur.execute('DELETE FROM artist_stats')
+    cur.execute('''
+        INSERT INTO artist_stats (owner_id, art_count, total_likes)
+        SELECT owner_id, COUNT(*), SUM(likes) FROM arts GROUP BY owner_id
+    ''')
+    cur.execute('''
+        INSERT OR IGNORE INTO artist_stats (owner_id)
+        SELECT DISTINCT following_id FROM profile_followers
+    ''')
+    cur.execute('''
+        UPDATE artist_stats SET followers = (
+            SELECT COUNT(*) FROM profile_followers WHERE following_id = artist_stats.owner_id
+        )
+    ''')
+    cur.execute('DELETE FROM hashtag_top')
+    cur.execute('''
+        INSERT OR IGNORE INTO hashtag_top (hashtag, art_id, likes, timestamp)
+        SELECT LOWER(h.hashtag), a.art_id, a.likes, a.timestamp
+        FROM hashtags h
+        JOIN arts a ON h.art_id = a.art_id
+    ''')
+    
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_artist_stats_art_insert AFTER INSERT ON arts
+        BEGIN
+            INSERT OR IGNORE INTO artist_stats (owner_id) VALUES (NEW.owner_id);
+            UPDATE artist_stats SET art_count = art_count + 1, total_likes = total_likes + NEW.likes
+            WHERE owner_id = NEW.owner_id;
+        END
+    ''')
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_artist_stats_art_delete AFTER DELETE ON arts
+        BEGIN
+            UPDATE artist_stats SET art_count = art_count - 1, total_likes = total_likes - OLD.likes
+            WHERE owner_id = OLD.owner_id;
+            DELETE FROM hashtag_top WHERE art_id = OLD.art_id;
+        END
+    ''')
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_leaderboards_art_update AFTER UPDATE OF likes, timestamp ON arts
+        BEGIN
+            UPDATE artist_stats SET total_likes = total_likes + NEW.likes - OLD.likes
+            WHERE owner_id = NEW.owner_id;
+            UPDATE hashtag_top SET likes = NEW.likes, timestamp = NEW.timestamp WHERE art_id = NEW.art_id;
+        END
+    ''')
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_artist_stats_follow AFTER INSERT ON profile_followers
+        BEGIN
+            INSERT OR IGNORE INTO artist_stats (owner_id) VALUES (NEW.following_id);
+            UPDATE artist_stats SET followers = followers + 1 WHERE owner_id = NEW.following_id;
+        END
+    ''')
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_artist_stats_unfollow AFTER DELETE ON profile_followers
+        BEGIN
+            UPDATE artist_stats SET followers = followers - 1 WHERE owner_id = OLD.following_id;
+        END
+    ''')
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_hashtag_top_insert AFTER INSERT ON hashtags
+        BEGIN
+            INSERT OR IGNORE INTO hashtag_top (hashtag, art_id, likes, timestamp)
+            SELECT LOWER(NEW.hashtag), art_id, likes, timestamp FROM arts WHERE art_id = NEW.art_id;
+        END
+    ''')
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_hashtag_top_delete AFTER DELETE ON hashtags
+        WHEN NOT EXISTS (
+            SELECT 1 FROM hashtags WHERE LOWER(hashtag) = LOWER(OLD.hashtag) AND art_id = OLD.art_id
+        )
+        BEGIN
+            DELETE FROM hashtag_top WHERE hashtag = LOWER(OLD.hashtag) AND art_id = OLD.art_id;
+        END
+    ''')
+
+def _migrate_like_levels(cur):
+    # Ранг в топе плотный: место = число различных значений лайков не меньше лучшего
+    # результата автора. like_levels хранит, сколько артов набрало каждое значение -
+    # по всем артам (scope = '') и по каждому хэштегу (scope = хэштег из hashtag_top),
+    # поэтому ранг считается по нескольким строкам индекса, а не по всей таблице arts
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS like_levels (
+            scope TEXT,
+            likes INTEGER,
+            art_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (scope, likes)
+        ) WITHOUT ROWID
+    ''')
+    cur.execute('DELETE FROM like_levels')
+    cur.execute('''
+        INSERT INTO like_levels (scope, likes, art_count)
+        SELECT '', likes, COUNT(*) FROM arts GROUP BY likes
+    ''')
+    cur.execute('''
+        INSERT INTO like_levels (scope, likes, art_count)
+        SELECT hashtag, likes, COUNT(*) FROM hashtag_top GROUP BY hashtag, likes
+    ''')
+    
+    for table, scope in (('arts', "''"), ('hashtag_top', 'hashtag')):
+        _create_like_levels_triggers(cur, table, scope)
+
+def _create_like_levels_triggers(cur, table, scope):
+    """Триггеры like_levels на строки table; scope - колонка table или SQL-константа"""
+    new_scope = f'NEW.{scope}' if scope.isidentifier() else scope
+    old_scope = f'OLD.{scope}' if scope.isidentifier() else scope
+    add_level = f'''
+        INSERT OR IGNORE INTO like_levels (scope, likes) VALUES ({new_scope}, NEW.likes);
+        UPDATE like_levels SET art_count = art_count + 1 WHERE scope = {new_scope} AND likes = NEW.likes;
+    '''
+    remove_level = f'''
+        UPDATE like_levels SET art_count = art_count - 1 WHERE scope = {old_scope} AND likes = OLD.likes;
+        DELETE FROM like_levels WHERE scope = {old_scope} AND likes = OLD.likes AND art_count <= 0;
+    '''
+    cur.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_like_levels_{table}_insert AFTER INSERT ON {table}
+        BEGIN {add_level} END
+    ''')
+    cur.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_like_levels_{table}_delete AFTER DELETE ON {table}
+        BEGIN {remove_level} END
+    ''')
+    cur.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_like_levels_{table}_update AFTER UPDATE OF likes ON {table}
+        WHEN NEW.likes != OLD.likes
+        BEGIN {remove_level} {add_level} END
+    ''')
+
+def _migrate_search_index(cur):
+    # Индексы FTS5 с трёхбуквенным токенизатором ищут подстроку без полного прохода
+    # по таблице. Они хранят только rowid исходных строк (content=...), поэтому
+    # после VACUUM, который может перенумеровать rowid all_hashtags, нужен rebuild_search_index
+    try:
+        cur.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS hashtags_fts USING fts5(
+                hashtag_text, content='all_hashtags', tokenize='trigram'
+            )
+        ''')
+        cur.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+                nickname, username, content='users', content_rowid='user_id', tokenize='trigram'
+            )
+        ''')
+    except sqlite3.OperationalError as e:
+        logging.warning(f"SQLite без FTS5/trigram ({e}), поиск останется на LIKE")
+        return
+    
+    cur.execute("INSERT INTO hashtags_fts (hashtags_fts) VALUES ('rebuild')")
+    cur.execute("INSERT INTO users_fts (users_fts) VALUES ('rebuild')")
+    # Короткие запросы и поиск с опечатками идут по началу ника через эти индексы
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_users_nickname ON users (nickname COLLATE NOCASE)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_users_username ON users (username COLLATE NOCASE)')
+    
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_hashtags_fts_insert AFTER INSERT ON all_hashtags
+        BEGIN
+            INSERT INTO hashtags_fts (rowid, hashtag_text) VALUES (NEW.rowid, NEW.hashtag_text);
+        END
+    ''')
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_hashtags_fts_delete AFTER DELETE ON all_hashtags
+        BEGIN
+            INSERT INTO hashtags_fts (hashtags_fts, rowid, hashtag_text) VALUES ('delete', OLD.rowid, OLD.hashtag_text);
+        END
+    ''')
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_hashtags_fts_update AFTER UPDATE OF hashtag_text ON all_hashtags
+        BEGIN
+            INSERT INTO hashtags_fts (hashtags_fts, rowid, hashtag_text) VALUES ('delete', OLD.rowid, OLD.hashtag_text);
+            INSERT INTO hashtags_fts (rowid, hashtag_text) VALUES (NEW.rowid, NEW.hashtag_text);
+        END
+    ''')
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_users_fts_insert AFTER INSERT ON users
+        BEGIN
+            INSERT INTO users_fts (rowid, nickname, username) VALUES (NEW.user_id, NEW.nickname, NEW.username);
+        END
+    ''')
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_users_fts_delete AFTER DELETE ON users
+        BEGIN
+            INSERT INTO users_fts (users_fts, rowid, nickname, username)
+            VALUES ('delete', OLD.user_id, OLD.nickname, OLD.username);
+        END
+    ''')
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_users_fts_update AFTER UPDATE OF nickname, username ON users
+        BEGIN
+            INSERT INTO users_fts (users_fts, rowid, nickname, username)
+            VALUES ('delete', OLD.user_id, OLD.nickname, OLD.username);
+            INSERT INTO users_fts (rowid, nickname, username) VALUES (NEW.user_id, NEW.nickname, NEW.username);
+        END
+    ''')
+
+def _migrate_normalized_tags(cur):
+    # all_hashtags становится словарём тегов: tag_id (прежний rowid, поэтому hashtags_fts
+    # остаётся верным) и текст в нижнем регистре. Связь с артами - art_tags, индексы
+    # в обе стороны. usage_count, hashtag_top и like_levels ведут триггеры art_tags,
+    # тег без артов удаляется. hashtag_top и like_levels теперь с целым ключом тега
+    # (like_levels.scope = 0 - все арты). Вместо таблицы hashtags остаётся представление.
+    # Атомарность шага обеспечивает транзакция apply_migrations, а таблицы, которые шаг
+    # пересоздаёт, удаляются через IF EXISTS - повторный запуск начинает с чистого листа
+    cur.execute("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'all_hashtags'")
+    all_hashtags_triggers = [row[0] for row in cur.fetchall()]
+    
+    cur.execute('DROP TABLE IF EXISTS all_hashtags_new')
+    cur.execute('''
+        CREATE TABLE all_hashtags_new (
+            tag_id INTEGER PRIMARY KEY,
+            hashtag_text TEXT NOT NULL UNIQUE,
+            usage_count INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cur.execute('INSERT INTO all_hashtags_new (tag_id, hashtag_text) SELECT rowid, hashtag_text FROM all_hashtags')
+    # LOWER в SQLite меняет только латиницу, а all_hashtags заполнялась через str.lower
+    cur.connection.create_function(
+        'py_lower', 1, lambda text: text.lower() if isinstance(text, str) else text, deterministic=True
+    )
+    cur.execute('''
+        INSERT OR IGNORE INTO all_hashtags_new (hashtag_text)
+        SELECT DISTINCT py_lower(hashtag) FROM hashtags WHERE hashtag != ''
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS art_tags (
+            art_id INTEGER NOT NULL,
+            tag_id INTEGER NOT NULL,
+            PRIMARY KEY (art_id, tag_id)
+        ) WITHOUT ROWID
+    ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_art_tags_tag ON art_tags (tag_id, art_id)')
+    cur.execute('''
+        INSERT OR IGNORE INTO art_tags (art_id, tag_id)
+        SELECT h.art_id, t.tag_id
+        FROM hashtags h
+        JOIN arts a ON a.art_id = h.art_id
+        JOIN all_hashtags_new t ON t.hashtag_text = py_lower(h.hashtag)
+    ''')
+    # Счётчики, которые раньше вели вручную, пересчитываются по фактическим связям
+    cur.execute('''
+        UPDATE all_hashtags_new SET usage_count = (
+            SELECT COUNT(*) FROM art_tags WHERE tag_id = all_hashtags_new.tag_id
+        )
+    ''')
+    cur.execute('DELETE FROM all_hashtags_new WHERE usage_count = 0')
+    cur.execute('DROP TABLE all_hashtags')
+    cur.execute('ALTER TABLE all_hashtags_new RENAME TO all_hashtags')
+    for statement in all_hashtags_triggers:
+        cur.execute(statement)
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'hashtags_fts'")
+    if cur.fetchone():
+        cur.execute("INSERT INTO hashtags_fts (hashtags_fts) VALUES ('rebuild')")
+    
+    cur.execute('DROP TABLE IF EXISTS hashtag_top')
+    cur.execute('''
+        CREATE TABLE hashtag_top (
+            tag_id INTEGER,
+            art_id INTEGER,
+            likes INTEGER,
+            timestamp DATETIME,
+            PRIMARY KEY (tag_id, art_id)
+        )
+    ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_hashtag_top_rank ON hashtag_top (tag_id, likes DESC, timestamp DESC)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_hashtag_top_art ON hashtag_top (art_id)')
+    cur.execute('''
+        INSERT INTO hashtag_top (tag_id, art_id, likes, timestamp)
+        SELECT t.tag_id, a.art_id, a.likes, a.timestamp
+        FROM art_tags t
+        JOIN arts a ON a.art_id = t.art_id
+    ''')
+    
+    cur.execute('DROP TABLE IF EXISTS like_levels')
+    cur.execute('''
+        CREATE TABLE like_levels (
+            scope INTEGER,
+            likes INTEGER,
+            art_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (scope, likes)
+        ) WITHOUT ROWID
+    ''')
+    cur.execute('''
+        INSERT INTO like_levels (scope, likes, art_count)
+        SELECT 0, likes, COUNT(*) FROM arts GROUP BY likes
+    ''')
+    cur.execute('''
+        INSERT INTO like_levels (scope, likes, art_count)
+        SELECT tag_id, likes, COUNT(*) FROM hashtag_top GROUP BY tag_id, likes
+    ''')
+    for event in ('insert', 'delete', 'update'):
+        cur.execute(f'DROP TRIGGER IF EXISTS trg_like_levels_arts_{event}')
+    _create_like_levels_triggers(cur, 'arts', '0')
+    _create_like_levels_triggers(cur, 'hashtag_top', 'tag_id')
+    
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_art_tags_insert AFTER INSERT ON art_tags
+        BEGIN
+            UPDATE all_hashtags SET usage_count = usage_count + 1 WHERE tag_id = NEW.tag_id;
+            INSERT OR IGNORE INTO hashtag_top (tag_id, art_id, likes, timestamp)
+            SELECT NEW.tag_id, art_id, likes, timestamp FROM arts WHERE art_id = NEW.art_id;
+        END
+    ''')
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_art_tags_delete AFTER DELETE ON art_tags
+        BEGIN
+            UPDATE all_hashtags SET usage_count = usage_count - 1 WHERE tag_id = OLD.tag_id;
+            DELETE FROM all_hashtags WHERE tag_id = OLD.tag_id AND usage_count <= 0;
+            DELETE FROM hashtag_top WHERE tag_id = OLD.tag_id AND art_id = OLD.art_id;
+        END
+    ''')
+    
+    cur.execute('DROP TABLE IF EXISTS hashtags')
+    cur.execute('''
+        CREATE VIEW IF NOT EXISTS hashtags AS
+        SELECT at.art_id, t.hashtag_text AS hashtag
+        FROM art_tags at
+        JOIN all_hashtags t ON t.tag_id = at.tag_id
+    ''')
+    cur.execute('ANALYZE')
+
+def _migrate_art_cleanup_indexes(cur):
+    # Удаление и блокировка чистят complaints и viewed_reactions по art_id - без индекса
+    # каждый такой DELETE проходил всю таблицу
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_complaints_art ON complaints (art_id)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_viewed_reactions_art ON viewed_reactions (art_id)')
+
+# (версия, описание, функция) - строго по возрастанию версии, уже выпущенные шаги не меняются
+SCHEMA_MIGRATIONS = [
+    (1, "колонка timestamp в reactions", _migrate_reactions_timestamp),
+    (2, "колонки профиля в users", _migrate_users_profile_columns),
+    (3, "индексы для горячих запросов", _migrate_hot_path_indexes),
+    (4, "рейтинг ленты feed_scores", _migrate_feed_scores),
+    (5, "кэш вердиктов модерации moderation_verdicts", _migrate_moderation_verdicts),
+    (6, "задания загрузки артов upload_jobs", _migrate_upload_jobs),
+    (7, "хэш отрисованной карточки в active_messages", _migrate_active_messages_rendered_hash),
+    (8, "счётчики непросмотренных реакций reaction_inbox", _migrate_reaction_inbox),
+    (9, "проходы напоминаний reminder_runs", _migrate_reminder_runs),
+    (10, "таблицы лидеров artist_stats и hashtag_top", _migrate_leaderboards),
+    (11, "уровни лайков like_levels для ранга в топе", _migrate_like_levels),
+    (12, "полнотекстовый поиск по хэштегам и профилям", _migrate_search_index),
+    (13, "словарь тегов all_hashtags.tag_id и связи art_tags", _migrate_normalized_tags),
+    (14, "индексы по art_id для удаления артов", _migrate_art_cleanup_indexes),
+]
+
+def get_schema_version(cur):
+    cur.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version')
+    return cur.fetchone()[0]
+
+def apply_migrations(conn, target_version=None):
+    """
+    Применяет все ещё не выполненные шаги миграции, каждый в своей транзакции.
+    Модуль sqlite3 в режиме по умолчанию выполняет CREATE, DROP и ALTER вне транзакции,
+    поэтому на время миграций соединение переводится в autocommit, а BEGIN и COMMIT
+    выдаются явно: при ошибке шаг откатывается целиком, вместе с изменениями схемы.
+    """
+    cur = conn.cursor()
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.commit()
+    
+    current_version = get_schema_version(cur)
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        for version, description, migrate in SCHEMA_MIGRATIONS:
+            if version <= current_version:
+                continue
+            if target_version is not None and version > target_version:
+                break
+            logging.info(f"Применяем миграцию схемы БД {version}: {description}...")
+            try:
+                cur.execute('BEGIN')
+                migrate(cur)
+                cur.execute('INSERT INTO schema_version (version, description) VALUES (?, ?)',
+                            (version, description))
+                cur.execute('COMMIT')
+            except Exception:
+                if conn.in_transaction:
+                    conn.rollback()
+                logging.exception(f"Ошибка миграции схемы БД {version}")
+                raise
+            current_version = version
+    finally:
+        conn.isolation_level = isolation_level
+    return current_version
+
+def init_db(schema_version=None):
+    conn = get_db_connection()
+    cur = conn.cursor()
+
     cur.execute('''
         CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
@@ -102,19 +1078,6 @@ def init_db():
             is_profile_public BOOLEAN DEFAULT TRUE
         )
     ''')
-    
-    try:
-        cur.execute("PRAGMA table_info(users)")
-        columns = [row[1] for row in cur.fetchall()]
-        if 'nickname' not in columns:
-            logging.info("Добавляем новые колонки в таблицу 'users'...")
-            cur.execute("ALTER TABLE users ADD COLUMN nickname TEXT")
-            cur.execute("ALTER TABLE users ADD COLUMN bio TEXT")
-            cur.execute("ALTER TABLE users ADD COLUMN profile_avatar_file_id TEXT")
-            cur.execute("ALTER TABLE users ADD COLUMN is_profile_public BOOLEAN DEFAULT TRUE")
-            conn.commit()
-    except sqlite3.OperationalError:
-        pass
 
     cur.execute('''
         CREATE TABLE IF NOT EXISTS privacy_settings (
@@ -304,13 +1267,15 @@ def init_db():
     ''')
 
     conn.commit()
+    apply_migrations(conn, target_version=schema_version)
+    refresh_search_index_status(conn)
     conn.close()
 
 # ========== СИСТЕМА ОБНОВЛЕНИЯ В РЕАЛЬНОМ ВРЕМЕНИ ==========
 
 def add_active_message(message_id, chat_id, art_id, user_id):
     """Добавляет сообщение в список активных для обновления"""
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     
     cur.execute('''
@@ -323,7 +1288,7 @@ def add_active_message(message_id, chat_id, art_id, user_id):
 
 def remove_active_message(message_id, chat_id):
     """Удаляет сообщение из списка активных"""
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     
     cur.execute('DELETE FROM active_messages WHERE message_id = ? AND chat_id = ?', 
@@ -332,9 +1297,32 @@ def remove_active_message(message_id, chat_id):
     conn.commit()
     conn.close()
 
+def save_rendered_active_messages(rendered):
+    """Сохраняет хэши отрисованных карточек: [(rendered_hash, message_id, chat_id), ...]"""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    
+    cur.executemany('''
+        UPDATE active_messages SET rendered_hash = ?, last_updated = CURRENT_TIMESTAMP
+        WHERE message_id = ? AND chat_id = ?
+    ''', rendered)
+    
+    conn.commit()
+    conn.close()
+
+def remove_active_messages(messages):
+    """Удаляет недействительные сообщения: [(message_id, chat_id), ...]"""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    
+    cur.executemany('DELETE FROM active_messages WHERE message_id = ? AND chat_id = ?', messages)
+    
+    conn.commit()
+    conn.close()
+
 def get_active_messages_for_art(art_id):
     """Получает все активные сообщения для конкретного арта"""
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     
     cur.execute('SELECT message_id, chat_id, user_id FROM active_messages WHERE art_id = ?', 
@@ -343,12 +1331,27 @@ def get_active_messages_for_art(art_id):
     conn.close()
     return messages
 
-def cleanup_old_active_messages(hours=24):
-    """Очищает старые записи об активных сообщениях"""
-    conn = sqlite3.connect('database.db')
+def get_active_messages_with_reactions(art_id):
+    """Активные сообщения арта вместе с реакцией зрителя и хэшем карточки - одним запросом"""
+    conn = get_db_connection()
     cur = conn.cursor()
     
-    cutoff_time = datetime.now() - timedelta(hours=hours)
+    cur.execute('''
+        SELECT am.message_id, am.chat_id, am.user_id, r.type, am.rendered_hash
+        FROM active_messages am
+        LEFT JOIN reactions r ON r.user_id = am.user_id AND r.art_id = am.art_id
+        WHERE am.art_id = ?
+    ''', (art_id,))
+    messages = cur.fetchall()
+    conn.close()
+    return messages
+
+def cleanup_old_active_messages(hours=24):
+    """Очищает старые записи об активных сообщениях"""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    
+    cutoff_time = datetime.now() - timedelta(hours=hours)
     cur.execute('DELETE FROM active_messages WHERE last_updated < ?', 
                 (cutoff_time,))
     
@@ -359,20 +1362,74 @@ def cleanup_old_active_messages(hours=24):
     if deleted_count > 0:
         logging.info(f"Очищено {deleted_count} устаревших активных сообщений")
 
+# Реакции на арт за REALTIME_REFRESH_DELAY сливаются в одно обновление карточек.
+# Правки расходятся параллельно, не больше REALTIME_EDIT_CONCURRENCY за раз, а
+# карточки, чей текст и кнопки не изменились, не правятся вовсе.
+REALTIME_REFRESH_DELAY = 1.0  # секунд
+REALTIME_EDIT_CONCURRENCY = 8
+_art_refresh_tasks = {}
+_art_refresh_dirty = set()
+
+def schedule_art_message_refresh(context: ContextTypes.DEFAULT_TYPE, art_id: int):
+    """Планирует обновление всех карточек арта; повторные вызовы до обновления сливаются"""
+    task = _art_refresh_tasks.get(art_id)
+    if task is not None and not task.done():
+        _art_refresh_dirty.add(art_id)
+        return
+    _art_refresh_tasks[art_id] = asyncio.create_task(_refresh_art_messages_later(context, art_id))
+
+@in_background_lane
+async def _refresh_art_messages_later(context, art_id):
+    try:
+        while True:
+            await asyncio.sleep(REALTIME_REFRESH_DELAY)
+            _art_refresh_dirty.discard(art_id)
+            await update_art_message_realtime(context, art_id)
+            # Реакции, пришедшие во время обновления, требуют ещё одного прохода
+            if art_id not in _art_refresh_dirty:
+                break
+    finally:
+        _art_refresh_tasks.pop(art_id, None)
+
+def build_realtime_keyboard(art_id, existing_reaction):
+    if existing_reaction:
+        keyboard = [
+            [InlineKeyboardButton("💬 Комментарий", callback_data=f'comment_{art_id}')],
+            [InlineKeyboardButton("🚫 Пожаловаться", callback_data=f'complaint_{art_id}')],
+            [InlineKeyboardButton("🔙 В меню", callback_data='back_to_menu')]
+        ]
+        
+        if existing_reaction == 'like':
+            keyboard[0].insert(0, InlineKeyboardButton("❤️ Вы лайкнули", callback_data='already_reacted'))
+        else:
+            keyboard[0].insert(0, InlineKeyboardButton("👎 Вы дизлайкнули", callback_data='already_reacted'))
+    else:
+        keyboard = [
+            [
+                InlineKeyboardButton("❤️ Лайк", callback_data=f'like_{art_id}'),
+                InlineKeyboardButton("👎 Дизлайк", callback_data=f'dislike_{art_id}')
+            ],
+            [InlineKeyboardButton("💬 Комментарий", callback_data=f'comment_{art_id}')],
+            [InlineKeyboardButton("🚫 Пожаловаться", callback_data=f'complaint_{art_id}')],
+            [InlineKeyboardButton("🔙 В меню", callback_data='back_to_menu')]
+        ]
+    return InlineKeyboardMarkup(keyboard)
+
+@in_background_lane
 async def update_art_message_realtime(context: ContextTypes.DEFAULT_TYPE, art_id: int):
     """Обновляет все активные сообщения с указанным артом"""
     try:
-        art = get_art_by_id(art_id)
+        art = await db_read(get_art_by_id, art_id)
         if not art:
             return
         
         art_id, file_id, caption, likes, dislikes = art
-        active_messages = get_active_messages_for_art(art_id)
+        active_messages = await db_read(get_active_messages_with_reactions, art_id)
         
         if not active_messages:
             return
         
-        hashtags = get_art_hashtags(art_id)
+        hashtags = await db_read(get_art_hashtags, art_id)
         hashtags_text = " ".join(hashtags) if hashtags else ""
         
         text = f"Лайков: {likes} | Дизлайков: {dislikes}"
@@ -381,63 +1438,40 @@ async def update_art_message_realtime(context: ContextTypes.DEFAULT_TYPE, art_id
         if hashtags_text:
             text = f"{text}\n\n{hashtags_text}"
         
-        for message_id, chat_id, user_id in active_messages:
+        semaphore = asyncio.Semaphore(REALTIME_EDIT_CONCURRENCY)
+        rendered, invalid = [], []
+        
+        async def edit(message_id, chat_id, existing_reaction, rendered_hash):
+            card_hash = hashlib.sha1(f"{existing_reaction}\n{text}".encode('utf-8')).hexdigest()
+            if card_hash == rendered_hash:
+                return
             try:
-                conn = sqlite3.connect('database.db')
-                cur = conn.cursor()
-                cur.execute('SELECT type FROM reactions WHERE user_id = ? AND art_id = ?', 
-                           (user_id, art_id))
-                existing_reaction = cur.fetchone()
-                conn.close()
-                
-                if existing_reaction:
-                    keyboard = [
-                        [InlineKeyboardButton("💬 Комментарий", callback_data=f'comment_{art_id}')],
-                        [InlineKeyboardButton("🚫 Пожаловаться", callback_data=f'complaint_{art_id}')],
-                        [InlineKeyboardButton("🔙 В меню", callback_data='back_to_menu')]
-                    ]
-                    
-                    reaction_type = existing_reaction[0]
-                    if reaction_type == 'like':
-                        keyboard[0].insert(0, InlineKeyboardButton("❤️ Вы лайкнули", callback_data='already_reacted'))
-                    else:
-                        keyboard[0].insert(0, InlineKeyboardButton("👎 Вы дизлайкнули", callback_data='already_reacted'))
-                else:
-                    keyboard = [
-                        [
-                            InlineKeyboardButton("❤️ Лайк", callback_data=f'like_{art_id}'),
-                            InlineKeyboardButton("👎 Дизлайк", callback_data=f'dislike_{art_id}')
-                        ],
-                        [InlineKeyboardButton("💬 Комментарий", callback_data=f'comment_{art_id}')],
-                        [InlineKeyboardButton("🚫 Пожаловаться", callback_data=f'complaint_{art_id}')],
-                        [InlineKeyboardButton("🔙 В меню", callback_data='back_to_menu')]
-                    ]
-                
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                await context.bot.edit_message_caption(
-                    chat_id=chat_id,
-                    message_id=message_id,
-                    caption=text,
-                    reply_markup=reply_markup
-                )
-                
-                conn = sqlite3.connect('database.db')
-                cur = conn.cursor()
-                cur.execute('UPDATE active_messages SET last_updated = CURRENT_TIMESTAMP WHERE message_id = ? AND chat_id = ?',
-                           (message_id, chat_id))
-                conn.commit()
-                conn.close()
-                
+                async with semaphore:
+                    await context.bot.edit_message_caption(
+                        chat_id=chat_id,
+                        message_id=message_id,
+                        caption=text,
+                        reply_markup=build_realtime_keyboard(art_id, existing_reaction)
+                    )
+                rendered.append((card_hash, message_id, chat_id))
             except telegram.error.BadRequest as e:
                 if "Message is not modified" in str(e):
-                    pass
+                    rendered.append((card_hash, message_id, chat_id))
                 else:
                     logging.warning(f"Удаляем недействительное сообщение {message_id}: {e}")
-                    remove_active_message(message_id, chat_id)
+                    invalid.append((message_id, chat_id))
             except Exception as e:
                 logging.error(f"Ошибка при обновлении сообщения {message_id}: {e}")
-                remove_active_message(message_id, chat_id)
+                invalid.append((message_id, chat_id))
+        
+        await asyncio.gather(*(
+            edit(message_id, chat_id, existing_reaction, rendered_hash)
+            for message_id, chat_id, _, existing_reaction, rendered_hash in active_messages
+        ))
+        if rendered:
+            await db_write(save_rendered_active_messages, rendered)
+        if invalid:
+            await db_write(remove_active_messages, invalid)
                 
     except Exception as e:
         logging.error(f"Ошибка в update_art_message_realtime: {e}")
@@ -445,15 +1479,16 @@ async def update_art_message_realtime(context: ContextTypes.DEFAULT_TYPE, art_id
 async def realtime_updater(context: ContextTypes.DEFAULT_TYPE):
     """Фоновая задача для обслуживания системы реального времени"""
     try:
-        cleanup_old_active_messages(hours=24)
-        cleanup_old_deleted_arts()
+        await db_write(cleanup_old_active_messages, hours=24)
+        await db_write(cleanup_old_deleted_arts)
+        await db_write(prune_verdict_cache)
         
     except Exception as e:
         logging.error(f"Ошибка в realtime_updater: {e}")
 
 def cleanup_old_deleted_arts():
     """Окончательно удаляет арты, которые были удалены более 1 дня назад"""
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     
     cur.execute('''
@@ -473,7 +1508,7 @@ def cleanup_old_deleted_arts():
 
 def get_active_notification_messages(owner_id):
     """Получает все активные уведомления пользователя"""
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     cur.execute('SELECT message_id, chat_id, last_count FROM notification_messages WHERE user_id = ?', (owner_id,))
     result = cur.fetchall()
@@ -483,57 +1518,58 @@ def get_active_notification_messages(owner_id):
 async def create_or_update_reaction_notification(context: ContextTypes.DEFAULT_TYPE, owner_id: int):
     """Создает новое уведомление или обновляет существующее в реальном времени"""
     try:
-        unviewed_count = get_unviewed_reactions_count(owner_id)
-        
-        if unviewed_count == 0:
-            active_notifications = get_active_notification_messages(owner_id)
-            for message_id, chat_id, _ in active_notifications:
-                try:
-                    await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
-                except:
-                    pass
-            delete_all_notification_messages(owner_id)
-            return
-        
-        message_text = f"🎉 Твой арт понравился {unviewed_count} человеку!" if unviewed_count == 1 else f"🎉 Твой арт понравился {unviewed_count} людям!"
-        
-        keyboard = [
-            [InlineKeyboardButton("🔍 Показать", callback_data='show_reactions')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        active_notifications = get_active_notification_messages(owner_id)
-        
-        if active_notifications:
-            for message_id, chat_id, last_count in active_notifications:
-                if unviewed_count != last_count:
-                    try:
-                        await context.bot.edit_message_text(
-                            chat_id=chat_id,
-                            message_id=message_id,
-                            text=message_text,
-                            reply_markup=reply_markup
-                        )
-                        save_notification_message(owner_id, message_id, chat_id, unviewed_count)
-                    except Exception as e:
-                        logging.error(f"Ошибка при обновлении уведомления: {e}")
-                        delete_notification_message_by_id(owner_id, message_id)
-                        await create_new_notification(context, owner_id, message_text, reply_markup)
-        else:
-            await create_new_notification(context, owner_id, message_text, reply_markup)
-            
+        unviewed_count = await db_read(get_unviewed_reactions_count, owner_id)
+        active_notifications = await db_read(get_active_notification_messages, owner_id)
+        await deliver_reaction_notification(context, owner_id, unviewed_count, active_notifications)
     except Exception as e:
         logging.error(f"Ошибка в create_or_update_reaction_notification: {e}")
 
+async def deliver_reaction_notification(context, owner_id, unviewed_count, active_notifications):
+    """Приводит уведомление автора к unviewed_count по уже прочитанному состоянию из БД"""
+    if unviewed_count == 0:
+        for message_id, chat_id, _ in active_notifications:
+            try:
+                await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
+            except:
+                pass
+        await db_write(delete_all_notification_messages, owner_id)
+        return
+    
+    message_text = f"🎉 Твой арт понравился {unviewed_count} человеку!" if unviewed_count == 1 else f"🎉 Твой арт понравился {unviewed_count} людям!"
+    
+    keyboard = [
+        [InlineKeyboardButton("🔍 Показать", callback_data='show_reactions')]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    if active_notifications:
+        for message_id, chat_id, last_count in active_notifications:
+            if unviewed_count != last_count:
+                try:
+                    await context.bot.edit_message_text(
+                        chat_id=chat_id,
+                        message_id=message_id,
+                        text=message_text,
+                        reply_markup=reply_markup
+                    )
+                    await db_write(save_notification_message, owner_id, message_id, chat_id, unviewed_count)
+                except Exception as e:
+                    logging.error(f"Ошибка при обновлении уведомления: {e}")
+                    await db_write(delete_notification_message_by_id, owner_id, message_id)
+                    await create_new_notification(context, owner_id, message_text, reply_markup, unviewed_count)
+    else:
+        await create_new_notification(context, owner_id, message_text, reply_markup, unviewed_count)
+
 def delete_all_notification_messages(user_id):
     """Удаляет все уведомления пользователя"""
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     cur.execute('DELETE FROM notification_messages WHERE user_id = ?', (user_id,))
     conn.commit()
     conn.close()
 
 def get_notification_message(user_id):
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     cur.execute('SELECT message_id, chat_id, last_count FROM notification_messages WHERE user_id = ?', (user_id,))
     result = cur.fetchone()
@@ -541,7 +1577,7 @@ def get_notification_message(user_id):
     return result
 
 def save_notification_message(user_id, message_id, chat_id, count):
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     cur.execute('''
         INSERT OR REPLACE INTO notification_messages (user_id, message_id, chat_id, last_count, last_update)
@@ -551,7 +1587,7 @@ def save_notification_message(user_id, message_id, chat_id, count):
     conn.close()
 
 def delete_notification_message(user_id):
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     cur.execute('DELETE FROM notification_messages WHERE user_id = ?', (user_id,))
     conn.commit()
@@ -559,13 +1595,13 @@ def delete_notification_message(user_id):
 
 def delete_notification_message_by_id(user_id, message_id):
     """Удаляет конкретное уведомление по ID сообщения"""
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     cur.execute('DELETE FROM notification_messages WHERE user_id = ? AND message_id = ?', (user_id, message_id))
     conn.commit()
     conn.close()
 
-async def create_new_notification(context, owner_id, message_text, reply_markup):
+async def create_new_notification(context, owner_id, message_text, reply_markup, unviewed_count=None):
     """Создает новое уведомление"""
     try:
         message = await context.bot.send_message(
@@ -573,12 +1609,14 @@ async def create_new_notification(context, owner_id, message_text, reply_markup)
             text=message_text,
             reply_markup=reply_markup
         )
-        save_notification_message(owner_id, message.message_id, owner_id, get_unviewed_reactions_count(owner_id))
+        if unviewed_count is None:
+            unviewed_count = await db_read(get_unviewed_reactions_count, owner_id)
+        await db_write(save_notification_message, owner_id, message.message_id, owner_id, unviewed_count)
     except Exception as e:
         logging.error(f"Ошибка при создании уведомления: {e}")
 
-def add_pending_art(user_id, file_id, caption, hashtags):
-    conn = sqlite3.connect('database.db')
+def add_pending_art(user_id, file_id, caption, hashtags, upload_job_id=None):
+    conn = get_db_connection()
     cur = conn.cursor()
     
     hashtags_text = ",".join(hashtags) if hashtags else ""
@@ -588,13 +1626,19 @@ def add_pending_art(user_id, file_id, caption, hashtags):
         (user_id, file_id, caption, hashtags_text)
     )
     pending_id = cur.lastrowid
+    if upload_job_id is not None:
+        # В той же транзакции: перезапущенное задание не создаст второй pending_art
+        cur.execute(
+            "UPDATE upload_jobs SET stage = 'pending', pending_id = ?, updated_at = CURRENT_TIMESTAMP WHERE job_id = ?",
+            (pending_id, upload_job_id)
+        )
     
     conn.commit()
     conn.close()
     return pending_id
 
 def get_pending_art(pending_id):
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     
     cur.execute('SELECT * FROM pending_arts WHERE pending_id = ?', (pending_id,))
@@ -604,7 +1648,7 @@ def get_pending_art(pending_id):
     return art
 
 def delete_pending_art(pending_id):
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     
     cur.execute('DELETE FROM pending_arts WHERE pending_id = ?', (pending_id,))
@@ -614,7 +1658,7 @@ def delete_pending_art(pending_id):
     return cur.rowcount > 0
 
 def add_user(user_id, username):
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     cur.execute(
         'INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)',
@@ -628,7 +1672,7 @@ def add_user(user_id, username):
     conn.close()
 
 def get_privacy_settings(user_id):
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     cur.execute('SELECT hide_username FROM privacy_settings WHERE user_id = ?', (user_id,))
     result = cur.fetchone()
@@ -641,7 +1685,7 @@ def get_privacy_settings(user_id):
         return {'hide_username': False}
 
 def set_privacy_settings(user_id, hide_username=None):
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     
     if hide_username is not None:
@@ -655,7 +1699,7 @@ def set_privacy_settings(user_id, hide_username=None):
 
 def get_display_name(user_id, for_moderator=False, profile_is_public=False):
     if for_moderator:
-        conn = sqlite3.connect('database.db')
+        conn = get_db_connection()
         cur = conn.cursor()
         cur.execute('SELECT username FROM users WHERE user_id = ?', (user_id,))
         result = cur.fetchone()
@@ -667,7 +1711,7 @@ def get_display_name(user_id, for_moderator=False, profile_is_public=False):
             return "Пользователь"
     else:
         if profile_is_public:
-            conn = sqlite3.connect('database.db')
+            conn = get_db_connection()
             cur = conn.cursor()
             cur.execute('SELECT username FROM users WHERE user_id = ?', (user_id,))
             result = cur.fetchone()
@@ -683,7 +1727,7 @@ def get_display_name(user_id, for_moderator=False, profile_is_public=False):
         if privacy_settings['hide_username']:
             return "Аноним"
         else:
-            conn = sqlite3.connect('database.db')
+            conn = get_db_connection()
             cur = conn.cursor()
             cur.execute('SELECT username FROM users WHERE user_id = ?', (user_id,))
             result = cur.fetchone()
@@ -695,28 +1739,63 @@ def get_display_name(user_id, for_moderator=False, profile_is_public=False):
                 return "Пользователь"
 
 def get_user_art_count(user_id):
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     cur.execute('SELECT COUNT(*) FROM arts WHERE owner_id = ?', (user_id,))
     count = cur.fetchone()[0]
     conn.close()
     return count
 
-def add_hashtag_to_global(hashtag, cur):
-    hashtag_lower = hashtag.lower()
-    
-    cur.execute(
-        'INSERT OR IGNORE INTO all_hashtags (hashtag_text) VALUES (?)',
-        (hashtag_lower,)
-    )
-    
-    cur.execute(
-        'UPDATE all_hashtags SET usage_count = usage_count + 1 WHERE hashtag_text = ?',
-        (hashtag_lower,)
+def add_art_hashtags(cur, art_hashtags):
+    """Связывает арты с тегами словаря по парам (art_id, хэштег); usage_count и hashtag_top обновляют триггеры art_tags"""
+    pairs = [(art_id, hashtag.lower()) for art_id, hashtag in art_hashtags if hashtag]
+    cur.executemany('INSERT OR IGNORE INTO all_hashtags (hashtag_text) VALUES (?)',
+                    [(hashtag,) for hashtag in dict.fromkeys(hashtag for _, hashtag in pairs)])
+    cur.executemany(
+        'INSERT OR IGNORE INTO art_tags (art_id, tag_id) SELECT ?, tag_id FROM all_hashtags WHERE hashtag_text = ?',
+        pairs
     )
+    return [hashtag for _, hashtag in pairs]
+
+# Строки, которые ссылаются на арт и удаляются вместе с ним
+ART_DEPENDENT_TABLES = ('reactions', 'comments', 'art_tags', 'complaints', 'viewed_reactions', 'active_messages')
+
+def archive_arts(cur, condition, params, reason):
+    """Копирует арты, подходящие под condition (псевдоним arts - a), в deleted_arts одним запросом"""
+    # Повторное удаление обновляет снимок: арт мог быть восстановлен и с тех пор набрать лайки
+    cur.execute(f'''
+        INSERT INTO deleted_arts (art_id, owner_id, file_id, caption, likes, dislikes, hashtags, reason)
+        SELECT a.art_id, a.owner_id, a.file_id, a.caption, a.likes, a.dislikes,
+               COALESCE(GROUP_CONCAT(t.hashtag_text, ','), ''), ?
+        FROM arts a
+        LEFT JOIN art_tags at ON at.art_id = a.art_id
+        LEFT JOIN all_hashtags t ON t.tag_id = at.tag_id
+        WHERE {condition}
+        GROUP BY a.art_id
+        ON CONFLICT (art_id) DO UPDATE SET
+            owner_id = excluded.owner_id, file_id = excluded.file_id, caption = excluded.caption,
+            likes = excluded.likes, dislikes = excluded.dislikes, hashtags = excluded.hashtags,
+            reason = excluded.reason, deleted_at = CURRENT_TIMESTAMP, restored_at = NULL
+    ''', (reason, *params))
+
+def delete_art_rows(cur, condition, params):
+    """Удаляет арты под condition (псевдоним arts - a) вместе со связанными строками, возвращает число артов"""
+    for table in ART_DEPENDENT_TABLES:
+        cur.execute(f'DELETE FROM {table} WHERE art_id IN (SELECT a.art_id FROM arts a WHERE {condition})', params)
+    cur.execute(f'DELETE FROM arts AS a WHERE {condition}', params)
+    return cur.rowcount
+
+def get_tag_id(cur, hashtag):
+    """tag_id хэштега или None, если ни один арт его не использует"""
+    cur.execute('SELECT tag_id FROM all_hashtags WHERE hashtag_text = ?', (hashtag.lower(),))
+    row = cur.fetchone()
+    return row[0] if row else None
 
 def get_popular_hashtags(limit=20):
-    conn = sqlite3.connect('database.db')
+    if hashtag_index.loaded:
+        return hashtag_index.top('', limit)
+    
+    conn = get_db_connection()
     cur = conn.cursor()
     cur.execute(
         'SELECT hashtag_text, usage_count FROM all_hashtags ORDER BY usage_count DESC LIMIT ?',
@@ -726,18 +1805,7 @@ def get_popular_hashtags(limit=20):
     conn.close()
     return hashtags
 
-def search_hashtags(query, limit=10):
-    conn = sqlite3.connect('database.db')
-    cur = conn.cursor()
-    cur.execute(
-        'SELECT hashtag_text, usage_count FROM all_hashtags WHERE hashtag_text LIKE ? ORDER BY usage_count DESC LIMIT ?',
-        (f'%{query.lower()}%', limit)
-    )
-    hashtags = cur.fetchall()
-    conn.close()
-    return hashtags
-
-def add_art(user_id, file_id, caption="", hashtags=None):
+def add_art(user_id, file_id, caption="", hashtags=None, upload_job_id=None):
     if hashtags is None:
         hashtags = []
     
@@ -745,7 +1813,7 @@ def add_art(user_id, file_id, caption="", hashtags=None):
     if art_count >= MAX_ARTS_PER_USER:
         return None, f"❌ Лимит артов достигнут! Максимум {MAX_ARTS_PER_USER} артов на пользователя."
     
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     
     try:
@@ -755,14 +1823,17 @@ def add_art(user_id, file_id, caption="", hashtags=None):
         )
         art_id = cur.lastrowid
         
-        for hashtag in hashtags[:MAX_HASHTAGS_PER_ART]:
+        add_art_hashtags(cur, [(art_id, hashtag) for hashtag in hashtags[:MAX_HASHTAGS_PER_ART]])
+        
+        if upload_job_id is not None:
+            # В той же транзакции: перезапущенное задание не опубликует арт дважды
             cur.execute(
-                'INSERT INTO hashtags (art_id, hashtag) VALUES (?, ?)',
-                (art_id, hashtag)
+                "UPDATE upload_jobs SET stage = 'published', art_id = ?, updated_at = CURRENT_TIMESTAMP WHERE job_id = ?",
+                (art_id, upload_job_id)
             )
-            add_hashtag_to_global(hashtag, cur)
         
         conn.commit()
+        sync_hashtag_index(cur, hashtags[:MAX_HASHTAGS_PER_ART])
         return art_id, "✅ Арт успешно добавлен!"
     
     except Exception as e:
@@ -774,15 +1845,19 @@ def add_art(user_id, file_id, caption="", hashtags=None):
         conn.close()
 
 def get_art_hashtags(art_id):
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
-    cur.execute('SELECT hashtag FROM hashtags WHERE art_id = ?', (art_id,))
+    cur.execute('''
+        SELECT t.hashtag_text FROM art_tags at
+        JOIN all_hashtags t ON t.tag_id = at.tag_id
+        WHERE at.art_id = ?
+    ''', (art_id,))
     hashtags = [row[0] for row in cur.fetchall()]
     conn.close()
     return hashtags
 
 def delete_art(user_id, art_number):
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     
     cur.execute('''
@@ -800,83 +1875,42 @@ def delete_art(user_id, art_number):
     art_id_to_delete = arts[art_number - 1][0]
     hashtags_to_delete = get_art_hashtags(art_id_to_delete)
     
-    cur.execute('DELETE FROM reactions WHERE art_id = ?', (art_id_to_delete,))
-    cur.execute('DELETE FROM comments WHERE art_id = ?', (art_id_to_delete,))
-    cur.execute('DELETE FROM hashtags WHERE art_id = ?', (art_id_to_delete,))
-    cur.execute('DELETE FROM complaints WHERE art_id = ?', (art_id_to_delete,))
-    cur.execute('DELETE FROM viewed_reactions WHERE art_id = ?', (art_id_to_delete,))
-    cur.execute('DELETE FROM active_messages WHERE art_id = ?', (art_id_to_delete,))
-    
-    cur.execute('DELETE FROM arts WHERE art_id = ? AND owner_id = ?', (art_id_to_delete, user_id))
-    
-    if cur.rowcount == 0:
+    if delete_art_rows(cur, 'a.art_id = ? AND a.owner_id = ?', (art_id_to_delete, user_id)) == 0:
         conn.close()
         return False, "❌ Ошибка при удалении арта!"
     
-    for hashtag in hashtags_to_delete:
-        cur.execute(
-            'UPDATE all_hashtags SET usage_count = usage_count - 1 WHERE hashtag_text = ?',
-            (hashtag.lower(),)
-        )
-        cur.execute('DELETE FROM all_hashtags WHERE usage_count <= 0')
-    
     conn.commit()
+    sync_hashtag_index(cur, hashtags_to_delete)
     conn.close()
+    invalidate_feed_queues(art_id=art_id_to_delete)
     return True, f"✅ Арт #{art_number} успешно удален!"
 
 def delete_art_by_id(art_id, reason="User deletion"):
     """Мягкое удаление арта - помещает в deleted_arts вместо полного удаления"""
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     
-    cur.execute('SELECT owner_id, file_id, caption, likes, dislikes FROM arts WHERE art_id = ?', (art_id,))
-    art_info = cur.fetchone()
-    
-    if not art_info:
+    cur.execute('SELECT 1 FROM arts WHERE art_id = ?', (art_id,))
+    if not cur.fetchone():
         conn.close()
         return False, "Арт не найден!"
     
-    owner_id, file_id, caption, likes, dislikes = art_info
     hashtags_to_delete = get_art_hashtags(art_id)
-    hashtags_text = ",".join(hashtags_to_delete) if hashtags_to_delete else ""
+    archive_arts(cur, 'a.art_id = ?', (art_id,), reason)
     
-    try:
-        cur.execute('''
-            INSERT INTO deleted_arts (art_id, owner_id, file_id, caption, likes, dislikes, hashtags, reason)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (art_id, owner_id, file_id, caption, likes, dislikes, hashtags_text, reason))
-    except sqlite3.IntegrityError:
-        cur.execute('''
-            UPDATE deleted_arts SET deleted_at = CURRENT_TIMESTAMP, reason = ?
-            WHERE art_id = ?
-        ''', (reason, art_id))
-    
-    cur.execute('DELETE FROM reactions WHERE art_id = ?', (art_id,))
-    cur.execute('DELETE FROM comments WHERE art_id = ?', (art_id,))
-    cur.execute('DELETE FROM hashtags WHERE art_id = ?', (art_id,))
-    cur.execute('DELETE FROM complaints WHERE art_id = ?', (art_id,))
-    cur.execute('DELETE FROM viewed_reactions WHERE art_id = ?', (art_id,))
-    cur.execute('DELETE FROM active_messages WHERE art_id = ?', (art_id,))
-    cur.execute('DELETE FROM arts WHERE art_id = ?', (art_id,))
-    
-    if cur.rowcount == 0:
+    if delete_art_rows(cur, 'a.art_id = ?', (art_id,)) == 0:
         conn.close()
         return False, "Ошибка при удалении арта!"
     
-    for hashtag in hashtags_to_delete:
-        cur.execute(
-            'UPDATE all_hashtags SET usage_count = usage_count - 1 WHERE hashtag_text = ?',
-            (hashtag.lower(),)
-        )
-        cur.execute('DELETE FROM all_hashtags WHERE usage_count <= 0')
-    
     conn.commit()
+    sync_hashtag_index(cur, hashtags_to_delete)
     conn.close()
+    invalidate_feed_queues(art_id=art_id)
     return True, "Арт успешно удален!"
 
 def get_user_block_status(user_id):
     """Получает информацию о блокировке пользователя"""
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     cur.execute('SELECT block_id, blocked_at, reason, appeal_status FROM user_blocks WHERE user_id = ?', (user_id,))
     result = cur.fetchone()
@@ -889,7 +1923,7 @@ def is_user_blocked(user_id):
 
 def block_user(user_id, reason, moderator_id):
     """Блокирует пользователя и скрывает все его арты"""
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     
     try:
@@ -908,32 +1942,25 @@ def block_user(user_id, reason, moderator_id):
                 VALUES (?, ?, ?)
             ''', (user_id, reason, moderator_id))
         cur.execute('SELECT art_id FROM arts WHERE owner_id = ?', (user_id,))
-        arts = cur.fetchall()
-        
-        for art in arts:
-            art_id = art[0]
-            cur.execute('SELECT file_id, caption, likes, dislikes FROM arts WHERE art_id = ?', (art_id,))
-            art_info = cur.fetchone()
-            if art_info:
-                file_id, caption, likes, dislikes = art_info
-                hashtags = get_art_hashtags(art_id)
-                hashtags_text = ",".join(hashtags) if hashtags else ""
-                
-                cur.execute('''
-                    INSERT OR IGNORE INTO deleted_arts (art_id, owner_id, file_id, caption, likes, dislikes, hashtags, reason)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (art_id, user_id, file_id, caption, likes, dislikes, hashtags_text, "User blocked"))
-        
-        cur.execute('DELETE FROM reactions WHERE art_id IN (SELECT art_id FROM arts WHERE owner_id = ?)', (user_id,))
-        cur.execute('DELETE FROM comments WHERE art_id IN (SELECT art_id FROM arts WHERE owner_id = ?)', (user_id,))
-        cur.execute('DELETE FROM hashtags WHERE art_id IN (SELECT art_id FROM arts WHERE owner_id = ?)', (user_id,))
-        cur.execute('DELETE FROM complaints WHERE art_id IN (SELECT art_id FROM arts WHERE owner_id = ?)', (user_id,))
-        cur.execute('DELETE FROM viewed_reactions WHERE art_id IN (SELECT art_id FROM arts WHERE owner_id = ?)', (user_id,))
-        cur.execute('DELETE FROM active_messages WHERE art_id IN (SELECT art_id FROM arts WHERE owner_id = ?)', (user_id,))
-        cur.execute('DELETE FROM arts WHERE owner_id = ?', (user_id,))
+        art_ids = [row[0] for row in cur.fetchall()]
+        cur.execute('''
+            SELECT DISTINCT t.hashtag_text
+            FROM arts a
+            JOIN art_tags at ON at.art_id = a.art_id
+            JOIN all_hashtags t ON t.tag_id = at.tag_id
+            WHERE a.owner_id = ?
+        ''', (user_id,))
+        blocked_hashtags = [row[0] for row in cur.fetchall()]
+        
+        archive_arts(cur, 'a.owner_id = ?', (user_id,), "User blocked")
+        delete_art_rows(cur, 'a.owner_id = ?', (user_id,))
         
         conn.commit()
+        sync_hashtag_index(cur, blocked_hashtags)
         conn.close()
+        invalidate_feed_queues(user_id=user_id)
+        for art_id in art_ids:
+            invalidate_feed_queues(art_id=art_id)
         return True, "Пользователь заблокирован!"
     except Exception as e:
         logging.error(f"Ошибка при блокировке пользователя: {e}")
@@ -942,37 +1969,37 @@ def block_user(user_id, reason, moderator_id):
 
 def unblock_user(user_id):
     """Разблокирует пользователя и восстанавливает все его арты"""
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     
     try:
         cur.execute('''
-            SELECT art_id, file_id, caption, likes, dislikes, hashtags 
-            FROM deleted_arts 
+            SELECT art_id, hashtags FROM deleted_arts
             WHERE owner_id = ? AND reason = 'User blocked'
         ''', (user_id,))
         deleted_arts = cur.fetchall()
         
-        for art_id, file_id, caption, likes, dislikes, hashtags_text in deleted_arts:
-            cur.execute('''
-                INSERT OR IGNORE INTO arts (art_id, owner_id, file_id, caption, likes, dislikes)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (art_id, user_id, file_id, caption, likes, dislikes))
-            if hashtags_text:
-                for hashtag in hashtags_text.split(","):
-                    cur.execute('INSERT INTO hashtags (art_id, hashtag) VALUES (?, ?)',
-                               (art_id, hashtag))
-                    cur.execute('INSERT OR IGNORE INTO all_hashtags (hashtag_text) VALUES (?)',
-                               (hashtag.lower(),))
-                    cur.execute(
-                        'UPDATE all_hashtags SET usage_count = usage_count + 1 WHERE hashtag_text = ?',
-                        (hashtag.lower(),)
-                    )
-            cur.execute('UPDATE deleted_arts SET restored_at = CURRENT_TIMESTAMP WHERE art_id = ?', (art_id,))
+        cur.execute('''
+            INSERT OR IGNORE INTO arts (art_id, owner_id, file_id, caption, likes, dislikes)
+            SELECT art_id, owner_id, file_id, caption, likes, dislikes
+            FROM deleted_arts
+            WHERE owner_id = ? AND reason = 'User blocked'
+        ''', (user_id,))
+        restored_hashtags = add_art_hashtags(cur, [
+            (art_id, hashtag)
+            for art_id, hashtags_text in deleted_arts if hashtags_text
+            for hashtag in hashtags_text.split(",")
+        ])
+        cur.execute('''
+            UPDATE deleted_arts SET restored_at = CURRENT_TIMESTAMP
+            WHERE owner_id = ? AND reason = 'User blocked'
+        ''', (user_id,))
         cur.execute('DELETE FROM user_blocks WHERE user_id = ?', (user_id,))
         
         conn.commit()
+        sync_hashtag_index(cur, restored_hashtags)
         conn.close()
+        reset_feed_cursors()
         return True, "Пользователь разблокирован и все арты восстановлены!"
     except Exception as e:
         logging.error(f"Ошибка при разблокировке пользователя: {e}")
@@ -981,7 +2008,7 @@ def unblock_user(user_id):
 
 def submit_appeal(user_id, reason):
     """Отправляет апелляцию от заблокированного пользователя"""
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     
     try:
@@ -998,9 +2025,102 @@ def submit_appeal(user_id, reason):
         conn.close()
         return False, f"Ошибка: {e}"
 
+def get_latest_appeal(user_id):
+    """Получает последнюю апелляцию пользователя"""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT appeal_id, reason, status, submitted_at 
+        FROM appeals 
+        WHERE user_id = ? 
+        ORDER BY submitted_at DESC 
+        LIMIT 1
+    ''', (user_id,))
+    appeal_info = cur.fetchone()
+    conn.close()
+    return appeal_info
+
+def save_blocked_user_appeal(user_id, reason):
+    """
+    Сохраняет сообщение заблокированного пользователя как апелляцию.
+    Возвращает True если обновлена ожидающая апелляция, False если создана новая.
+    """
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT appeal_id, status FROM appeals 
+        WHERE user_id = ? 
+        ORDER BY submitted_at DESC 
+        LIMIT 1
+    ''', (user_id,))
+    appeal_info = cur.fetchone()
+    
+    if appeal_info and appeal_info[1] == 'pending':
+        cur.execute('''
+            UPDATE appeals 
+            SET reason = ?, submitted_at = CURRENT_TIMESTAMP
+            WHERE user_id = ? AND status = 'pending'
+        ''', (reason, user_id))
+        updated = True
+    else:
+        cur.execute('''
+            INSERT INTO appeals (user_id, reason, submitted_at, status)
+            VALUES (?, ?, CURRENT_TIMESTAMP, 'pending')
+        ''', (user_id, reason))
+        updated = False
+    
+    conn.commit()
+    conn.close()
+    return updated
+
+def update_pending_appeal(user_id, reason):
+    """Обновляет текст ожидающей апелляции. Возвращает False если её нет"""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT appeal_id FROM appeals 
+        WHERE user_id = ? AND status = 'pending'
+        ORDER BY submitted_at DESC 
+        LIMIT 1
+    ''', (user_id,))
+    appeal_info = cur.fetchone()
+    
+    if not appeal_info:
+        conn.close()
+        return False
+    
+    cur.execute('''
+        UPDATE appeals 
+        SET reason = ?, submitted_at = CURRENT_TIMESTAMP
+        WHERE appeal_id = ?
+    ''', (reason, appeal_info[0]))
+    conn.commit()
+    conn.close()
+    return True
+
+def get_appeal_user_id(appeal_id):
+    """Возвращает ID пользователя, подавшего апелляцию"""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('SELECT user_id FROM appeals WHERE appeal_id = ?', (appeal_id,))
+    result = cur.fetchone()
+    conn.close()
+    return result[0] if result else None
+
+def set_appeal_decision(appeal_id, status, moderator_id):
+    """Фиксирует решение модератора по апелляции"""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('''
+        UPDATE appeals SET status = ?, decided_by = ?, decided_at = CURRENT_TIMESTAMP
+        WHERE appeal_id = ?
+    ''', (status, moderator_id, appeal_id))
+    conn.commit()
+    conn.close()
+
 def get_pending_appeals():
     """Получает список ожидающих апеляций"""
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     cur.execute('''
         SELECT appeal_id, user_id, reason, submitted_at FROM appeals WHERE status = 'pending'
@@ -1012,7 +2132,7 @@ def get_pending_appeals():
 
 def get_deleted_arts(limit=10):
     """Получает удалённые арты последних N дней"""
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     cur.execute('''
         SELECT deleted_id, art_id, owner_id, file_id, caption, deleted_at, reason
@@ -1027,7 +2147,7 @@ def get_deleted_arts(limit=10):
 
 def get_deleted_arts_by_user(username: str):
     """Получает удалённые арты конкретного пользователя по нику"""
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     cur.execute('SELECT user_id FROM users WHERE nickname = ?', (username,))
     user_result = cur.fetchone()
@@ -1050,7 +2170,7 @@ def get_deleted_arts_by_user(username: str):
 
 def restore_deleted_art(art_id):
     """Восстанавливает удалённый арт"""
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     
     cur.execute('''
@@ -1070,20 +2190,13 @@ def restore_deleted_art(art_id):
             INSERT OR IGNORE INTO arts (art_id, owner_id, file_id, caption, likes, dislikes)
             VALUES (?, ?, ?, ?, ?, ?)
         ''', (art_id, owner_id, file_id, caption, likes, dislikes))
-        if hashtags_text:
-            for hashtag in hashtags_text.split(","):
-                cur.execute('INSERT INTO hashtags (art_id, hashtag) VALUES (?, ?)',
-                           (art_id, hashtag))
-                cur.execute('INSERT OR IGNORE INTO all_hashtags (hashtag_text) VALUES (?)',
-                           (hashtag.lower(),))
-                cur.execute(
-                    'UPDATE all_hashtags SET usage_count = usage_count + 1 WHERE hashtag_text = ?',
-                    (hashtag.lower(),)
-                )
+        restored_hashtags = add_art_hashtags(cur, [(art_id, hashtag) for hashtag in (hashtags_text or '').split(",")])
         cur.execute('UPDATE deleted_arts SET restored_at = CURRENT_TIMESTAMP WHERE art_id = ?', (art_id,))
         
         conn.commit()
+        sync_hashtag_index(cur, restored_hashtags)
         conn.close()
+        reset_feed_cursors()
         return True, "Арт восстановлен!"
     except Exception as e:
         logging.error(f"Ошибка при восстановлении арта: {e}")
@@ -1091,7 +2204,7 @@ def restore_deleted_art(art_id):
         return False, f"Ошибка: {e}"
     
 def add_complaint(art_id, reporter_id, reason, comment):
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     
     cur.execute(
@@ -1103,133 +2216,231 @@ def add_complaint(art_id, reporter_id, reason, comment):
     conn.close()
     return True
 
-def get_unseen_art(user_id, hashtag_filter=None):
-    conn = sqlite3.connect('database.db')
-    cur = conn.cursor()
-    cur.execute('SELECT following_id FROM profile_followers WHERE follower_id = ?', (user_id,))
-    following_users = [row[0] for row in cur.fetchall()]
-    if hashtag_filter:
-        if following_users:
-            query = '''
-                SELECT a.art_id, a.file_id, a.caption, a.likes, a.dislikes 
-                FROM arts a
-                JOIN hashtags h ON a.art_id = h.art_id
-                WHERE a.art_id NOT IN (
-                    SELECT art_id FROM reactions WHERE user_id = ?
-                ) 
-                AND a.owner_id != ?
-                AND LOWER(h.hashtag) = LOWER(?)
-                ORDER BY a.timestamp DESC
-                LIMIT 1
-            '''
-            params = (user_id, user_id, hashtag_filter)
+# Лента непросмотренных артов упорядочена по рейтингу из таблицы feed_scores:
+# свежесть + доля лайков. Рейтинг хранится готовым и пересчитывается триггерами
+# при загрузке арта и каждой реакции, а от текущего времени не зависит - поэтому
+# для каждой пары (пользователь, фильтр) можно запомнить ключ (score, art_id)
+# последнего выданного арта и продолжать обход индекса с этого места, не пропуская
+# заново все уже оценённые арты. Арты, загруженные после начала обхода, образуют
+# отдельные отрезки по art_id со своими позициями, результаты отрезков сливаются
+# по рейтингу. Арты авторов, на которых подписан пользователь, получают надбавку.
+
+FEED_RECENCY_SCALE = 45000  # секунд свежести, равноценных единице рейтинга (12.5 ч)
+FEED_LIKE_WEIGHT = 2.0      # вес сглаженной доли лайков (likes + 1) / (likes + dislikes + 2)
+FEED_FOLLOW_BOOST = 1.0     # надбавка для артов авторов из подписок
+FEED_MAX_SEGMENTS = 4
+FEED_CURSOR_TTL = 6 * 3600  # секунд; затем обход начинается заново и учитывает изменившийся рейтинг
+FEED_RANDOM_SAMPLE_ATTEMPTS = 3
+# Ключ курсора содержит произвольный текст фильтра, поэтому словарь ограничен: порядок
+# вставки - порядок последней записи, при переполнении вытесняются давно не листавшие
+FEED_MAX_CURSORS = 50000
+_feed_cursors = {}
+_feed_cursors_lock = threading.Lock()
+_feed_cursors_pruned_at = 0.0
+
+def feed_score_sql(row):
+    """SQL-выражение рейтинга для строки arts (NEW в триггерах, имя таблицы в запросах)"""
+    return (
+        f"CAST(strftime('%s', COALESCE({row}.timestamp, CURRENT_TIMESTAMP)) AS REAL) / {FEED_RECENCY_SCALE}"
+        f" + {FEED_LIKE_WEIGHT} * ({row}.likes + 1.0) / ({row}.likes + {row}.dislikes + 2.0)"
+    )
+
+def reset_feed_cursors(user_id=None):
+    """Сбрасывает сохранённые позиции в ленте (например, после восстановления артов со старыми art_id)"""
+    with _feed_cursors_lock:
+        if user_id is None:
+            _feed_cursors.clear()
         else:
-            query = '''
-                SELECT a.art_id, a.file_id, a.caption, a.likes, a.dislikes 
-                FROM arts a
-                JOIN hashtags h ON a.art_id = h.art_id
-                WHERE a.art_id NOT IN (
-                    SELECT art_id FROM reactions WHERE user_id = ?
-                ) 
-                AND a.owner_id != ?
-                AND LOWER(h.hashtag) = LOWER(?)
-                ORDER BY a.timestamp DESC
-                LIMIT 1
-            '''
-            params = (user_id, user_id, hashtag_filter)
+            for key in [key for key in _feed_cursors if key[0] == user_id]:
+                del _feed_cursors[key]
+
+def _find_feed_arts(cur, user_id, hashtag_filter, extra_conditions=(), extra_params=(),
+                    order_by='fs.score DESC, fs.art_id DESC', limit=1, followed_only=False):
+    if followed_only:
+        query = '''
+            SELECT a.art_id, a.file_id, a.caption, a.likes, a.dislikes, fs.score
+            FROM profile_followers pf
+            JOIN feed_scores fs ON fs.owner_id = pf.following_id
+            JOIN arts a ON a.art_id = fs.art_id
+            WHERE pf.follower_id = ?
+        '''
     else:
-        if following_users:
-            query = '''
-                SELECT art_id, file_id, caption, likes, dislikes 
-                FROM arts 
-                WHERE art_id NOT IN (
-                    SELECT art_id FROM reactions WHERE user_id = ?
-                ) 
-                AND owner_id != ?
-                ORDER BY timestamp DESC
-                LIMIT 1
-            '''
-            params = (user_id, user_id)
-        else:
-            query = '''
-                SELECT art_id, file_id, caption, likes, dislikes 
-                FROM arts 
-                WHERE art_id NOT IN (
-                    SELECT art_id FROM reactions WHERE user_id = ?
-                ) 
-                AND owner_id != ?
-                ORDER BY timestamp DESC
-                LIMIT 1
-            '''
-            params = (user_id, user_id)
-    
+        query = '''
+            SELECT a.art_id, a.file_id, a.caption, a.likes, a.dislikes, fs.score
+            FROM feed_scores fs
+            JOIN arts a ON a.art_id = fs.art_id
+            WHERE fs.owner_id != ?
+        '''
+    query += '''
+        AND NOT EXISTS (
+            SELECT 1 FROM reactions r WHERE r.user_id = ? AND r.art_id = fs.art_id
+        )
+    '''
+    params = [user_id, user_id]
+    if hashtag_filter:
+        query += '''
+        AND EXISTS (
+            SELECT 1 FROM art_tags t
+            WHERE t.art_id = fs.art_id AND t.tag_id = (SELECT tag_id FROM all_hashtags WHERE hashtag_text = ?)
+        )
+        '''
+        params.append(hashtag_filter.lower())
+    for condition in extra_conditions:
+        query += f"    AND {condition}\n"
+    query += f"        ORDER BY {order_by}\n        LIMIT ?"
+    params.extend(extra_params)
+    params.append(limit)
     cur.execute(query, params)
-    art = cur.fetchone()
-    if not art:
-        logging.info(f"Все свежие арты просмотрены пользователем {user_id}. Ищем случайный арт.")
-        if hashtag_filter:
-            query = '''
-                SELECT a.art_id, a.file_id, a.caption, a.likes, a.dislikes 
-                FROM arts a
-                JOIN hashtags h ON a.art_id = h.art_id
-                WHERE a.art_id NOT IN (
-                    SELECT art_id FROM reactions WHERE user_id = ?
-                ) 
-                AND a.owner_id != ?
-                AND LOWER(h.hashtag) = LOWER(?)
-                ORDER BY RANDOM()
-                LIMIT 1
-            '''
-            params = (user_id, user_id, hashtag_filter)
-        else:
-            query = '''
-                SELECT art_id, file_id, caption, likes, dislikes 
-                FROM arts 
-                WHERE art_id NOT IN (
-                    SELECT art_id FROM reactions WHERE user_id = ?
-                ) 
-                AND owner_id != ?
-                ORDER BY RANDOM()
-                LIMIT 1
-            '''
-            params = (user_id, user_id)
-        
-        cur.execute(query, params)
-        art = cur.fetchone()
+    return cur.fetchall()
+
+def _find_arts_in_feed_segment(cur, user_id, hashtag_filter, segment, limit):
+    """Непросмотренные арты отрезка с наибольшим рейтингом, не выше позиции отрезка"""
+    if segment['low_id'] is None:
+        # Основной отрезок обходится по индексу рейтинга ("+" не даёт выбрать диапазон rowid)
+        conditions, params = ['+fs.art_id <= ?'], [segment['high_id']]
+    else:
+        # Новые загрузки - узкий диапазон art_id, его дешевле отсортировать целиком
+        conditions, params = ['fs.art_id > ?', 'fs.art_id <= ?'], [segment['low_id'], segment['high_id']]
+    if segment['position']:
+        conditions.append('(fs.score, fs.art_id) <= (?, ?)')
+        params.extend(segment['position'])
+    return _find_feed_arts(cur, user_id, hashtag_filter, conditions, params, limit=limit)
+
+def _sample_feed_art(cur, user_id, hashtag_filter, max_art_id):
+    """Случайный непросмотренный арт: выборка по rowid вместо сортировки всей таблицы"""
+    for _ in range(FEED_RANDOM_SAMPLE_ATTEMPTS):
+        pivot = random.randint(1, max_art_id)
+        arts = _find_feed_arts(cur, user_id, hashtag_filter, ['fs.art_id >= ?'], [pivot],
+                               order_by='fs.art_id')
+        if arts:
+            return arts
+    # Справа от последней точки ничего нет - проверяем остаток таблицы
+    return _find_feed_arts(cur, user_id, hashtag_filter, ['fs.art_id < ?'], [pivot],
+                           order_by='fs.art_id')
+
+def _store_feed_cursor(key, cursor):
+    """Сохраняет курсор, удаляя просроченные (не чаще раза в FEED_CURSOR_TTL) и лишние сверх FEED_MAX_CURSORS"""
+    global _feed_cursors_pruned_at
+    now = time.monotonic()
+    with _feed_cursors_lock:
+        _feed_cursors.pop(key, None)
+        _feed_cursors[key] = cursor
+        if now - _feed_cursors_pruned_at > FEED_CURSOR_TTL:
+            for expired in [k for k, c in _feed_cursors.items() if now - c['started_at'] > FEED_CURSOR_TTL]:
+                del _feed_cursors[expired]
+            _feed_cursors_pruned_at = now
+        while len(_feed_cursors) > FEED_MAX_CURSORS:
+            del _feed_cursors[next(iter(_feed_cursors))]
+
+def _load_feed_cursor(key, max_art_id):
+    now = time.monotonic()
+    with _feed_cursors_lock:
+        cursor = _feed_cursors.get(key)
+        if cursor is None or now - cursor['started_at'] > FEED_CURSOR_TTL:
+            return {'started_at': now, 'high_id': max_art_id, 'exhausted': False,
+                    'segments': [{'low_id': None, 'high_id': max_art_id, 'position': None}]}
+        cursor = dict(cursor)
+        cursor['segments'] = [dict(segment) for segment in cursor['segments']]
+    
+    if max_art_id > cursor['high_id']:
+        cursor['segments'].append({'low_id': cursor['high_id'], 'high_id': max_art_id, 'position': None})
+        cursor['high_id'] = max_art_id
+        cursor['exhausted'] = False
+        if len(cursor['segments']) > FEED_MAX_SEGMENTS:
+            # Сливаем два самых новых отрезка: позиция - наибольшая из двух, чтобы ничего не пропустить
+            newer = cursor['segments'].pop()
+            older = cursor['segments'][-1]
+            positions = [older['position'], newer['position']]
+            older['high_id'] = newer['high_id']
+            older['position'] = None if None in positions else max(positions)
+    return cursor
+
+def get_unseen_arts(user_id, hashtag_filter=None, limit=1, exclude_ids=()):
+    """Следующие непросмотренные арты ленты, не считая уже выданных (exclude_ids)"""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    key = (user_id, hashtag_filter.lower() if hashtag_filter else None)
+    exclude_ids = set(exclude_ids)
     
-    conn.close()
-    return art
+    try:
+        cur.execute('SELECT MAX(art_id) FROM feed_scores')
+        max_art_id = cur.fetchone()[0]
+        if not max_art_id:
+            return []
+        cursor = _load_feed_cursor(key, max_art_id)
+        
+        wanted = limit + len(exclude_ids)
+        ranked = {}
+        for segment in list(cursor['segments']):
+            found = _find_arts_in_feed_segment(cur, user_id, hashtag_filter, segment, wanted)
+            if found:
+                # Позиция включительно: первый арт ещё не оценён и может быть показан снова
+                segment['position'] = (found[0][5], found[0][0])
+                for art in found:
+                    ranked[art[0]] = (art[5], art)
+            elif segment['low_id'] is not None:
+                cursor['segments'].remove(segment)
+        
+        # В каждом отрезке всё, что не попало в выборку, имеет рейтинг не выше выбранного,
+        # поэтому первые limit артов объединения - лучшие во всей ленте
+        for art in _find_feed_arts(cur, user_id, hashtag_filter, limit=wanted, followed_only=True):
+            ranked[art[0]] = (art[5] + FEED_FOLLOW_BOOST, art)
+        arts = [art for _, art in sorted(ranked.values(), key=lambda item: (item[0], item[1][0]), reverse=True)]
+        
+        if not arts and not cursor['exhausted']:
+            logging.info(f"Все свежие арты просмотрены пользователем {user_id}. Ищем случайный арт.")
+            arts = _sample_feed_art(cur, user_id, hashtag_filter, max_art_id)
+            cursor['exhausted'] = not arts
+        
+        _store_feed_cursor(key, cursor)
+        return [art[:5] for art in arts if art[0] not in exclude_ids][:limit]
+    finally:
+        conn.close()
+
+def get_unseen_art(user_id, hashtag_filter=None):
+    arts = get_unseen_arts(user_id, hashtag_filter)
+    return arts[0] if arts else None
 
 def has_new_arts_for_user(user_id):
     """Проверяет, есть ли арты, которые пользователь еще не оценил"""
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     
     query = '''
-        SELECT COUNT(*) 
-        FROM arts 
-        WHERE art_id NOT IN (
-            SELECT art_id FROM reactions WHERE user_id = ?
-        ) 
-        AND owner_id != ?
+        SELECT EXISTS (
+            SELECT 1 FROM arts a
+            WHERE a.owner_id != ?
+            AND NOT EXISTS (
+                SELECT 1 FROM reactions r WHERE r.user_id = ? AND r.art_id = a.art_id
+            )
+        )
     '''
     
     cur.execute(query, (user_id, user_id))
-    count = cur.fetchone()[0]
+    has_new = cur.fetchone()[0]
     conn.close()
     
-    return count > 0
+    return bool(has_new)
 
 def get_art_owner(art_id):
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     cur.execute('SELECT owner_id FROM arts WHERE art_id = ?', (art_id,))
     result = cur.fetchone()
     conn.close()
     return result[0] if result else None
 
+def get_user_reaction(user_id, art_id):
+    """Возвращает тип реакции пользователя на арт ('like'/'dislike') или None"""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('SELECT type FROM reactions WHERE user_id = ? AND art_id = ?', (user_id, art_id))
+    result = cur.fetchone()
+    conn.close()
+    return result[0] if result else None
+
 def add_reaction(user_id, art_id, reaction_type):
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     
     cur.execute(
@@ -1247,7 +2458,7 @@ def add_reaction(user_id, art_id, reaction_type):
 
 def add_comment(user_id, art_id, text):
     try:
-        conn = sqlite3.connect('database.db')
+        conn = get_db_connection()
         cur = conn.cursor()
         
         cur.execute('SELECT user_id FROM users WHERE user_id = ?', (user_id,))
@@ -1277,7 +2488,7 @@ def add_comment(user_id, art_id, text):
         return False, f"Ошибка базы данных: {e}"
 
 def get_art_by_id(art_id):
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     cur.execute('''
         SELECT art_id, file_id, caption, likes, dislikes 
@@ -1289,7 +2500,7 @@ def get_art_by_id(art_id):
     return art
 
 def get_user_arts(user_id):
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     
     cur.execute('''
@@ -1315,20 +2526,29 @@ def get_user_arts(user_id):
     
     return stats, arts
 
+def get_user_likes_totals(user_id):
+    """Возвращает суммарное количество лайков и дизлайков на артах пользователя"""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('SELECT SUM(likes), SUM(dislikes) FROM arts WHERE owner_id = ?', (user_id,))
+    result = cur.fetchone()
+    conn.close()
+    return result[0] or 0, result[1] or 0
+
 def get_top_arts(limit=5, hashtag_filter=None):
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     
     if hashtag_filter:
         query = '''
             SELECT a.art_id, a.file_id, a.caption, a.likes, a.dislikes, a.owner_id
-            FROM arts a
-            JOIN hashtags h ON a.art_id = h.art_id
-            WHERE LOWER(h.hashtag) = LOWER(?)
-            ORDER BY a.likes DESC, a.timestamp DESC
+            FROM hashtag_top t
+            JOIN arts a ON a.art_id = t.art_id
+            WHERE t.tag_id = (SELECT tag_id FROM all_hashtags WHERE hashtag_text = ?)
+            ORDER BY t.likes DESC, t.timestamp DESC
             LIMIT ?
         '''
-        params = (hashtag_filter, limit)
+        params = (hashtag_filter.lower(), limit)
     else:
         query = '''
             SELECT art_id, file_id, caption, likes, dislikes, owner_id
@@ -1349,19 +2569,16 @@ def get_top_arts_by_likes(limit=5, hashtag_filter=None):
 
 def get_top_artists_by_followers(limit=5):
     """Получает топ художников по количеству подписчиков"""
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     
     query = '''
-        SELECT u.user_id, u.username, u.nickname, COUNT(pf.follower_id) as followers_count,
-               (SELECT COUNT(*) FROM arts WHERE owner_id = u.user_id) as art_count,
-               (SELECT SUM(likes) FROM arts WHERE owner_id = u.user_id) as total_likes,
+        SELECT u.user_id, u.username, u.nickname, s.followers, s.art_count, s.total_likes,
                u.bio, u.profile_avatar_file_id
-        FROM users u
-        LEFT JOIN profile_followers pf ON u.user_id = pf.following_id
-        WHERE u.user_id IN (SELECT owner_id FROM arts)
-        GROUP BY u.user_id
-        ORDER BY followers_count DESC, total_likes DESC
+        FROM artist_stats s
+        JOIN users u ON u.user_id = s.owner_id
+        WHERE s.art_count > 0
+        ORDER BY s.followers DESC, s.total_likes DESC
         LIMIT ?
     '''
     
@@ -1371,52 +2588,35 @@ def get_top_artists_by_followers(limit=5):
     return artists
 
 def get_user_rank(user_id, hashtag_filter=None):
-    conn = sqlite3.connect('database.db')
+    """Лучшее место автора в топе артов (плотный ранг по лайкам) или None"""
+    conn = get_db_connection()
     cur = conn.cursor()
     
+    scope = 0
     if hashtag_filter:
-        query = '''
-            SELECT a.owner_id, a.likes, a.art_id
+        scope = get_tag_id(cur, hashtag_filter)
+        # CROSS JOIN фиксирует порядок: сначала несколько артов автора, а не весь хэштег
+        cur.execute('''
+            SELECT MAX(t.likes)
             FROM arts a
-            JOIN hashtags h ON a.art_id = h.art_id
-            WHERE LOWER(h.hashtag) = LOWER(?)
-            ORDER BY a.likes DESC, a.timestamp DESC
-        '''
-        cur.execute(query, (hashtag_filter,))
+            CROSS JOIN hashtag_top t ON t.tag_id = ? AND t.art_id = a.art_id
+            WHERE a.owner_id = ?
+        ''', (scope, user_id))
     else:
-        query = '''
-            SELECT owner_id, likes, art_id
-            FROM arts 
-            ORDER BY likes DESC, timestamp DESC
-        '''
-        cur.execute(query)
-    
-    all_arts = cur.fetchall()
-    conn.close()
+        cur.execute('SELECT MAX(likes) FROM arts WHERE owner_id = ?', (user_id,))
+    user_max_likes = cur.fetchone()[0]
     
-    user_max_likes = 0
-    for art in all_arts:
-        if art[0] == user_id and art[1] > user_max_likes:
-            user_max_likes = art[1]
-    
-    if user_max_likes == 0:
+    if not user_max_likes:
+        conn.close()
         return None
     
-    current_rank = 0
-    last_likes = -1
-    rank_counter = 0
-    
-    for art in all_arts:
-        if art[1] != last_likes:
-            rank_counter += 1
-            last_likes = art[1]
-        
-        current_rank = rank_counter
-        
-        if art[0] == user_id and art[1] == user_max_likes:
-            return current_rank
-    
-    return None
+    cur.execute(
+        'SELECT COUNT(*) FROM like_levels WHERE scope = ? AND likes >= ?',
+        (scope, user_max_likes)
+    )
+    rank = cur.fetchone()[0]
+    conn.close()
+    return rank
 
 def extract_hashtags(text):
     hashtags = re.findall(r'#\w+', text)
@@ -1425,71 +2625,35 @@ def extract_hashtags(text):
 
 def get_unviewed_reactions_count(owner_id):
     """Возвращает количество непросмотренных реакций"""
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     
-    cur.execute('''
-        SELECT COUNT(*) FROM reactions r
-        JOIN arts a ON r.art_id = a.art_id
-        WHERE a.owner_id = ? AND r.type = 'like'
-        AND NOT EXISTS (
-            SELECT 1 FROM viewed_reactions vr 
-            WHERE vr.user_id = ? AND vr.reaction_type = 'like' AND vr.reaction_id = r.reaction_id
-        )
-    ''', (owner_id, owner_id))
-    unviewed_likes = cur.fetchone()[0]
-    
-    cur.execute('''
-        SELECT COUNT(*) FROM comments c
-        JOIN arts a ON c.art_id = a.art_id
-        WHERE a.owner_id = ?
-        AND NOT EXISTS (
-            SELECT 1 FROM viewed_reactions vr 
-            WHERE vr.user_id = ? AND vr.reaction_type = 'comment' AND vr.reaction_id = c.comment_id
-        )
-    ''', (owner_id, owner_id))
-    unviewed_comments = cur.fetchone()[0]
+    cur.execute('SELECT unread FROM reaction_unread_counts WHERE owner_id = ?', (owner_id,))
+    result = cur.fetchone()
     
     conn.close()
-    return unviewed_likes + unviewed_comments
+    return result[0] if result else 0
 
 def get_unviewed_reactions(owner_id):
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     
     cur.execute('''
-        SELECT r.art_id, r.user_id, r.type, a.file_id, a.caption, r.reaction_id, NULL, r.timestamp
-        FROM reactions r
-        JOIN arts a ON r.art_id = a.art_id
-        WHERE a.owner_id = ? AND r.type = 'like'
-        AND NOT EXISTS (
-            SELECT 1 FROM viewed_reactions vr 
-            WHERE vr.user_id = ? AND vr.reaction_type = 'like' AND vr.reaction_id = r.reaction_id
-        )
-        ORDER BY r.timestamp DESC
-        LIMIT 50
-    ''', (owner_id, owner_id))
-    unviewed_likes = cur.fetchall()
-    
-    cur.execute('''
-        SELECT c.art_id, c.user_id, 'comment', a.file_id, a.caption, c.comment_id, c.text, c.timestamp
-        FROM comments c
-        JOIN arts a ON c.art_id = a.art_id
-        WHERE a.owner_id = ?
-        AND NOT EXISTS (
-            SELECT 1 FROM viewed_reactions vr 
-            WHERE vr.user_id = ? AND vr.reaction_type = 'comment' AND vr.reaction_id = c.comment_id
-        )
-        ORDER BY c.timestamp DESC
-        LIMIT 50
-    ''', (owner_id, owner_id))
-    unviewed_comments = cur.fetchall()
+        SELECT i.art_id, i.user_id, i.reaction_type, a.file_id, a.caption, i.reaction_id, c.text, i.timestamp
+        FROM reaction_inbox i
+        JOIN arts a ON i.art_id = a.art_id
+        LEFT JOIN comments c ON i.reaction_type = 'comment' AND c.comment_id = i.reaction_id
+        WHERE i.owner_id = ?
+        ORDER BY i.timestamp DESC
+        LIMIT 100
+    ''', (owner_id,))
+    unviewed = cur.fetchall()
     
     conn.close()
     
     all_reactions = []
     
-    for reaction in unviewed_likes + unviewed_comments:
+    for reaction in unviewed:
         all_reactions.append({
             'type': reaction[2],
             'art_id': reaction[0],
@@ -1501,71 +2665,323 @@ def get_unviewed_reactions(owner_id):
             'timestamp': reaction[7]
         })
     
-    all_reactions.sort(key=lambda x: x['timestamp'], reverse=True)
-    
     return all_reactions
 
 def mark_reaction_as_viewed(user_id, reaction_type, reaction_id, art_id):
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     
     cur.execute(
         'INSERT OR IGNORE INTO viewed_reactions (user_id, reaction_type, reaction_id, art_id) VALUES (?, ?, ?, ?)',
         (user_id, reaction_type, reaction_id, art_id)
     )
+    cur.execute(
+        'DELETE FROM reaction_inbox WHERE reaction_type = ? AND reaction_id = ? AND owner_id = ?',
+        (reaction_type, reaction_id, user_id)
+    )
     
     conn.commit()
     conn.close()
 
 def mark_all_reactions_as_viewed(owner_id):
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     
     cur.execute('''
         INSERT OR IGNORE INTO viewed_reactions (user_id, reaction_type, reaction_id, art_id)
-        SELECT ?, 'like', r.reaction_id, r.art_id
-        FROM reactions r
-        JOIN arts a ON r.art_id = a.art_id
-        WHERE a.owner_id = ?
-        AND NOT EXISTS (
-            SELECT 1 FROM viewed_reactions vr 
-            WHERE vr.user_id = ? AND vr.reaction_type = 'like' AND vr.reaction_id = r.reaction_id
-        )
-    ''', (owner_id, owner_id, owner_id))
+        SELECT owner_id, reaction_type, reaction_id, art_id
+        FROM reaction_inbox
+        WHERE owner_id = ?
+    ''', (owner_id,))
+    cur.execute('DELETE FROM reaction_inbox WHERE owner_id = ?', (owner_id,))
     
-    cur.execute('''
-        INSERT OR IGNORE INTO viewed_reactions (user_id, reaction_type, reaction_id, art_id)
-        SELECT ?, 'comment', c.comment_id, c.art_id
-        FROM comments c
-        JOIN arts a ON c.art_id = a.art_id
-        WHERE a.owner_id = ?
-        AND NOT EXISTS (
-            SELECT 1 FROM viewed_reactions vr 
-            WHERE vr.user_id = ? AND vr.reaction_type = 'comment' AND vr.reaction_id = c.comment_id
+    conn.commit()
+    conn.close()
+
+# ========== ПОИСК ПО ХЭШТЕГАМ И ПРОФИЛЯМ ==========
+# Запрос от трёх символов ищется как подстрока по индексам FTS5 (trigram), более
+# короткий - по началу строки через обычный индекс. Ранжируются по популярности
+# не больше SEARCH_MATCH_LIMIT совпадений, поэтому время не растёт с размером таблиц.
+# Если точных совпадений меньше лимита, добираем строки, начало которых отличается
+# от запроса одной опечаткой (замена, пропуск, лишняя буква или перестановка соседних).
+# Первые SEARCH_TYPO_PREFIX символа должны совпасть: тогда каждый вариант опечатки -
+# это шаблон LIKE/GLOB с известным началом, и он читается диапазоном индекса
+
+SEARCH_MATCH_LIMIT = 1000
+SEARCH_FUZZY_CANDIDATES = 200
+SEARCH_TYPO_PREFIX = 2
+search_index_available = False
+
+def refresh_search_index_status(conn):
+    """Проверяет, создала ли миграция индексы FTS5 (их нет, если SQLite собран без trigram)"""
+    global search_index_available
+    cur = conn.cursor()
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'hashtags_fts'")
+    search_index_available = cur.fetchone() is not None
+
+def rebuild_search_index():
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("INSERT INTO hashtags_fts (hashtags_fts) VALUES ('rebuild')")
+    cur.execute("INSERT INTO users_fts (users_fts) VALUES ('rebuild')")
+    conn.commit()
+    conn.close()
+
+def _fts_phrase(text):
+    return '"' + text.replace('"', '""') + '"'
+
+def _like_escape(text):
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def _glob_escape(text):
+    return ''.join(f'[{char}]' if char in '[*?' else char for char in text)
+
+def _typo_patterns(term, escape, any_char):
+    """Варианты начала строки с одной опечаткой после SEARCH_TYPO_PREFIX символов"""
+    patterns = set()
+    for position in range(SEARCH_TYPO_PREFIX, len(term) + 1):
+        head, tail = escape(term[:position]), term[position:]
+        patterns.add(head + any_char + escape(tail))  # лишняя буква
+        if tail:
+            patterns.add(head + any_char + escape(tail[1:]))  # замена
+            patterns.add(head + escape(tail[1:]))  # пропущенная буква
+        if len(tail) > 1:
+            patterns.add(head + escape(tail[1] + tail[0] + tail[2:]))  # перестановка
+    return sorted(patterns)
+
+def _edit_distance(a, b):
+    """Расстояние Дамерау-Левенштейна (вариант без повторных правок одной подстроки)"""
+    previous, current = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        before, previous, current = previous, current, [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], before[j - 2] + 1)
+    return current[len(b)]
+
+def _search_with_typos(term, limit, by_match, by_prefix, by_typo, texts, popularity):
+    """Общая схема поиска: подстрока или начало строки, затем добор вариантов с опечаткой"""
+    if len(term) < 3:
+        return by_prefix(term, limit)
+    
+    results = by_match(_fts_phrase(term), limit)
+    if len(results) < limit:
+        candidates = set(by_typo(term)) - set(results)
+        
+        def closeness(row):
+            distance = min(
+                _edit_distance(term.lower(), text.lower()[:length])
+                for text in texts(row) if text
+                for length in range(len(term) - 1, len(term) + 2)
+            )
+            return distance, -popularity(row)
+        
+        results += sorted(candidates, key=closeness)[:limit - len(results)]
+    return results
+
+def search_hashtags(query, limit=10):
+    term = query.strip().lower().lstrip('#')
+    if not term:
+        return []
+    
+    conn = get_db_connection()
+    cur = conn.cursor()
+    
+    if not search_index_available:
+        cur.execute(
+            'SELECT hashtag_text, usage_count FROM all_hashtags WHERE hashtag_text LIKE ? ORDER BY usage_count DESC LIMIT ?',
+            (f'%{term}%', limit)
         )
-    ''', (owner_id, owner_id, owner_id))
+        hashtags = cur.fetchall()
+        conn.close()
+        return hashtags
     
-    conn.commit()
+    def by_match(fts_query, count):
+        cur.execute('''
+            SELECT a.hashtag_text, a.usage_count
+            FROM (SELECT rowid FROM hashtags_fts WHERE hashtags_fts MATCH ? LIMIT ?) f
+            JOIN all_hashtags a ON a.rowid = f.rowid
+            ORDER BY a.usage_count DESC
+            LIMIT ?
+        ''', (fts_query, SEARCH_MATCH_LIMIT, count))
+        return cur.fetchall()
+    
+    # Хэштеги хранятся в нижнем регистре с '#': GLOB по началу читает диапазон первичного ключа
+    def by_patterns(patterns, scan_limit, count):
+        condition = ' OR '.join(['hashtag_text GLOB ?'] * len(patterns))
+        cur.execute(f'''
+            SELECT hashtag_text, usage_count FROM (
+                SELECT hashtag_text, usage_count FROM all_hashtags WHERE {condition} LIMIT ?
+            )
+            ORDER BY usage_count DESC
+            LIMIT ?
+        ''', (*('#' + pattern + '*' for pattern in patterns), scan_limit, count))
+        return cur.fetchall()
+    
+    hashtags = _search_with_typos(
+        term, limit, by_match,
+        by_prefix=lambda prefix, count: by_patterns([_glob_escape(prefix)], SEARCH_MATCH_LIMIT, count),
+        by_typo=lambda term: by_patterns(
+            _typo_patterns(term, _glob_escape, '?'), SEARCH_FUZZY_CANDIDATES, SEARCH_FUZZY_CANDIDATES
+        ),
+        texts=lambda row: (row[0].lstrip('#'),),
+        popularity=lambda row: row[1]
+    )
+    conn.close()
+    return hashtags
+
+# ========== ИНДЕКС ХЭШТЕГОВ В ПАМЯТИ ==========
+# Копия all_hashtags в процессе бота: отсортированный список хэштегов (поддиапазон по
+# префиксу находится бинарным поиском) и закэшированные top-k по usage_count для
+# коротких префиксов. Загружается при старте, после каждой транзакции, меняющей
+# all_hashtags, в индекс переносятся значения затронутых строк - так он повторяет БД,
+# включая удаление хэштегов с нулевым счётчиком. Подсказки и популярные хэштеги
+# отдаются из памяти, в БД уходит только поиск по подстроке и с опечатками
+
+HASHTAG_INDEX_TOP_K = 20
+# Кэшируются только префиксы существующих хэштегов не длиннее этого ('#' и три буквы):
+# их число ограничено словарём, а не вводом пользователей. Для длинных префиксов
+# поддиапазон маленький, и top-k считается на месте без сохранения
+HASHTAG_INDEX_CACHED_PREFIX_LEN = 4
+
+class HashtagPrefixIndex:
+    """Хэштеги с числом использований: поиск по началу и top-k для каждого префикса"""
+    
+    def __init__(self, top_k=HASHTAG_INDEX_TOP_K):
+        self.top_k = top_k
+        self.loaded = False
+        self._lock = threading.Lock()
+        self._counts = {}
+        self._sorted = []
+        self._top = {}
+    
+    def load(self, rows):
+        with self._lock:
+            self._counts = {hashtag_text: usage_count for hashtag_text, usage_count in rows if usage_count > 0}
+            self._sorted = sorted(self._counts)
+            self._top = {}
+            self.loaded = True
+    
+    def __len__(self):
+        return len(self._counts)
+    
+    def _compute_top(self, prefix, limit):
+        start = bisect.bisect_left(self._sorted, prefix)
+        end = bisect.bisect_left(self._sorted, prefix + '\U0010ffff') if prefix else len(self._sorted)
+        # nlargest устойчив: при равном счётчике хэштеги идут по алфавиту
+        return heapq.nlargest(limit, self._sorted[start:end], key=self._counts.__getitem__)
+    
+    def top(self, prefix='', limit=10):
+        """Самые используемые хэштеги, начинающиеся с prefix"""
+        with self._lock:
+            if limit > self.top_k or len(prefix) > HASHTAG_INDEX_CACHED_PREFIX_LEN:
+                tags = self._compute_top(prefix, limit)
+            else:
+                tags = self._top.get(prefix)
+                if tags is None:
+                    tags = self._compute_top(prefix, self.top_k)
+                    # Пустой результат не кэшируется: иначе ключами стали бы любые строки из ввода
+                    if tags:
+                        self._top[prefix] = tags
+            return [(tag, self._counts[tag]) for tag in tags[:limit]]
+    
+    def update(self, counts):
+        """Переносит новые usage_count (None - строки больше нет в all_hashtags)"""
+        with self._lock:
+            for tag, count in counts.items():
+                old = self._counts.get(tag)
+                if not count or count <= 0:
+                    if old is None:
+                        continue
+                    del self._counts[tag]
+                    del self._sorted[bisect.bisect_left(self._sorted, tag)]
+                elif old is None:
+                    bisect.insort(self._sorted, tag)
+                    self._counts[tag] = count
+                else:
+                    self._counts[tag] = count
+                
+                for length in range(min(len(tag), HASHTAG_INDEX_CACHED_PREFIX_LEN) + 1):
+                    prefix = tag[:length]
+                    tags = self._top.get(prefix)
+                    if tags is None:
+                        continue
+                    if tag in tags:
+                        if old is not None and (not count or count < old):
+                            # Освободившееся место может занять хэштег, которого нет в кэше
+                            del self._top[prefix]
+                        else:
+                            tags.sort(key=self._counts.__getitem__, reverse=True)
+                    elif count and (len(tags) < self.top_k or count > self._counts[tags[-1]]):
+                        tags.append(tag)
+                        tags.sort(key=self._counts.__getitem__, reverse=True)
+                        del tags[self.top_k:]
+
+hashtag_index = HashtagPrefixIndex()
+
+def load_hashtag_index():
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('SELECT hashtag_text, usage_count FROM all_hashtags')
+    hashtag_index.load(cur.fetchall())
     conn.close()
+    logging.info(f"Индекс хэштегов загружен: {len(hashtag_index)} хэштегов")
+
+def sync_hashtag_index(cur, hashtags):
+    """Вызывается после commit: переносит в индекс строки all_hashtags для затронутых хэштегов"""
+    if not hashtag_index.loaded:
+        return
+    tags = list({hashtag.lower() for hashtag in hashtags})
+    if not tags:
+        return
+    counts = dict.fromkeys(tags)
+    for start in range(0, len(tags), 500):
+        chunk = tags[start:start + 500]
+        cur.execute(
+            f'SELECT hashtag_text, usage_count FROM all_hashtags WHERE hashtag_text IN ({",".join("?" * len(chunk))})',
+            chunk
+        )
+        counts.update(cur.fetchall())
+    hashtag_index.update(counts)
+
+async def find_hashtags(query, limit=10):
+    """Подсказки по началу хэштега из памяти.
+    
+    В БД (search_hashtags - поиск по подстроке и с опечатками) запрос уходит только
+    если ни один хэштег не начинается с введённого текста или индекс ещё не загружен.
+    Если по началу что-то нашлось, совпадения в середине слова не добавляются -
+    иначе почти каждый ввод с редким префиксом читал бы БД
+    """
+    term = query.strip().lower().lstrip('#')
+    if not term:
+        return []
+    
+    if hashtag_index.loaded:
+        hashtags = hashtag_index.top('#' + term, limit)
+        if hashtags:
+            return hashtags
+    return await db_read(search_hashtags, query, limit)
 
 # ========== СИСТЕМА УВЕДОМЛЕНИЙ О РЕАКЦИЯХ ==========
 
 async def update_reaction_notification(context: ContextTypes.DEFAULT_TYPE, owner_id: int):
     """Обновляет или создает уведомление о реакциях"""
     try:
-        unviewed_count = get_unviewed_reactions_count(owner_id)
+        unviewed_count = await db_read(get_unviewed_reactions_count, owner_id)
         
         if unviewed_count == 0:
-            existing_notification = get_notification_message(owner_id)
+            existing_notification = await db_read(get_notification_message, owner_id)
             if existing_notification:
                 message_id, chat_id, _ = existing_notification
                 try:
                     await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
                 except:
                     pass
-                delete_notification_message(owner_id)
+                await db_write(delete_notification_message, owner_id)
             return
-        existing_notification = get_notification_message(owner_id)
+        existing_notification = await db_read(get_notification_message, owner_id)
         
         message_text = f"🎉 Твой арт понравился {unviewed_count} человеку!" if unviewed_count == 1 else f"🎉 Твой арт понравился {unviewed_count} людям!"
         
@@ -1585,7 +3001,7 @@ async def update_reaction_notification(context: ContextTypes.DEFAULT_TYPE, owner
                         text=message_text,
                         reply_markup=reply_markup
                     )
-                    save_notification_message(owner_id, message_id, chat_id, unviewed_count)
+                    await db_write(save_notification_message, owner_id, message_id, chat_id, unviewed_count)
                 except Exception as e:
                     logging.error(f"Ошибка при обновлении уведомления: {e}")
                     await create_new_notification(context, owner_id, message_text, reply_markup)
@@ -1597,7 +3013,7 @@ async def update_reaction_notification(context: ContextTypes.DEFAULT_TYPE, owner
 
 async def notify_art_owner(art_id, reaction_type, comment_text, from_user, context):
     try:
-        owner_id = get_art_owner(art_id)
+        owner_id = await db_read(get_art_owner, art_id)
         if not owner_id:
             return
         await create_or_update_reaction_notification(context, owner_id)
@@ -1605,39 +3021,130 @@ async def notify_art_owner(art_id, reaction_type, comment_text, from_user, conte
     except Exception as e:
         logging.error(f"Ошибка в notify_art_owner: {e}")
 
+# Напоминание обходит авторов пачками по возрастанию owner_id. После каждой пачки
+# граница сохраняется в reminder_runs, и после перезапуска бота проход продолжается с неё
+
+REMINDER_BATCH_SIZE = 200
+REMINDER_CONCURRENCY = 8  # Одновременных отправок уведомлений внутри пачки
+_reminder_lock = asyncio.Lock()
+reminder_stats = {'runs': 0, 'resumed': 0, 'last_duration': 0.0, 'last_owners': 0, 'failed': 0}
+
+def start_reminder_run():
+    """Продолжает незавершённый проход напоминаний или начинает новый"""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT run_id, last_owner_id, owners_done, owners_total FROM reminder_runs
+        WHERE finished_at IS NULL ORDER BY run_id DESC LIMIT 1
+    ''')
+    run = cur.fetchone()
+    if run:
+        conn.close()
+        return run, True
+    
+    cur.execute('SELECT COUNT(*) FROM reaction_unread_counts WHERE unread > 0')
+    owners_total = cur.fetchone()[0]
+    cur.execute(
+        'INSERT INTO reminder_runs (owners_total, started_at) VALUES (?, ?)',
+        (owners_total, time.time())
+    )
+    run = (cur.lastrowid, 0, 0, owners_total)
+    conn.commit()
+    conn.close()
+    return run, False
+
+def get_reminder_batch(after_owner_id, limit):
+    """Следующая пачка авторов с непросмотренными реакциями вместе с их уведомлениями"""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT c.owner_id, c.unread, n.message_id, n.chat_id, n.last_count
+        FROM reaction_unread_counts c
+        LEFT JOIN notification_messages n ON n.user_id = c.owner_id
+        WHERE c.owner_id > ? AND c.unread > 0
+        ORDER BY c.owner_id
+        LIMIT ?
+    ''', (after_owner_id, limit))
+    batch = cur.fetchall()
+    conn.close()
+    return batch
+
+def advance_reminder_run(run_id, last_owner_id, owners_done, failed):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('''
+        UPDATE reminder_runs SET last_owner_id = ?, owners_done = owners_done + ?, failed = failed + ?
+        WHERE run_id = ?
+    ''', (last_owner_id, owners_done, failed, run_id))
+    conn.commit()
+    conn.close()
+
+def finish_reminder_run(run_id):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('UPDATE reminder_runs SET finished_at = ? WHERE run_id = ?', (time.time(), run_id))
+    # Историю держим короткой: для метрик хватает последних проходов
+    cur.execute('DELETE FROM reminder_runs WHERE run_id <= ? - 50', (run_id,))
+    conn.commit()
+    conn.close()
+
+def get_reminder_progress():
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT owners_done, owners_total, failed, started_at, finished_at FROM reminder_runs
+        ORDER BY run_id DESC LIMIT 1
+    ''')
+    result = cur.fetchone()
+    conn.close()
+    return result
+
+@in_background_lane
 async def send_notification_reminder(context: ContextTypes.DEFAULT_TYPE):
     """Отправляет напоминание о непросмотренных реакциях раз в 12 часов"""
-    try:
-        conn = sqlite3.connect('database.db')
-        cur = conn.cursor()
-        
-        cur.execute('''
-            SELECT DISTINCT a.owner_id 
-            FROM arts a
-            JOIN reactions r ON a.art_id = r.art_id
-            WHERE NOT EXISTS (
-                SELECT 1 FROM viewed_reactions vr 
-                WHERE vr.user_id = a.owner_id AND vr.reaction_type = 'like' AND vr.reaction_id = r.reaction_id
-            )
-            UNION
-            SELECT DISTINCT a.owner_id 
-            FROM arts a
-            JOIN comments c ON a.art_id = c.art_id
-            WHERE NOT EXISTS (
-                SELECT 1 FROM viewed_reactions vr 
-                WHERE vr.user_id = a.owner_id AND vr.reaction_type = 'comment' AND vr.reaction_id = c.comment_id
-            )
-        ''')
-        
-        users_with_reactions = cur.fetchall()
-        conn.close()
-        
-        for user_row in users_with_reactions:
-            user_id = user_row[0]
-            await create_or_update_reaction_notification(context, user_id)
+    if _reminder_lock.locked():
+        logging.info("Предыдущий проход напоминаний ещё не завершён, пропускаем")
+        return
+    
+    async with _reminder_lock:
+        started_at = time.perf_counter()
+        try:
+            (run_id, last_owner_id, owners_done, owners_total), resumed = await db_write(start_reminder_run)
+            if resumed:
+                reminder_stats['resumed'] += 1
+                logging.info(f"Продолжаем проход напоминаний {run_id} с автора {last_owner_id} ({owners_done}/{owners_total})")
             
-    except Exception as e:
-        logging.error(f"Ошибка в send_notification_reminder: {e}")
+            semaphore = asyncio.Semaphore(REMINDER_CONCURRENCY)
+            
+            async def remind(owner_id, unread, message_id, chat_id, last_count):
+                active_notifications = [(message_id, chat_id, last_count)] if message_id else []
+                async with semaphore:
+                    try:
+                        await deliver_reaction_notification(context, owner_id, unread, active_notifications)
+                        return True
+                    except Exception as e:
+                        logging.error(f"Ошибка напоминания автору {owner_id}: {e}")
+                        return False
+            
+            processed = 0
+            while True:
+                batch = await db_read(get_reminder_batch, last_owner_id, REMINDER_BATCH_SIZE)
+                if not batch:
+                    break
+                results = await asyncio.gather(*(remind(*row) for row in batch))
+                failed = results.count(False)
+                last_owner_id = batch[-1][0]
+                await db_write(advance_reminder_run, run_id, last_owner_id, len(batch), failed)
+                processed += len(batch)
+                reminder_stats['failed'] += failed
+            
+            await db_write(finish_reminder_run, run_id)
+            reminder_stats['runs'] += 1
+            reminder_stats['last_owners'] = processed
+            reminder_stats['last_duration'] = time.perf_counter() - started_at
+            logging.info(f"Проход напоминаний {run_id} завершён: {processed} авторов за {reminder_stats['last_duration']:.1f}с")
+        except Exception as e:
+            logging.error(f"Ошибка в send_notification_reminder: {e}")
 
 # ========== СИСТЕМА ПОШАГОВОГО ПРОСМОТРА РЕАКЦИЙ С ОБНОВЛЕНИЕМ В РЕАЛЬНОМ ВРЕМЕНИ ==========
 
@@ -1655,7 +3162,7 @@ async def show_reactions_handler(update: Update, context: ContextTypes.DEFAULT_T
         await query.message.delete()
     except Exception:
         pass
-    reactions = get_unviewed_reactions(user_id)
+    reactions = await db_read(get_unviewed_reactions, user_id)
     
     if not reactions:
         await context.bot.send_message(
@@ -1683,7 +3190,7 @@ async def show_single_reaction(update: Update, context: ContextTypes.DEFAULT_TYP
     current_index = context.user_data.get('current_reaction_index', 0)
     
     if current_index >= len(reactions):
-        mark_all_reactions_as_viewed(user_id)
+        await db_write(mark_all_reactions_as_viewed, user_id)
         await context.bot.send_message(
             chat_id=user_id,
             text="🎉 Вы просмотрели все новые реакции!"
@@ -1696,10 +3203,10 @@ async def show_single_reaction(update: Update, context: ContextTypes.DEFAULT_TYP
         return
     
     reaction = reactions[current_index]
-    reactor_profile = get_user_profile(reaction['user_id'])
+    reactor_profile = await db_read(get_user_profile, reaction['user_id'])
     is_reactor_profile_public = reactor_profile[5] if reactor_profile else False
     
-    reactor_name = get_display_name(reaction['user_id'], profile_is_public=is_reactor_profile_public)
+    reactor_name = await db_read(get_display_name, reaction['user_id'], profile_is_public=is_reactor_profile_public)
     
     if reaction['type'] == 'like':
         reaction_text = f"❤️ {reactor_name} поставил(а) лайк твоему арту!"
@@ -1708,7 +3215,7 @@ async def show_single_reaction(update: Update, context: ContextTypes.DEFAULT_TYP
         safe_comment_text = escape_markdown(comment_text) if comment_text else ""
         reaction_text = f"💬 {reactor_name} написал(а) комментарий к твоему арту:\n\n{safe_comment_text}"
     
-    art = get_art_by_id(reaction['art_id'])
+    art = await db_read(get_art_by_id, reaction['art_id'])
     if not art:
         context.user_data['current_reaction_index'] = current_index + 1
         await show_single_reaction(update, context)
@@ -1738,7 +3245,7 @@ async def show_single_reaction(update: Update, context: ContextTypes.DEFAULT_TYP
             reply_markup=reply_markup
         )
     
-    mark_reaction_as_viewed(user_id, reaction['type'], reaction['reaction_id'], reaction['art_id'])
+    await db_write(mark_reaction_as_viewed, user_id, reaction['type'], reaction['reaction_id'], reaction['art_id'])
     context.user_data['current_reaction_index'] = current_index + 1
     await create_or_update_reaction_notification(context, user_id)
     
@@ -1763,7 +3270,7 @@ async def finish_reactions_handler(update: Update, context: ContextTypes.DEFAULT
         logging.info(f"Не удалось удалить старое сообщение с кнопкой 'Завершить': {e}")
 
     user_id = query.from_user.id
-    mark_all_reactions_as_viewed(user_id)
+    await db_write(mark_all_reactions_as_viewed, user_id)
     
     if 'reactions_to_show' in context.user_data:
         del context.user_data['reactions_to_show']
@@ -1778,47 +3285,36 @@ async def menu_from_reactions_handler(update: Update, context: ContextTypes.DEFA
 
 # ========== СИСТЕМА CLIP ДЛЯ ПРОВЕРКИ ИЗОБРАЖЕНИЙ ==========
 
-# Конфигурация устройства
-device = "cuda" if torch.cuda.is_available() else "cpu"
-print(f"\n{'='*60}")
-print(f"🖥️  Используемое устройство: {device.upper()}")
-if device == "cuda":
-    print(f"   GPU: {torch.cuda.get_device_name(0)}")
-    print(f"   Память: {torch.cuda.get_device_properties(0).total_memory / 1e9:.1f} GB")
-print(f"{'='*60}\n")
+# Модели загружаются не при импорте, а в фоне после запуска бота (см. post_init):
+# бот сразу отвечает на команды и ленту, а проверка изображений ждёт готовности моделей.
+# ViT-B/32 - быстрая модель (32M параметров)
+# ViT-L/14 - точная модель (305M параметров)
+CLIP_MODEL_NAME = "ViT-L/14"
+NSFW_CLASSIFIER_MODEL = "Falconsai/nsfw_image_detection"
+# Бэкенд инференса на CPU:
+#   "torch"      - исходные fp32-модели;
+#   "torch-int8" - динамическое int8-квантование линейных слоёв визуальной части CLIP
+#                  и классификатора (текстовая часть CLIP остаётся в fp32);
+#   "onnx"       - визуальная часть CLIP и классификатор в ONNX Runtime, графы
+#                  экспортируются один раз и хранятся в TEXT_FEATURES_CACHE_DIR.
+# На GPU всегда используется "torch". Совпадение решений с fp32 на размеченных
+# образцах проверяет python artpeakbot.py --bench moderation.
+INFERENCE_BACKEND = "torch"
+INFERENCE_THREADS = 0  # потоков инференса на процесс, 0 - по умолчанию библиотеки
+torch = None
+clip = None
+device = None
 clip_model = None
 clip_preprocess = None
-try:
-    # ViT-B/32 - быстрая модель (32M параметров)
-    # ViT-L/14 - точная модель (305M параметров)
-    clip_model, clip_preprocess = clip.load("ViT-L/14", device=device)
-    logging.info(f"✅ CLIP модель ViT-L/14 загружена на устройство: {device}")
-    print(f"✅ CLIP модель успешно загружена на {device.upper()}")
-except Exception as e:
-    logging.error(f"❌ Ошибка загрузки CLIP модели: {e}")
-    clip_model = None
-    clip_preprocess = None
-    print(f"❌ Ошибка загрузки CLIP модели: {e}")
-
 # Дополнительная модель для проверки NSFW (быстрая, специализированная)
 nsfw_classifier = None
-try:
-    # Используем трансформер специально натренированный на NSFW
-    from transformers import pipeline
-    nsfw_classifier = pipeline(
-        "image-classification",
-        model="Falconsai/nsfw_image_detection",
-        device=0 if device == "cuda" else -1
-    )
-    logging.info("✅ NSFW classifier загружен успешно")
-    print("✅ NSFW classifier успешно загружена")
-except Exception as e:
-    logging.warning(f"⚠️  NSFW classifier не загружена: {e}")
-    nsfw_classifier = None
-    print(f"⚠️  NSFW classifier недоступна (используется только CLIP)")
+clip_image_encoder = None  # подготовленная пачка изображений -> признаки CLIP
+active_inference_backend = None
+_models_future = None  # concurrent.futures.Future фоновой загрузки моделей
+models_load_seconds = None
 
 nsfw_text_descriptions = [
-    "realistic blood and gore", "photographic violent"
+    "realistic blood and gore", "photographic violent",
     "real murder scene", "photograph of dead body", "real corpse", "real bloody scene",
     "real weapons violence", "real gun violence", "real knife attack",
     "blood and gore art", "violent scene drawing", "illustrated violence", "cartoon violence",
@@ -1850,7 +3346,7 @@ nsfw_text_descriptions = [
 nsfw_text_classes = [
     "violence", "violence", "violence", "violence", "violence", "violence", "violence", 
     "violence", "violence", "violence", "violence", "violence", "violence", "violence",
-    "violence", "violence", "violence", "violence", "violence", "violence",
+    "violence", "violence", "violence", "violence", "violence",
     
     "nudity", "nudity", "nudity", "nudity", "nudity", "nudity", "nudity", "nudity",
     "nudity", "nudity", "nudity", "nudity", "nudity", "nudity", "nudity", "nudity",
@@ -1863,111 +3359,587 @@ nsfw_text_classes = [
     "safe", "safe", "safe", "safe", "safe", "safe", "safe", "safe", "safe", "safe"
 ]
 
-async def check_image_nsfw(image: Image.Image) -> dict:
-    """
-    Проверяет изображение на NSFW контент используя CLIP модель.
-    Также использует дополнительный classifier если он доступен.
-    ПРИОРИТЕТ: NSFW classifier имеет наивысший приоритет.
-    """
-    if clip_model is None or clip_preprocess is None:
-        logging.error("CLIP модель не загружена")
-        return {"error": "Модель не загружена"}
+# Текстовые признаки описаний не зависят от изображения: они считаются один раз
+# при загрузке модели и кэшируются на диске по имени модели и хэшу списка описаний.
+# Модераторы могут переопределить описания в NSFW_PROMPTS_FILE
+# ({"violence": [...], "nudity": [...], "gore": [...], "safe": [...]})
+# и применить их командой /reload_prompts без перезапуска бота.
+NSFW_PROMPTS_FILE = 'nsfw_prompts.json'
+TEXT_FEATURES_CACHE_DIR = 'clip_cache'
+NSFW_CATEGORIES = ("safe", "violence", "nudity", "gore")
+clip_text_state = None  # (нормированные признаки описаний, категории описаний)
+
+def load_nsfw_prompts():
+    """Описания и их категории: из NSFW_PROMPTS_FILE, если он есть, иначе встроенные"""
+    if not os.path.exists(NSFW_PROMPTS_FILE):
+        descriptions, classes = list(nsfw_text_descriptions), list(nsfw_text_classes)
+    else:
+        with open(NSFW_PROMPTS_FILE, encoding='utf-8') as f:
+            prompts = json.load(f)
+        unknown = set(prompts) - set(NSFW_CATEGORIES)
+        if unknown:
+            raise ValueError(f"Неизвестные категории в {NSFW_PROMPTS_FILE}: {', '.join(sorted(unknown))}")
+        descriptions, classes = [], []
+        for category, category_descriptions in prompts.items():
+            descriptions.extend(category_descriptions)
+            classes.extend([category] * len(category_descriptions))
+    
+    if len(descriptions) != len(classes):
+        raise ValueError(f"Описаний {len(descriptions)}, а категорий {len(classes)}")
+    if not descriptions:
+        raise ValueError("Список описаний пуст")
+    return descriptions, classes
+
+def _text_features_cache_path(descriptions):
+    prompts_hash = hashlib.sha256(json.dumps(descriptions, ensure_ascii=False).encode('utf-8')).hexdigest()
+    model_slug = re.sub(r'[^A-Za-z0-9]+', '-', CLIP_MODEL_NAME)
+    return os.path.join(TEXT_FEATURES_CACHE_DIR, f"text_features_{model_slug}_{prompts_hash[:16]}.pt")
+
+def compute_clip_text_features(descriptions):
+    """Нормированные признаки описаний - с диска, если они уже считались для этой модели"""
+    cache_path = _text_features_cache_path(descriptions)
+    if os.path.exists(cache_path):
+        try:
+            return torch.load(cache_path, map_location=device)
+        except Exception as e:
+            logging.warning(f"Не удалось прочитать кэш текстовых признаков {cache_path}: {e}")
+    
+    text_tokens = clip.tokenize(descriptions).to(device)
+    with torch.no_grad():
+        text_features = clip_model.encode_text(text_tokens)
+        text_features = text_features / text_features.norm(dim=-1, keepdim=True)
     
     try:
-        # 1. Первая проверка с дополнительным NSFW классификатором (ПРИОРИТЕТ)
-        nsfw_classifier_score = 0
-        nsfw_classifier_confidence = 0
-        if nsfw_classifier is not None:
-            try:
-                classifier_results = nsfw_classifier(image)
-                # classifier_results = [{"label": "nsfw", "score": 0.9}, {"label": "normal", "score": 0.1}]
-                for result in classifier_results:
-                    if result["label"].lower() == "nsfw":
-                        nsfw_classifier_score = result["score"]
-                        nsfw_classifier_confidence = result["score"]
-                        logging.info(f"📊 NSFW classifier результат: NSFW score = {result['score']:.2%}")
-                        break
-            except Exception as e:
-                logging.warning(f"Ошибка при использовании дополнительного классификатора: {e}")
-        
-        # 2. Проверка с CLIP моделью (вспомогательная)
-        image_input = clip_preprocess(image).unsqueeze(0).to(device)
-        text_tokens = clip.tokenize(nsfw_text_descriptions).to(device)
-        
-        with torch.no_grad():
-            image_features = clip_model.encode_image(image_input)
-            text_features = clip_model.encode_text(text_tokens)
+        os.makedirs(TEXT_FEATURES_CACHE_DIR, exist_ok=True)
+        tmp_path = cache_path + '.tmp'
+        torch.save(text_features.cpu(), tmp_path)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logging.warning(f"Не удалось сохранить кэш текстовых признаков: {e}")
+    return text_features
+
+def reload_clip_text_features():
+    """Перечитывает описания и подменяет признаки одной операцией присваивания"""
+    global clip_text_state
+    descriptions, classes = load_nsfw_prompts()
+    text_features = compute_clip_text_features(descriptions)
+    clip_text_state = (text_features, classes)
+    logging.info(f"✅ Текстовые признаки CLIP готовы: {len(descriptions)} описаний")
+    return len(descriptions)
+
+def load_moderation_models():
+    """Импортирует torch, CLIP и transformers и загружает модели. Выполняется в потоке инференса."""
+    global torch, clip, device, clip_model, clip_preprocess, nsfw_classifier, models_load_seconds
+    started = time.perf_counter()
+    try:
+        import torch
+        import clip
+    except ImportError as e:
+        logging.error(f"❌ Не удалось импортировать torch/CLIP: {e}")
+        return False
+    
+    # Конфигурация устройства
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    if INFERENCE_THREADS > 0:
+        torch.set_num_threads(INFERENCE_THREADS)
+    print(f"\n{'='*60}")
+    print(f"🖥️  Используемое устройство: {device.upper()}")
+    if device == "cuda":
+        print(f"   GPU: {torch.cuda.get_device_name(0)}")
+        print(f"   Память: {torch.cuda.get_device_properties(0).total_memory / 1e9:.1f} GB")
+    print(f"{'='*60}\n")
+    try:
+        model, preprocess = clip.load(CLIP_MODEL_NAME, device=device)
+        logging.info(f"✅ CLIP модель {CLIP_MODEL_NAME} загружена на устройство: {device}")
+        print(f"✅ CLIP модель успешно загружена на {device.upper()}")
+    except Exception as e:
+        logging.error(f"❌ Ошибка загрузки CLIP модели: {e}")
+        model, preprocess = None, None
+        print(f"❌ Ошибка загрузки CLIP модели: {e}")
+    
+    try:
+        # Используем трансформер специально натренированный на NSFW
+        from transformers import pipeline
+        nsfw_classifier = pipeline(
+            "image-classification",
+            model=NSFW_CLASSIFIER_MODEL,
+            device=0 if device == "cuda" else -1
+        )
+        logging.info("✅ NSFW classifier загружен успешно")
+        print("✅ NSFW classifier успешно загружена")
+    except Exception as e:
+        logging.warning(f"⚠️  NSFW classifier не загружена: {e}")
+        nsfw_classifier = None
+        print(f"⚠️  NSFW classifier недоступна (используется только CLIP)")
+    
+    if model is not None:
+        # compute_clip_text_features обращается к clip_model, поэтому модель
+        # публикуется до подготовки признаков и снимается при ошибке
+        clip_model, clip_preprocess = model, preprocess
+        try:
+            reload_clip_text_features()
+        except Exception as e:
+            logging.error(f"❌ Ошибка подготовки текстовых признаков CLIP: {e}")
+            clip_model, clip_preprocess = None, None
+    if clip_model is not None:
+        apply_inference_backend()
+    
+    models_load_seconds = time.perf_counter() - started
+    logging.info(f"Загрузка моделей проверки изображений заняла {models_load_seconds:.1f} с")
+    return clip_model is not None
+
+def _onnx_model_path(name):
+    return os.path.join(TEXT_FEATURES_CACHE_DIR, re.sub(r'[^A-Za-z0-9]+', '-', name) + '.onnx')
+
+def _export_onnx(module, example_input, path):
+    os.makedirs(TEXT_FEATURES_CACHE_DIR, exist_ok=True)
+    tmp_path = path + '.tmp'
+    with torch.no_grad():
+        torch.onnx.export(
+            module, example_input, tmp_path,
+            input_names=["input"], output_names=["output"],
+            dynamic_axes={"input": {0: "batch"}, "output": {0: "batch"}},
+            opset_version=17,
+        )
+    os.replace(tmp_path, path)
+    logging.info(f"Граф ONNX сохранён: {path}")
+
+def _onnx_session(path):
+    import onnxruntime
+    options = onnxruntime.SessionOptions()
+    if INFERENCE_THREADS > 0:
+        options.intra_op_num_threads = INFERENCE_THREADS
+    return onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+class OnnxClipVisual:
+    """Визуальная часть CLIP в ONNX Runtime, вызывается вместо clip_model.encode_image"""
+    
+    def __init__(self, visual):
+        path = _onnx_model_path(f"clip_visual_{CLIP_MODEL_NAME}")
+        if not os.path.exists(path):
+            size = visual.input_resolution
+            _export_onnx(visual, torch.randn(1, 3, size, size), path)
+        self.session = _onnx_session(path)
+    
+    def __call__(self, image_input):
+        features = self.session.run(None, {"input": image_input.cpu().numpy()})[0]
+        return torch.from_numpy(features).to(device)
+
+class OnnxImageClassifier:
+    """Классификатор в ONNX Runtime с препроцессингом и форматом ответа pipeline"""
+    
+    def __init__(self, classifier):
+        self.image_processor = classifier.image_processor
+        self.labels = classifier.model.config.id2label
+        path = _onnx_model_path(f"classifier_{NSFW_CLASSIFIER_MODEL}")
+        if not os.path.exists(path):
+            model = classifier.model
             
-            image_features = image_features / image_features.norm(dim=-1, keepdim=True)
-            text_features = text_features / text_features.norm(dim=-1, keepdim=True)
+            class LogitsOnly(torch.nn.Module):
+                def __init__(self):
+                    super().__init__()
+                    self.model = model
+                
+                def forward(self, pixel_values):
+                    return self.model(pixel_values=pixel_values).logits
             
-            similarity = (100.0 * image_features @ text_features.T).softmax(dim=-1)
-            results = similarity[0].cpu().numpy()
+            example = self.image_processor(images=[Image.new("RGB", (224, 224))], return_tensors="pt")["pixel_values"]
+            _export_onnx(LogitsOnly().eval(), example, path)
+        self.session = _onnx_session(path)
+    
+    def __call__(self, images, batch_size=None):
+        pixel_values = self.image_processor(images=images, return_tensors="pt")["pixel_values"]
+        logits = self.session.run(None, {"input": pixel_values.numpy()})[0]
+        return [
+            [{"label": self.labels[index], "score": float(score)} for index, score in enumerate(row)]
+            for row in torch.from_numpy(logits).softmax(dim=-1)
+        ]
 
-        category_scores = {"safe": 0, "violence": 0, "nudity": 0, "gore": 0}
+def apply_inference_backend():
+    """Переводит загруженные модели на INFERENCE_BACKEND; при ошибке остаётся fp32 torch"""
+    global clip_image_encoder, nsfw_classifier, active_inference_backend
+    clip_image_encoder = clip_model.encode_image
+    active_inference_backend = "torch"
+    backend = INFERENCE_BACKEND
+    if backend == "torch":
+        return
+    if device != "cpu":
+        logging.info(f"Бэкенд {backend} рассчитан на CPU, на {device} используется torch")
+        return
+    
+    try:
+        if backend == "torch-int8":
+            quantize = torch.ao.quantization.quantize_dynamic
+            visual = quantize(clip_model.visual, {torch.nn.Linear}, dtype=torch.qint8)
+            classifier_model = None
+            if nsfw_classifier is not None:
+                classifier_model = quantize(nsfw_classifier.model, {torch.nn.Linear}, dtype=torch.qint8)
+            clip_model.visual = visual
+            if classifier_model is not None:
+                nsfw_classifier.model = classifier_model
+        elif backend == "onnx":
+            visual = OnnxClipVisual(clip_model.visual)
+            classifier = OnnxImageClassifier(nsfw_classifier) if nsfw_classifier is not None else None
+            clip_image_encoder = visual
+            if classifier is not None:
+                nsfw_classifier = classifier
+        else:
+            raise ValueError("неизвестный бэкенд")
+    except Exception as e:
+        logging.error(f"❌ Бэкенд инференса {backend} недоступен, используется torch: {e}")
+        return
+    active_inference_backend = backend
+    logging.info(f"✅ Бэкенд инференса: {backend}")
+
+def _moderation_worker_ready():
+    """Выполняется в процессе пула после его инициализатора load_moderation_models"""
+    return clip_model is not None
+
+def start_loading_moderation_models():
+    """Запускает фоновую загрузку моделей, если она ещё не запущена"""
+    global _models_future
+    if _models_future is None:
+        if MODERATION_WORKERS > 0:
+            _models_future = _get_moderation_pool().submit(_moderation_worker_ready)
+        else:
+            _models_future = _inference_executor.submit(load_moderation_models)
+    return _models_future
+
+async def wait_for_moderation_models():
+    """Ждёт готовности моделей и возвращает, загрузились ли они; загрузка запускается, если ещё не начата"""
+    try:
+        return await asyncio.shield(asyncio.wrap_future(start_loading_moderation_models()))
+    except BrokenProcessPool as e:
+        logging.error(f"❌ Процессы проверки изображений не запустились: {e}")
+        reset_moderation_pool()
+        return False
+
+def moderation_models_ready():
+    future = _models_future
+    return future is not None and future.done() and future.exception() is None and future.result()
+
+def get_models_status():
+    if _models_future is None:
+        return "не загружались"
+    if not _models_future.done():
+        return "загружаются"
+    if not moderation_models_ready():
+        return "ошибка загрузки"
+    if MODERATION_WORKERS > 0:
+        return f"{CLIP_MODEL_NAME} ({INFERENCE_BACKEND}) в {MODERATION_WORKERS} процессах"
+    return f"{CLIP_MODEL_NAME} ({active_inference_backend}) готова за {models_load_seconds:.1f} с"
+
+# Изображения на проверку собираются в очередь и обрабатываются пачками: до
+# INFERENCE_BATCH_SIZE штук или сколько успело прийти за INFERENCE_BATCH_WAIT_MS.
+# Пачка проходит через модели за один вызов в отдельном потоке, не блокируя цикл событий.
+INFERENCE_BATCH_SIZE = 8
+INFERENCE_BATCH_WAIT_MS = 50
+_inference_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='inference')
+_inference_queue = None
+_inference_worker_task = None
+inference_stats = {'batches': 0, 'images': 0, 'max_batch': 0, 'run_total': 0.0, 'wait_total': 0.0, 'failed': 0,
+                   'classifier_ms_total': 0.0, 'clip_ms_total': 0.0, 'clip_images': 0}
+
+# При MODERATION_WORKERS > 0 проверка идёт в отдельных процессах: каждый процесс
+# пула один раз загружает модели, получает байты изображений и возвращает оценки
+# категорий, а процесс бота не держит GIL на инференсе и не хранит модели в памяти.
+# Одновременно обрабатывается до MODERATION_WORKERS пачек. В очереди ждёт не больше
+# MODERATION_MAX_PENDING изображений, дальше новые загрузки ждут места в очереди.
+MODERATION_WORKERS = 0
+MODERATION_MAX_PENDING = 64
+_moderation_pool = None
+_inference_batch_tasks = set()
+
+def _get_moderation_pool():
+    global _moderation_pool
+    if _moderation_pool is None:
+        _moderation_pool = ProcessPoolExecutor(
+            max_workers=MODERATION_WORKERS,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=load_moderation_models,
+        )
+    return _moderation_pool
+
+def reset_moderation_pool():
+    """Останавливает процессы проверки; следующая проверка запустит новые"""
+    global _moderation_pool, _models_future
+    if _moderation_pool is not None:
+        _moderation_pool.shutdown(wait=False, cancel_futures=True)
+        _moderation_pool = None
+        _models_future = None
+
+def _classifier_nsfw_confidences(images):
+    """NSFW score дополнительного классификатора для каждого изображения пачки; None, если он недоступен"""
+    confidences = [0] * len(images)
+    if nsfw_classifier is None:
+        return None
+    try:
+        batch_results = nsfw_classifier(images, batch_size=len(images))
+        # batch_results = [[{"label": "nsfw", "score": 0.9}, {"label": "normal", "score": 0.1}], ...]
+        for index, classifier_results in enumerate(batch_results):
+            for result in classifier_results:
+                if result["label"].lower() == "nsfw":
+                    confidences[index] = result["score"]
+                    logging.info(f"📊 NSFW classifier результат: NSFW score = {result['score']:.2%}")
+                    break
+    except Exception as e:
+        logging.warning(f"Ошибка при использовании дополнительного классификатора: {e}")
+        return None
+    return confidences
+
+def _clip_category_scores(images):
+    """Максимальная вероятность по каждой категории CLIP для каждого изображения пачки"""
+    text_features, text_classes = clip_text_state
+    image_input = torch.stack([clip_preprocess(image) for image in images]).to(device)
+    
+    with torch.no_grad():
+        image_features = clip_image_encoder(image_input)
+        image_features = image_features / image_features.norm(dim=-1, keepdim=True)
         
+        similarity = (100.0 * image_features @ text_features.T).softmax(dim=-1)
+        batch_results = similarity.cpu().numpy()
+    
+    batch_scores = []
+    for results in batch_results:
+        category_scores = {"safe": 0, "violence": 0, "nudity": 0, "gore": 0}
         for i, score in enumerate(results):
-            category = nsfw_text_classes[i]
+            category = text_classes[i]
             if score > category_scores[category]:
-                category_scores[category] = score
-        
+                category_scores[category] = float(score)
+        batch_scores.append(category_scores)
+    return batch_scores
+
+# Каскад: сначала на всей пачке работает быстрый NSFW classifier, CLIP запускается
+# только для изображений в полосе [CASCADE_PASS_CONFIDENCE, CASCADE_BLOCK_CONFIDENCE).
+# Выше полосы изображение блокируется без CLIP. По умолчанию нижняя граница 0 -
+# CLIP проверяет всё, что не заблокировано: classifier обучен только на откровенном
+# контенте, и пропуск ниже полосы снял бы проверку на насилие и кровь. Поднимать
+# CASCADE_PASS_CONFIDENCE (например, до 0.05) можно только сознательно, приняв эту потерю.
+CASCADE_PASS_CONFIDENCE = 0
+CASCADE_BLOCK_CONFIDENCE = 0.7
+
+def run_nsfw_models(images):
+    """
+    Синхронная проверка пачки изображений каскадом моделей.
+    ПРИОРИТЕТ: NSFW classifier имеет наивысший приоритет.
+    """
+    images = [image.convert("RGB") if image.mode != "RGB" else image for image in images]
+    # 1. Первая проверка с дополнительным NSFW классификатором (ПРИОРИТЕТ)
+    started = time.perf_counter()
+    confidences = _classifier_nsfw_confidences(images)
+    classifier_ms = (time.perf_counter() - started) * 1000 / len(images)
+    
+    # 2. Проверка с CLIP моделью (вспомогательная) - только там, где classifier не уверен
+    if confidences is None:
+        confidences = [0] * len(images)
+        uncertain = list(range(len(images)))
+    else:
+        uncertain = [
+            index for index, confidence in enumerate(confidences)
+            if CASCADE_PASS_CONFIDENCE <= confidence < CASCADE_BLOCK_CONFIDENCE
+        ]
+    started = time.perf_counter()
+    clip_scores = dict(zip(uncertain, _clip_category_scores([images[index] for index in uncertain]) if uncertain else []))
+    clip_ms = (time.perf_counter() - started) * 1000 / len(uncertain) if uncertain else 0
+    
+    batch_scores = []
+    for index, nsfw_classifier_confidence in enumerate(confidences):
+        category_scores = clip_scores.get(index)
+        if category_scores is None:
+            category_scores = {"clip_skipped": True}
         # 3. Применяем результат NSFW classifier с ВЫСОКИМ ПРИОРИТЕТОМ
         # Если NSFW classifier дал высокий score, это переопределяет CLIP результаты
-        if nsfw_classifier_confidence > 0.5:
-            # NSFW classifier уверен что это NSFW - используем его результат
+        elif nsfw_classifier_confidence > 0.5:
             category_scores["nudity"] = nsfw_classifier_confidence
             logging.info(f"⚠️  NSFW classifier переопределяет результаты (confidence={nsfw_classifier_confidence:.2%})")
         
         # Добавляем confidence от NSFW classifier в результаты
         category_scores["nsfw_classifier_confidence"] = nsfw_classifier_confidence
-        
-        return category_scores
-        
+        category_scores["timings"] = {
+            "classifier_ms": classifier_ms,
+            "clip_ms": clip_ms if index in clip_scores else 0,
+        }
+        batch_scores.append(category_scores)
+    return batch_scores
+
+def run_nsfw_models_on_bytes(payloads):
+    """Проверка пачки закодированных изображений в процессе пула"""
+    return run_nsfw_models([Image.open(BytesIO(payload)) for payload in payloads])
+
+def _encode_image(image):
+    buffer = BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+async def _inference_worker():
+    loop = asyncio.get_running_loop()
+    # Пачек в работе не больше, чем исполнителей: остальные изображения копятся в очереди
+    slots = asyncio.Semaphore(max(MODERATION_WORKERS, 1))
+    while True:
+        await slots.acquire()
+        batch = [await _inference_queue.get()]
+        deadline = loop.time() + INFERENCE_BATCH_WAIT_MS / 1000
+        while len(batch) < INFERENCE_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_inference_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        
+        task = asyncio.create_task(_run_inference_batch(batch, slots))
+        _inference_batch_tasks.add(task)
+        task.add_done_callback(_inference_batch_tasks.discard)
+
+async def _run_inference_batch(batch, slots):
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    payloads = [payload for payload, _, _ in batch]
+    try:
+        if MODERATION_WORKERS > 0:
+            results = await loop.run_in_executor(_get_moderation_pool(), run_nsfw_models_on_bytes, payloads)
+        else:
+            results = await loop.run_in_executor(_inference_executor, run_nsfw_models, payloads)
     except Exception as e:
         logging.error(f"Ошибка при проверке изображения с CLIP: {e}")
-        return {"error": str(e)}
+        if isinstance(e, BrokenProcessPool):
+            reset_moderation_pool()
+        inference_stats['failed'] += len(batch)
+        results = [{"error": str(e)}] * len(batch)
+    finally:
+        slots.release()
+    
+    finished = time.perf_counter()
+    inference_stats['batches'] += 1
+    inference_stats['images'] += len(batch)
+    inference_stats['max_batch'] = max(inference_stats['max_batch'], len(batch))
+    inference_stats['run_total'] += finished - started
+    for (_, future, queued_at), result in zip(batch, results):
+        inference_stats['wait_total'] += started - queued_at
+        timings = result.pop("timings", None)
+        if timings:
+            inference_stats['classifier_ms_total'] += timings['classifier_ms']
+            if not result.get("clip_skipped"):
+                inference_stats['clip_images'] += 1
+                inference_stats['clip_ms_total'] += timings['clip_ms']
+        if not future.done():
+            future.set_result(result)
+
+def get_inference_stats():
+    batches = inference_stats['batches'] or 1
+    images = inference_stats['images'] or 1
+    return {
+        'queued': _inference_queue.qsize() if _inference_queue else 0,
+        'running': len(_inference_batch_tasks),
+        'workers': MODERATION_WORKERS,
+        'batches': inference_stats['batches'],
+        'images': inference_stats['images'],
+        'failed': inference_stats['failed'],
+        'avg_batch': inference_stats['images'] / batches,
+        'max_batch': inference_stats['max_batch'],
+        'avg_wait_ms': inference_stats['wait_total'] * 1000 / images,
+        'avg_batch_ms': inference_stats['run_total'] * 1000 / batches,
+        'avg_classifier_ms': inference_stats['classifier_ms_total'] / images,
+        'clip_images': inference_stats['clip_images'],
+        'avg_clip_ms': inference_stats['clip_ms_total'] / (inference_stats['clip_images'] or 1),
+    }
+
+async def check_image_nsfw(image: Image.Image, image_bytes: bytes = None) -> dict:
+    """
+    Проверяет изображение на NSFW контент используя CLIP модель.
+    Также использует дополнительный classifier если он доступен.
+    Изображение ставится в очередь пакетной проверки, результат приходит через future.
+    Процессам пула передаются исходные байты файла (image_bytes), если они есть.
+    """
+    global _inference_queue, _inference_worker_task
+    if not await wait_for_moderation_models():
+        logging.error("CLIP модель не загружена")
+        return {"error": "Модель не загружена"}
+    
+    if _inference_worker_task is None or _inference_worker_task.done():
+        _inference_queue = asyncio.Queue(maxsize=MODERATION_MAX_PENDING)
+        _inference_worker_task = asyncio.create_task(_inference_worker())
+    
+    payload = image
+    if MODERATION_WORKERS > 0:
+        payload = image_bytes or await asyncio.get_running_loop().run_in_executor(None, _encode_image, image)
+    future = asyncio.get_running_loop().create_future()
+    await _inference_queue.put((payload, future, time.perf_counter()))
+    return await future
+
+# Для проверки скачивается наименьший размер фото, которого хватает моделям
+# (обе работают со входом 224x224), и он сразу декодируется в уменьшенном виде.
+# Размеры и пропорции проверяются по метаданным Telegram ещё до скачивания,
+# разнообразие цветов - по миниатюре.
+MODERATION_INPUT_SIZE = 224
+MODERATION_COLOR_CHECK_SIZE = 128
+
+def select_moderation_photo(photos):
+    """Наименьший PhotoSize, меньшая сторона которого не меньше MODERATION_INPUT_SIZE"""
+    by_area = sorted(photos, key=lambda photo: photo.width * photo.height)
+    for photo in by_area:
+        if min(photo.width, photo.height) >= MODERATION_INPUT_SIZE:
+            return photo
+    return by_area[-1]
+
+def decode_moderation_image(data) -> Image.Image:
+    """Декодирует файл сразу в уменьшенном виде: JPEG через draft, остальные форматы через reduce"""
+    image = Image.open(BytesIO(data))
+    image.draft("RGB", (MODERATION_INPUT_SIZE, MODERATION_INPUT_SIZE))
+    image.load()
+    factor = min(image.size) // MODERATION_INPUT_SIZE
+    if factor >= 2:
+        image = image.reduce(factor)
+    return image
+
+def validate_image_dimensions(width, height) -> tuple:
+    if width < 50 or height < 50:
+        return False, "❌ Арт не может быть загружен!\n\nЕсли вы считаете, что это ошибка, обратитесь в поддержку."
+    
+    if width > 5000 or height > 5000:
+        return False, "❌ Арт не может быть загружен!\n\nЕсли вы считаете, что это ошибка, обратитесь в поддержку."
+    
+    ratio = max(width, height) / min(width, height)
+    if ratio > 8:
+        return False, "❌ Арт не может быть загружен!\n\nЕсли вы считаете, что это ошибка, обратитесь в поддержку."
+    
+    return True, "✅ Изображение прошло базовую проверку"
 
-async def validate_image_basic(image: Image.Image) -> tuple:
-    try:
-        width, height = image.size
-        if width < 50 or height < 50:
-            return False, "❌ Арт не может быть загружен!\n\nЕсли вы считаете, что это ошибка, обратитесь в поддержку."
-        
-        if width > 5000 or height > 5000:
-            return False, "❌ Арт не может быть загружен!\n\nЕсли вы считаете, что это ошибка, обратитесь в поддержку."
-        
-        ratio = max(width, height) / min(width, height)
-        if ratio > 8:
-            return False, "❌ Арт не может быть загружен!\n\nЕсли вы считаете, что это ошибка, обратитесь в поддержку."
-        
-        colors = image.getcolors(maxcolors=10000)
-        if colors and len(colors) < 10:
-            return False, "❌ Арт не может быть загружен!\n\nЕсли вы считаете, что это ошибка, обратитесь в поддержку."
-            
-        return True, "✅ Изображение прошло базовую проверку"
-        
-    except Exception as e:
-        logging.error(f"Ошибка базовой проверки изображения: {e}")
+def validate_image_colors(image: Image.Image) -> tuple:
+    # Миниатюра ближайшим соседом: она не смешивает пиксели и не добавляет новых цветов
+    thumbnail = image.copy()
+    thumbnail.thumbnail((MODERATION_COLOR_CHECK_SIZE, MODERATION_COLOR_CHECK_SIZE), Image.NEAREST)
+    colors = thumbnail.getcolors(maxcolors=10000)
+    if colors and len(colors) < 10:
         return False, "❌ Арт не может быть загружен!\n\nЕсли вы считаете, что это ошибка, обратитесь в поддержку."
     
-async def is_image_safe(image: Image.Image) -> tuple:
+    return True, "✅ Изображение прошло базовую проверку"
+
+def decide_image_safety(scores: dict) -> tuple:
     """
-    Проверяет изображение на NSFW контент.
-    Использует CLIP модель + опциональный дополнительный классификатор.
+    Решение по оценкам check_image_nsfw.
     
     Логика приоритетов:
+    0. CLIP пропущен каскадом → решение только по NSFW classifier
     1. NSFW classifier >= 70% → БЛОКИРОВКА
     2. safe_score < 0.02 AND NSFW classifier < 10% → ПРОПУСК
     3. Остальные CLIP проверки
     """
-    scores = await check_image_nsfw(image)
-    
     if "error" in scores:
         return False, "❌ Арт не может быть загружен!\n\nЕсли вы считаете, что это ошибка, обратитесь в поддержку."
     
     # Получаем confidence от NSFW classifier
     nsfw_classifier_confidence = scores.get("nsfw_classifier_confidence", 0)
     
+    # ★ Каскад: CLIP не запускался, решение принимается только по NSFW classifier
+    if scores.get("clip_skipped"):
+        if nsfw_classifier_confidence >= CASCADE_BLOCK_CONFIDENCE:
+            logging.warning(f"🚫 NSFW classifier блокирует без CLIP (уверенность {nsfw_classifier_confidence:.1%})")
+            return False, "❌ Арт не может быть загружен!\n\nЕсли вы считаете, что это ошибка, обратитесь в поддержку."
+        logging.info(f"✅ Изображение одобрено без CLIP (NSFW classifier: {nsfw_classifier_confidence:.1%})")
+        return True, f"✅ Изображение безопасно (риск: {nsfw_classifier_confidence:.1%})"
+    
     max_nsfw_score = max(scores["violence"], scores["nudity"], scores["gore"])
     safe_score = scores["safe"]
     logging.info(
@@ -1980,7 +3952,7 @@ async def is_image_safe(image: Image.Image) -> tuple:
     )
     
     # ★ ПРИОРИТЕТ 1: NSFW classifier блокирует если >= 70% вероятность
-    if nsfw_classifier_confidence >= 0.7:
+    if nsfw_classifier_confidence >= CASCADE_BLOCK_CONFIDENCE:
         logging.warning(f"🚫 NSFW classifier блокирует (уверенность {nsfw_classifier_confidence:.1%})")
         return False, "❌ Арт не может быть загружен!\n\nЕсли вы считаете, что это ошибка, обратитесь в поддержку."
     
@@ -2017,28 +3989,202 @@ async def is_image_safe(image: Image.Image) -> tuple:
     logging.info(f"✅ Изображение одобрено (риск CLIP: {max_nsfw_score:.1%}, NSFW classifier: {nsfw_classifier_confidence:.1%})")
     return True, f"✅ Изображение безопасно (риск: {max_nsfw_score:.1%})"
 
-# ========== СИСТЕМА ПРОФИЛЕЙ ПОЛЬЗОВАТЕЛЕЙ ==========
-
-def get_user_profile(user_id):
-    """Получает профиль пользователя"""
-    conn = sqlite3.connect('database.db')
+# ========== КЭШ ВЕРДИКТОВ МОДЕРАЦИИ ==========
+# Одно и то же изображение часто загружают повторно: как аватар и как арт или
+# снова после отказа. Вердикт сначала ищется по file_unique_id (ещё до
+# скачивания файла), затем по dHash среди похожих изображений. Похожее
+# изображение наследует отказ на расстоянии до VERDICT_DHASH_MAX_DISTANCE,
+# а одобрение - только при совпадении хэша: небольшой вставленный фрагмент
+# почти не меняет dHash.
+
+VERDICT_CACHE_TTL = 30 * 24 * 3600  # секунд
+VERDICT_CACHE_MAX_ENTRIES = 50000  # сверх этого вытесняются давно не использованные записи
+VERDICT_DHASH_MAX_DISTANCE = 3  # не больше 3, иначе поиск по полосам хэша пропустит совпадения
+VERDICT_DHASH_SAFE_MAX_DISTANCE = 0
+verdict_cache_stats = {'exact_hits': 0, 'similar_hits': 0, 'misses': 0}
+
+def compute_dhash(image: Image.Image) -> int:
+    """64-битный разностный хэш: сравнение соседних пикселей серой копии 9x8"""
+    pixels = list(image.convert("L").resize((9, 8), Image.LANCZOS).getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = value << 1 | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    # SQLite хранит знаковые 64-битные целые
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+def _dhash_bands(dhash):
+    return tuple((dhash >> (16 * band)) & 0xFFFF for band in range(4))
+
+def _dhash_distance(a, b):
+    return bin((a ^ b) & 0xFFFFFFFFFFFFFFFF).count("1")
+
+def get_cached_verdict(file_unique_id):
+    """Вердикт для того же файла: (scores, is_safe, message, basic_ok, basic_message) или None"""
+    conn = get_db_connection()
     cur = conn.cursor()
     cur.execute('''
-        SELECT user_id, username, nickname, bio, profile_avatar_file_id, is_profile_public
-        FROM users WHERE user_id = ?
-    ''', (user_id,))
+        SELECT scores, is_safe, message, basic_ok, basic_message FROM moderation_verdicts
+        WHERE file_unique_id = ? AND created_at > ?
+    ''', (file_unique_id, time.time() - VERDICT_CACHE_TTL))
     result = cur.fetchone()
     conn.close()
     return result
 
-def update_user_nickname(user_id, nickname):
-    """Обновляет ник пользователя (максимум 30 символов)"""
-    if len(nickname) > 30:
-        return False, "❌ Ник не может быть длиннее 30 символов"
-    if len(nickname) < 1:
+def find_similar_verdict(dhash):
+    """Ближайший по dHash вердикт: (file_unique_id, scores, is_safe, message) или None"""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT file_unique_id, dhash, scores, is_safe, message FROM moderation_verdicts
+        WHERE (band0 = ? OR band1 = ? OR band2 = ? OR band3 = ?) AND created_at > ?
+    ''', (*_dhash_bands(dhash), time.time() - VERDICT_CACHE_TTL))
+    best, best_distance = None, None
+    for file_unique_id, cached_dhash, scores, is_safe, message in cur.fetchall():
+        distance = _dhash_distance(dhash, cached_dhash)
+        limit = VERDICT_DHASH_SAFE_MAX_DISTANCE if is_safe else VERDICT_DHASH_MAX_DISTANCE
+        if distance <= limit and (best is None or distance < best_distance):
+            best, best_distance = (file_unique_id, scores, is_safe, message), distance
+    conn.close()
+    return best
+
+def save_verdict(file_unique_id, dhash, scores, is_safe, message, basic_ok, basic_message):
+    now = time.time()
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('''
+        INSERT OR REPLACE INTO moderation_verdicts
+        (file_unique_id, dhash, band0, band1, band2, band3, scores, is_safe, message,
+         basic_ok, basic_message, created_at, last_hit_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (file_unique_id, dhash, *_dhash_bands(dhash), scores, is_safe, message,
+          basic_ok, basic_message, now, now))
+    conn.commit()
+    conn.close()
+
+def touch_verdict(file_unique_id):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('UPDATE moderation_verdicts SET last_hit_at = ? WHERE file_unique_id = ?',
+                (time.time(), file_unique_id))
+    conn.commit()
+    conn.close()
+
+def prune_verdict_cache():
+    """Удаляет просроченные вердикты и вытесняет давно не использованные сверх лимита"""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('DELETE FROM moderation_verdicts WHERE created_at <= ?', (time.time() - VERDICT_CACHE_TTL,))
+    expired_count = cur.rowcount
+    cur.execute('''
+        DELETE FROM moderation_verdicts WHERE file_unique_id IN (
+            SELECT file_unique_id FROM moderation_verdicts
+            ORDER BY last_hit_at DESC LIMIT -1 OFFSET ?
+        )
+    ''', (VERDICT_CACHE_MAX_ENTRIES,))
+    evicted_count = cur.rowcount
+    conn.commit()
+    conn.close()
+    
+    if expired_count or evicted_count:
+        logging.info(f"Кэш вердиктов: удалено просроченных {expired_count}, вытеснено {evicted_count}")
+
+def clear_verdict_cache():
+    """Сбрасывает кэш вердиктов, например после смены описаний NSFW-категорий"""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('DELETE FROM moderation_verdicts')
+    conn.commit()
+    conn.close()
+
+def _prepare_moderation_image(data):
+    """Вне цикла событий: уменьшенное изображение, проверка цветов и dHash"""
+    image = decode_moderation_image(data)
+    return image, validate_image_colors(image), compute_dhash(image)
+
+async def moderate_photo(photos, check_basic=True, on_stage=None) -> tuple:
+    """
+    Проверяет фото из сообщения (список PhotoSize) с учётом кэша вердиктов.
+    Возвращает (прошло ли базовую проверку, безопасно ли, сообщение).
+    При check_basic=False базовая проверка не влияет на результат (аватары).
+    on_stage(стадия) вызывается после скачивания ('downloaded') и базовой проверки ('validated').
+    """
+    photo = photos[-1]
+    cached = await db_read(get_cached_verdict, photo.file_unique_id)
+    if cached:
+        verdict_cache_stats['exact_hits'] += 1
+        await db_write(touch_verdict, photo.file_unique_id)
+        scores, is_safe, message, basic_ok, basic_message = cached
+        if check_basic and not basic_ok:
+            return False, False, basic_message
+        return True, bool(is_safe), message
+    
+    # Результат базовой проверки сохраняется вместе с вердиктом, поэтому
+    # проверяем всегда, даже если для аватара он не нужен
+    basic_ok, basic_message = validate_image_dimensions(photo.width, photo.height)
+    if check_basic and not basic_ok:
+        return False, False, basic_message
+    
+    photo_file = await select_moderation_photo(photos).get_file()
+    photo_bytes = bytes(await photo_file.download_as_bytearray())
+    loop = asyncio.get_running_loop()
+    image, colors_result, dhash = await loop.run_in_executor(None, _prepare_moderation_image, photo_bytes)
+    if on_stage:
+        await on_stage('downloaded')
+    if basic_ok:
+        basic_ok, basic_message = colors_result
+    if check_basic and not basic_ok:
+        return False, False, basic_message
+    if on_stage:
+        await on_stage('validated')
+    
+    similar = await db_read(find_similar_verdict, dhash)
+    if similar:
+        verdict_cache_stats['similar_hits'] += 1
+        similar_file_unique_id, scores, is_safe, message = similar
+        logging.info(f"Вердикт модерации взят у похожего изображения {similar_file_unique_id}")
+        is_safe = bool(is_safe)
+    else:
+        verdict_cache_stats['misses'] += 1
+        scores = await check_image_nsfw(image, photo_bytes)
+        is_safe, message = decide_image_safety(scores)
+        if "error" in scores:
+            return True, is_safe, message
+        scores = json.dumps(scores)
+    
+    await db_write(save_verdict, photo.file_unique_id, dhash, scores, is_safe, message,
+                   basic_ok, basic_message)
+    return True, is_safe, message
+
+def get_verdict_cache_stats():
+    lookups = sum(verdict_cache_stats.values()) or 1
+    return {
+        **verdict_cache_stats,
+        'hit_rate': (verdict_cache_stats['exact_hits'] + verdict_cache_stats['similar_hits']) / lookups,
+    }
+
+# ========== СИСТЕМА ПРОФИЛЕЙ ПОЛЬЗОВАТЕЛЕЙ ==========
+
+def get_user_profile(user_id):
+    """Получает профиль пользователя"""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT user_id, username, nickname, bio, profile_avatar_file_id, is_profile_public
+        FROM users WHERE user_id = ?
+    ''', (user_id,))
+    result = cur.fetchone()
+    conn.close()
+    return result
+
+def update_user_nickname(user_id, nickname):
+    """Обновляет ник пользователя (максимум 30 символов)"""
+    if len(nickname) > 30:
+        return False, "❌ Ник не может быть длиннее 30 символов"
+    if len(nickname) < 1:
         return False, "❌ Ник не может быть пустым"
     
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     cur.execute('UPDATE users SET nickname = ? WHERE user_id = ?', (nickname, user_id))
     conn.commit()
@@ -2050,7 +4196,7 @@ def update_user_bio(user_id, bio):
     if len(bio) > 500:
         return False, "❌ Описание не может быть длиннее 500 символов"
     
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     cur.execute('UPDATE users SET bio = ? WHERE user_id = ?', (bio, user_id))
     conn.commit()
@@ -2059,7 +4205,7 @@ def update_user_bio(user_id, bio):
 
 def update_user_profile_avatar(user_id, file_id):
     """Обновляет аватар профиля"""
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     cur.execute('UPDATE users SET profile_avatar_file_id = ? WHERE user_id = ?', (file_id, user_id))
     conn.commit()
@@ -2074,7 +4220,7 @@ def toggle_profile_privacy(user_id):
     
     is_public = not profile[5]
     
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     cur.execute('UPDATE users SET is_profile_public = ? WHERE user_id = ?', (is_public, user_id))
     conn.commit()
@@ -2088,7 +4234,7 @@ def follow_user(follower_id, following_id):
     if follower_id == following_id:
         return False, "❌ Вы не можете подписаться на самого себя"
     
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     cur.execute('SELECT 1 FROM profile_followers WHERE follower_id = ? AND following_id = ?',
                (follower_id, following_id))
@@ -2112,11 +4258,7 @@ def follow_user(follower_id, following_id):
 async def notify_about_follower(context: ContextTypes.DEFAULT_TYPE, following_id: int):
     """Отправляет уведомление о новой подписке"""
     try:
-        conn = sqlite3.connect('database.db')
-        cur = conn.cursor()
-        cur.execute('SELECT COUNT(*) FROM profile_followers WHERE following_id = ?', (following_id,))
-        followers_count = cur.fetchone()[0]
-        conn.close()
+        followers_count = await db_read(get_followers_count, following_id)
         if followers_count % 10 == 1 and followers_count % 100 != 11:
             word = "человек"
         else:
@@ -2145,7 +4287,7 @@ async def notify_about_follower(context: ContextTypes.DEFAULT_TYPE, following_id
 
 def unfollow_user(follower_id, following_id):
     """Отписывает от пользователя"""
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     cur.execute('DELETE FROM profile_followers WHERE follower_id = ? AND following_id = ?',
                (follower_id, following_id))
@@ -2155,7 +4297,7 @@ def unfollow_user(follower_id, following_id):
 
 def is_following(follower_id, following_id):
     """Проверяет подписан ли пользователь"""
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     cur.execute('SELECT 1 FROM profile_followers WHERE follower_id = ? AND following_id = ?',
                (follower_id, following_id))
@@ -2165,16 +4307,31 @@ def is_following(follower_id, following_id):
 
 def get_followers_count(user_id):
     """Получает количество подписчиков"""
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     cur.execute('SELECT COUNT(*) FROM profile_followers WHERE following_id = ?', (user_id,))
     count = cur.fetchone()[0]
     conn.close()
     return count
 
+def get_followers(user_id):
+    """Получает подписчиков пользователя, начиная с самых новых"""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT u.user_id, u.username, u.nickname
+        FROM profile_followers pf
+        JOIN users u ON pf.follower_id = u.user_id
+        WHERE pf.following_id = ?
+        ORDER BY pf.timestamp DESC
+    ''', (user_id,))
+    followers = cur.fetchall()
+    conn.close()
+    return followers
+
 def get_following_count(user_id):
     """Получает количество подписок пользователя"""
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     cur.execute('SELECT COUNT(*) FROM profile_followers WHERE follower_id = ?', (user_id,))
     count = cur.fetchone()[0]
@@ -2188,22 +4345,76 @@ def search_users_by_nickname(query, limit=10):
     if not clean_query:
         return []
     
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
-    cur.execute('''
-        SELECT user_id, nickname, username, is_profile_public
-        FROM users
-        WHERE (nickname LIKE ? OR username LIKE ?)
-        AND is_profile_public = 1
-        LIMIT ?
-    ''', (f'%{clean_query}%', f'%{clean_query}%', limit))
-    results = cur.fetchall()
+    
+    if not search_index_available:
+        cur.execute('''
+            SELECT user_id, nickname, username, is_profile_public
+            FROM users
+            WHERE (nickname LIKE ? OR username LIKE ?)
+            AND is_profile_public = 1
+            LIMIT ?
+        ''', (f'%{clean_query}%', f'%{clean_query}%', limit))
+        results = cur.fetchall()
+        conn.close()
+        return results
+    
+    # Последняя колонка - число подписчиков, по нему сортируем и затем отбрасываем
+    def ranked(candidates_sql, args, count):
+        cur.execute(f'''
+            SELECT u.user_id, u.nickname, u.username, u.is_profile_public, COALESCE(s.followers, 0) AS followers
+            FROM ({candidates_sql}) c
+            JOIN users u ON u.user_id = c.user_id
+            LEFT JOIN artist_stats s ON s.owner_id = u.user_id
+            WHERE u.is_profile_public = 1
+            ORDER BY followers DESC
+            LIMIT ?
+        ''', (*args, count))
+        return cur.fetchall()
+    
+    def by_match(fts_query, count):
+        return ranked(
+            'SELECT rowid AS user_id FROM users_fts WHERE users_fts MATCH ? LIMIT ?',
+            (fts_query.lower(), SEARCH_MATCH_LIMIT), count
+        )
+    
+    # LIKE в SQLite не учитывает регистр только для ASCII: ник "Аня" не найдётся ни по "ан",
+    # ни по "АН". Для остальных букв шаблоны строятся для введённого текста, нижнего
+    # регистра и с заглавной буквы; ASCII-запросу лишние шаблоны только сузили бы выборку
+    def case_variants(text):
+        if text.isascii():
+            return [text]
+        return list(dict.fromkeys((text, text.lower(), text.capitalize())))
+    
+    def by_patterns(patterns, scan_limit, count):
+        condition = ' OR '.join(
+            ["nickname LIKE ? ESCAPE '\\'"] * len(patterns) + ["username LIKE ? ESCAPE '\\'"] * len(patterns)
+        )
+        patterns = [pattern + '%' for pattern in patterns]
+        return ranked(
+            f'SELECT user_id FROM users WHERE {condition} LIMIT ?',
+            (*patterns, *patterns, scan_limit), count
+        )
+    
+    results = _search_with_typos(
+        clean_query, limit, by_match,
+        by_prefix=lambda prefix, count: by_patterns(
+            [_like_escape(variant) for variant in case_variants(prefix)], SEARCH_MATCH_LIMIT, count
+        ),
+        by_typo=lambda term: by_patterns(
+            sorted({pattern for variant in case_variants(term) for pattern in _typo_patterns(variant, _like_escape, '_')}),
+            SEARCH_FUZZY_CANDIDATES, SEARCH_FUZZY_CANDIDATES
+        ),
+        texts=lambda row: (row[1], row[2]),
+        popularity=lambda row: row[4]
+    )
     conn.close()
-    return results
+    return [row[:4] for row in results]
 
 def add_profile_violation(user_id, violation_type, reason):
     """Добавляет нарушение профиля"""
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     cur.execute('''
         INSERT INTO profile_violations (user_id, violation_type, reason)
@@ -2215,7 +4426,7 @@ def add_profile_violation(user_id, violation_type, reason):
 
 def has_profile_violations(user_id):
     """Проверяет есть ли нарушения в профиле"""
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     cur = conn.cursor()
     cur.execute('SELECT COUNT(*) FROM profile_violations WHERE user_id = ?', (user_id,))
     count = cur.fetchone()[0]
@@ -2228,7 +4439,7 @@ async def send_for_manual_review(context, user_id: int, caption: str, file_id: s
     try:
         review_text = (
             f"🔍 **Требуется ручная модерация**\n\n"
-            f"👤 Пользователь: {escape_markdown(get_display_name(user_id, for_moderator=True))}\n"
+            f"👤 Пользователь: {escape_markdown(await db_read(get_display_name, user_id, for_moderator=True))}\n"
             f"🆔 ID: {user_id}\n"
             f"📝 Подпись: {escape_markdown(caption[:500] if caption else 'Нет подписи')}\n\n"
             f"Автоматическая проверка вызвала подозрения."
@@ -2268,7 +4479,7 @@ async def send_to_support_handler(update: Update, context: ContextTypes.DEFAULT_
         callback_data = query.data
         pending_id = int(callback_data.split('_')[-1])
         
-        pending_art = get_pending_art(pending_id)
+        pending_art = await db_read(get_pending_art, pending_id)
         if not pending_art:
             await query.answer("❌ Арт не найден в базе данных", show_alert=True)
             return
@@ -2294,7 +4505,7 @@ async def approve_manual_handler(update: Update, context: ContextTypes.DEFAULT_T
         callback_data = query.data
         pending_id = int(callback_data.split('_')[-1])
         
-        pending_art = get_pending_art(pending_id)
+        pending_art = await db_read(get_pending_art, pending_id)
         if not pending_art:
             await query.answer("❌ Арт не найден в базе данных", show_alert=True)
             return
@@ -2303,10 +4514,10 @@ async def approve_manual_handler(update: Update, context: ContextTypes.DEFAULT_T
         
         hashtags = hashtags_text.split(",") if hashtags_text else []
         
-        art_id, message = add_art(user_id, file_id, caption, hashtags)
+        art_id, message = await db_write(add_art, user_id, file_id, caption, hashtags)
         
         if art_id:
-            delete_pending_art(pending_id)
+            await db_write(delete_pending_art, pending_id)
             
             old_caption = query.message.caption or ""
             await query.edit_message_caption(
@@ -2337,14 +4548,14 @@ async def reject_manual_handler(update: Update, context: ContextTypes.DEFAULT_TY
         callback_data = query.data
         pending_id = int(callback_data.split('_')[-1])
         
-        pending_art = get_pending_art(pending_id)
+        pending_art = await db_read(get_pending_art, pending_id)
         if not pending_art:
             await query.answer("❌ Арт не найден в базе данных", show_alert=True)
             return
         
         pending_id, user_id, file_id, caption, hashtags_text, timestamp = pending_art
         
-        delete_pending_art(pending_id)
+        await db_write(delete_pending_art, pending_id)
         
         old_caption = query.message.caption or ""
         await query.edit_message_caption(
@@ -2367,69 +4578,172 @@ async def reject_manual_handler(update: Update, context: ContextTypes.DEFAULT_TY
 
 # ========== ОСНОВНЫЕ ФУНКЦИИ БОТА ==========
 
-async def send_art_to_user(chat_id, context, user_id, art=None, update_message=None, hashtag_filter=None):
-    """Показывает арт пользователю"""
-    if not art:
-        art = get_unseen_art(user_id, hashtag_filter)
+# Лента показывается из очереди заранее подготовленных карточек: после оценки
+# следующий арт берётся из памяти, а очередь пополняется в фоне.
+FEED_PREFETCH_SIZE = 5
+FEED_PREFETCH_LOW_WATER = 2
+FEED_CARD_TTL = 300  # секунд - дольше счётчики лайков в карточке устаревают
+feed_queues = {}
+_feed_queue_generations = {}
+_feed_queues_lock = threading.Lock()
+_feed_refill_tasks = {}
+
+def build_art_card(user_id, art, hashtag_filter=None):
+    """Готовит подпись и клавиатуру карточки арта для пользователя"""
+    art_id, file_id, caption, likes, dislikes = art
+    owner_id = get_art_owner(art_id)
+    owner_profile = get_user_profile(owner_id) if owner_id else None
     
-    if art:
-        art_id, file_id, caption, likes, dislikes = art
-        owner_id = get_art_owner(art_id)
-        owner_profile = get_user_profile(owner_id) if owner_id else None
-        
-        hashtags = get_art_hashtags(art_id)
-        hashtags_text = " ".join(hashtags) if hashtags else ""
-        text = f"Лайков: {likes} | Дизлайков: {dislikes}"
-        if caption:
-            text = f"{caption}\n\n{text}"
-        if hashtags_text:
-            text = f"{text}\n\n{hashtags_text}"
-        conn = sqlite3.connect('database.db')
-        cur = conn.cursor()
-        cur.execute('SELECT type FROM reactions WHERE user_id = ? AND art_id = ?', 
-                   (user_id, art_id))
-        existing_reaction = cur.fetchone()
-        conn.close()
-        if existing_reaction:
-            keyboard = []
-            if existing_reaction[0] == 'like':
-                keyboard.append([
-                    InlineKeyboardButton("❤️ Вы лайкнули", callback_data='already_reacted'),
-                    InlineKeyboardButton("💬 Комментарий", callback_data=f'comment_{art_id}'),
-                    InlineKeyboardButton("👎 Дизлайк", callback_data=f'dislike_{art_id}')
-                ])
-            else:
-                keyboard.append([
-                    InlineKeyboardButton("❤️ Лайк", callback_data=f'like_{art_id}'),
-                    InlineKeyboardButton("💬 Комментарий", callback_data=f'comment_{art_id}'),
-                    InlineKeyboardButton("👎 Вы дизлайкнули", callback_data='already_reacted')
-                ])
-            
-            row2 = []
-            if owner_profile and owner_profile[5]: 
-                row2.append(InlineKeyboardButton("👤 Профиль", callback_data=f'view_profile_{owner_id}'))
-            if row2:
-                keyboard.append(row2)
-            keyboard.append([InlineKeyboardButton("🔙 В меню", callback_data='back_to_menu')])
+    hashtags = get_art_hashtags(art_id)
+    hashtags_text = " ".join(hashtags) if hashtags else ""
+    text = f"Лайков: {likes} | Дизлайков: {dislikes}"
+    if caption:
+        text = f"{caption}\n\n{text}"
+    if hashtags_text:
+        text = f"{text}\n\n{hashtags_text}"
+    existing_reaction = get_user_reaction(user_id, art_id)
+    if existing_reaction:
+        keyboard = []
+        if existing_reaction == 'like':
+            keyboard.append([
+                InlineKeyboardButton("❤️ Вы лайкнули", callback_data='already_reacted'),
+                InlineKeyboardButton("💬 Комментарий", callback_data=f'comment_{art_id}'),
+                InlineKeyboardButton("👎 Дизлайк", callback_data=f'dislike_{art_id}')
+            ])
         else:
-            keyboard = []
             keyboard.append([
                 InlineKeyboardButton("❤️ Лайк", callback_data=f'like_{art_id}'),
                 InlineKeyboardButton("💬 Комментарий", callback_data=f'comment_{art_id}'),
-                InlineKeyboardButton("👎 Дизлайк", callback_data=f'dislike_{art_id}')
+                InlineKeyboardButton("👎 Вы дизлайкнули", callback_data='already_reacted')
             ])
-            
-            row2 = []
-            if owner_profile and owner_profile[5]:
-                row2.append(InlineKeyboardButton("👤 Профиль", callback_data=f'view_profile_{owner_id}'))
-            row2.append(InlineKeyboardButton("🚫 Жалоба", callback_data=f'complaint_{art_id}'))
-            if row2:
-                keyboard.append(row2)
-            keyboard.append([InlineKeyboardButton("🔙 В меню", callback_data='back_to_menu')])
-        if hashtag_filter:
-            keyboard.insert(-1, [InlineKeyboardButton("🔍 Сбросить фильтр", callback_data='view_arts')])
         
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        row2 = []
+        if owner_profile and owner_profile[5]: 
+            row2.append(InlineKeyboardButton("👤 Профиль", callback_data=f'view_profile_{owner_id}'))
+        if row2:
+            keyboard.append(row2)
+        keyboard.append([InlineKeyboardButton("🔙 В меню", callback_data='back_to_menu')])
+    else:
+        keyboard = []
+        keyboard.append([
+            InlineKeyboardButton("❤️ Лайк", callback_data=f'like_{art_id}'),
+            InlineKeyboardButton("💬 Комментарий", callback_data=f'comment_{art_id}'),
+            InlineKeyboardButton("👎 Дизлайк", callback_data=f'dislike_{art_id}')
+        ])
+        
+        row2 = []
+        if owner_profile and owner_profile[5]:
+            row2.append(InlineKeyboardButton("👤 Профиль", callback_data=f'view_profile_{owner_id}'))
+        row2.append(InlineKeyboardButton("🚫 Жалоба", callback_data=f'complaint_{art_id}'))
+        if row2:
+            keyboard.append(row2)
+        keyboard.append([InlineKeyboardButton("🔙 В меню", callback_data='back_to_menu')])
+    if hashtag_filter:
+        keyboard.insert(-1, [InlineKeyboardButton("🔍 Сбросить фильтр", callback_data='view_arts')])
+    
+    return {
+        'art_id': art_id,
+        'file_id': file_id,
+        'text': text,
+        'reply_markup': InlineKeyboardMarkup(keyboard),
+        'created_at': time.monotonic(),
+    }
+
+def prefetch_art_cards(user_id, hashtag_filter=None, limit=FEED_PREFETCH_SIZE, exclude_ids=()):
+    arts = get_unseen_arts(user_id, hashtag_filter, limit, exclude_ids)
+    return [build_art_card(user_id, art, hashtag_filter) for art in arts]
+
+def _feed_queue_key(user_id, hashtag_filter):
+    return (user_id, hashtag_filter.lower() if hashtag_filter else None)
+
+def invalidate_feed_queues(user_id=None, art_id=None):
+    """
+    Сбрасывает подготовленные карточки ленты. Можно вызывать из потоков БД.
+    art_id - убрать только карточки этого арта (у всех или у user_id),
+    user_id без art_id - очистить все очереди пользователя, без аргументов - все очереди.
+    """
+    with _feed_queues_lock:
+        for key in set(feed_queues) | set(_feed_queue_generations):
+            if user_id is not None and key[0] != user_id:
+                continue
+            if art_id is None:
+                feed_queues.pop(key, None)
+            elif key in feed_queues:
+                feed_queues[key] = deque(card for card in feed_queues[key] if card['art_id'] != art_id)
+            if user_id is None or art_id is None:
+                # Пополнение, начатое до сброса, не должно вернуть устаревшие карточки
+                _feed_queue_generations[key] = _feed_queue_generations.get(key, 0) + 1
+
+def pop_feed_card(user_id, hashtag_filter=None):
+    key = _feed_queue_key(user_id, hashtag_filter)
+    now = time.monotonic()
+    with _feed_queues_lock:
+        queued = feed_queues.get(key)
+        while queued:
+            card = queued.popleft()
+            if now - card['created_at'] < FEED_CARD_TTL:
+                return card
+    return None
+
+async def refill_feed_queue(user_id, hashtag_filter=None, shown_art_id=None):
+    key = _feed_queue_key(user_id, hashtag_filter)
+    with _feed_queues_lock:
+        generation = _feed_queue_generations.setdefault(key, 0)
+        queued = feed_queues.get(key) or ()
+        missing = FEED_PREFETCH_SIZE - len(queued)
+        exclude_ids = [card['art_id'] for card in queued]
+    if shown_art_id is not None:
+        # Показанный арт ещё не оценён и иначе снова попал бы в очередь
+        exclude_ids.append(shown_art_id)
+    if missing <= 0:
+        return
+    
+    cards = await db_read(prefetch_art_cards, user_id, hashtag_filter, missing, exclude_ids)
+    
+    with _feed_queues_lock:
+        if _feed_queue_generations[key] != generation:
+            return
+        queued = feed_queues.setdefault(key, deque())
+        present = {card['art_id'] for card in queued}
+        queued.extend(card for card in cards if card['art_id'] not in present)
+
+def schedule_feed_refill(user_id, hashtag_filter=None, shown_art_id=None):
+    """Запускает фоновое пополнение очереди, если в ней осталось мало карточек"""
+    key = _feed_queue_key(user_id, hashtag_filter)
+    with _feed_queues_lock:
+        if len(feed_queues.get(key) or ()) >= FEED_PREFETCH_LOW_WATER:
+            return
+    task = _feed_refill_tasks.get(key)
+    if task and not task.done():
+        return
+    
+    async def refill():
+        try:
+            await refill_feed_queue(user_id, hashtag_filter, shown_art_id)
+        except Exception as e:
+            logging.error(f"Ошибка при пополнении ленты пользователя {user_id}: {e}")
+        finally:
+            _feed_refill_tasks.pop(key, None)
+    
+    _feed_refill_tasks[key] = asyncio.create_task(refill())
+
+async def send_art_to_user(chat_id, context, user_id, art=None, update_message=None, hashtag_filter=None):
+    """Показывает арт пользователю"""
+    if art:
+        card = await db_read(build_art_card, user_id, art, hashtag_filter)
+    else:
+        card = pop_feed_card(user_id, hashtag_filter)
+        if card is None:
+            # Очередь пуста (первый показ или сброс) - заполняем её сразу
+            await refill_feed_queue(user_id, hashtag_filter)
+            card = pop_feed_card(user_id, hashtag_filter)
+        schedule_feed_refill(user_id, hashtag_filter, card['art_id'] if card else None)
+    
+    if card:
+        art_id = card['art_id']
+        file_id = card['file_id']
+        text = card['text']
+        reply_markup = card['reply_markup']
         try:
             if update_message:
                 await update_message.edit_media(
@@ -2444,7 +4758,7 @@ async def send_art_to_user(chat_id, context, user_id, art=None, update_message=N
                     caption=text,
                     reply_markup=reply_markup
                 )
-            add_active_message(message.message_id, chat_id, art_id, user_id)
+            await db_write(add_active_message, message.message_id, chat_id, art_id, user_id)
             return True
             
         except telegram.error.BadRequest as e:
@@ -2463,7 +4777,7 @@ async def send_art_to_user(chat_id, context, user_id, art=None, update_message=N
                     caption=text,
                     reply_markup=reply_markup
                 )
-                add_active_message(message.message_id, chat_id, art_id, user_id)
+                await db_write(add_active_message, message.message_id, chat_id, art_id, user_id)
                 return True
             else:
                 logging.error(f"Ошибка при отправке арта: {e}")
@@ -2474,7 +4788,7 @@ async def send_art_to_user(chat_id, context, user_id, art=None, update_message=N
                         caption=text,
                         reply_markup=reply_markup
                     )
-                    add_active_message(message.message_id, chat_id, art_id, user_id)
+                    await db_write(add_active_message, message.message_id, chat_id, art_id, user_id)
                     return True
                 except Exception as e2:
                     logging.error(f"Ошибка при повторной отправке арта: {e2}")
@@ -2529,7 +4843,7 @@ async def show_hashtag_search_results(update: Update, context: ContextTypes.DEFA
         chat_id = update.message.chat_id
 
     if search_query:
-        found_hashtags = search_hashtags(search_query)
+        found_hashtags = await find_hashtags(search_query)
         if found_hashtags:
             keyboard = []
             for hashtag_text, usage_count in found_hashtags:
@@ -2587,7 +4901,7 @@ async def show_search_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def show_user_gallery(update: Update, context: ContextTypes.DEFAULT_TYPE, gallery_user_id: int, is_my_gallery: bool = False):
     """Показывает галерею пользователя"""
     query = update.callback_query
-    stats, arts = get_user_arts(gallery_user_id)
+    stats, arts = await db_read(get_user_arts, gallery_user_id)
     
     if not arts:
         await query.answer("🎨 Галерея пуста", show_alert=True)
@@ -2611,7 +4925,7 @@ async def show_gallery_page(update: Update, context: ContextTypes.DEFAULT_TYPE,
         return
     
     art_id, file_id, caption, likes, dislikes, timestamp = arts[index]
-    hashtags = get_art_hashtags(art_id)
+    hashtags = await db_read(get_art_hashtags, art_id)
     gallery_text = f"🎨 **Галерея** ({index + 1}/{len(arts)})\n\n"
     if caption:
         gallery_text += f"{escape_markdown(caption)}\n\n"
@@ -2664,7 +4978,7 @@ async def show_deleted_arts_gallery(update: Update, context: ContextTypes.DEFAUL
     if 'deleted_arts_list' in context.user_data:
         deleted_arts = context.user_data.get('deleted_arts_list', [])
     else:
-        deleted_arts = get_deleted_arts(limit=100)
+        deleted_arts = await db_read(get_deleted_arts, limit=100)
         context.user_data['deleted_arts_list'] = deleted_arts
     
     if not deleted_arts:
@@ -2681,10 +4995,10 @@ async def show_deleted_arts_gallery(update: Update, context: ContextTypes.DEFAUL
         index = 0
     
     deleted_id, art_id, owner_id, file_id, caption, deleted_at, reason = deleted_arts[index]
-    owner_profile = get_user_profile(owner_id)
+    owner_profile = await db_read(get_user_profile, owner_id)
     is_owner_profile_public = owner_profile[5] if owner_profile else False
     
-    owner_name = get_display_name(owner_id, profile_is_public=is_owner_profile_public)
+    owner_name = await db_read(get_display_name, owner_id, profile_is_public=is_owner_profile_public)
     gallery_text = f"🗑️ **Удалённый арт** ({index + 1}/{len(deleted_arts)})\n\n"
     gallery_text += f"🎨 Арт #{art_id}\n"
     gallery_text += f"👤 Автор: {escape_markdown(owner_name)}\n"
@@ -2788,7 +5102,7 @@ async def show_other_user_profile(update: Update, context: ContextTypes.DEFAULT_
         if not query:
             return
             
-        profile = get_user_profile(user_id)
+        profile = await db_read(get_user_profile, user_id)
         
         if not profile:
             await query.answer("❌ Профиль не найден", show_alert=True)
@@ -2801,20 +5115,14 @@ async def show_other_user_profile(update: Update, context: ContextTypes.DEFAULT_
         if not is_public:
             await query.answer("❌ Этот профиль закрыт", show_alert=True)
             return
-        if has_profile_violations(user_id):
+        if await db_read(has_profile_violations, user_id):
             await query.answer("❌ Профиль недоступен", show_alert=True)
             return
-        followers_count = get_followers_count(user_id)
-        following_count = get_following_count(user_id)
-        art_count = get_user_art_count(user_id)
+        followers_count = await db_read(get_followers_count, user_id)
+        following_count = await db_read(get_following_count, user_id)
+        art_count = await db_read(get_user_art_count, user_id)
         
-        conn = sqlite3.connect('database.db')
-        cur = conn.cursor()
-        cur.execute('SELECT SUM(likes), SUM(dislikes) FROM arts WHERE owner_id = ?', (user_id,))
-        result = cur.fetchone()
-        total_likes = result[0] or 0
-        total_dislikes = result[1] or 0
-        conn.close()
+        total_likes, total_dislikes = await db_read(get_user_likes_totals, user_id)
         
         profile_text = f"👤 **Профиль**\n\n"
         
@@ -2833,7 +5141,7 @@ async def show_other_user_profile(update: Update, context: ContextTypes.DEFAULT_
         )
         
         current_user_id = query.from_user.id
-        is_following_user = is_following(current_user_id, user_id)
+        is_following_user = await db_read(is_following, current_user_id, user_id)
         follow_text = "✅ Отписаться" if is_following_user else "👤 Подписаться"
         follow_data = f"unfollow_{user_id}" if is_following_user else f"follow_{user_id}"
         
@@ -2875,7 +5183,7 @@ async def show_other_user_profile(update: Update, context: ContextTypes.DEFAULT_
 async def show_my_profile_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показывает мой профиль с аватаром и статистикой"""
     user_id = update.effective_user.id
-    profile = get_user_profile(user_id)
+    profile = await db_read(get_user_profile, user_id)
     
     if not profile:
         await update.message.reply_text("❌ Профиль не найден")
@@ -2884,17 +5192,11 @@ async def show_my_profile_settings(update: Update, context: ContextTypes.DEFAULT
     nickname = profile[2] or "Не указан"
     bio = profile[3] or "Не указано"
     avatar_file_id = profile[4]
-    followers_count = get_followers_count(user_id)
-    following_count = get_following_count(user_id)
-    art_count = get_user_art_count(user_id)
+    followers_count = await db_read(get_followers_count, user_id)
+    following_count = await db_read(get_following_count, user_id)
+    art_count = await db_read(get_user_art_count, user_id)
     
-    conn = sqlite3.connect('database.db')
-    cur = conn.cursor()
-    cur.execute('SELECT SUM(likes), SUM(dislikes) FROM arts WHERE owner_id = ?', (user_id,))
-    result = cur.fetchone()
-    total_likes = result[0] or 0
-    total_dislikes = result[1] or 0
-    conn.close()
+    total_likes, total_dislikes = await db_read(get_user_likes_totals, user_id)
     
     profile_text = f"👤 **Мой профиль**\n\n"
     
@@ -3060,17 +5362,7 @@ async def show_my_profile_settings_menu(update: Update, context: ContextTypes.DE
 async def show_followers(update: Update, context: ContextTypes.DEFAULT_TYPE, index: int = 0):
     """Показывает список подписчиков пользователя с возможностью пролистывания"""
     user_id = update.effective_user.id
-    conn = sqlite3.connect('database.db')
-    cur = conn.cursor()
-    cur.execute('''
-        SELECT u.user_id, u.username, u.nickname
-        FROM profile_followers pf
-        JOIN users u ON pf.follower_id = u.user_id
-        WHERE pf.following_id = ?
-        ORDER BY pf.timestamp DESC
-    ''', (user_id,))
-    followers = cur.fetchall()
-    conn.close()
+    followers = await db_read(get_followers, user_id)
     
     if not followers:
         keyboard = [[InlineKeyboardButton("🔙 В меню", callback_data='back_to_menu')]]
@@ -3096,7 +5388,7 @@ async def show_followers(update: Update, context: ContextTypes.DEFAULT_TYPE, ind
         index = len(followers) - 1
     
     follower_id, follower_username, follower_nickname = followers[index]
-    profile = get_user_profile(follower_id)
+    profile = await db_read(get_user_profile, follower_id)
     display_name = follower_nickname or follower_username or "Пользователь"
     
     text = (
@@ -3108,11 +5400,11 @@ async def show_followers(update: Update, context: ContextTypes.DEFAULT_TYPE, ind
         if bio and bio != "Не указано":
             text += f"📝 {escape_markdown(bio)}\n\n"
         
-        followers_count = get_followers_count(follower_id)
-        art_count = get_user_art_count(follower_id)
+        followers_count = await db_read(get_followers_count, follower_id)
+        art_count = await db_read(get_user_art_count, follower_id)
         text += f"👥 Подписчиков: {followers_count}\n"
         text += f"🎨 Артов: {art_count}\n"
-    is_following_flag = is_following(user_id, follower_id)
+    is_following_flag = await db_read(is_following, user_id, follower_id)
     nav_buttons = []
     if index > 0:
         nav_buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f'followers_prev_{index-1}'))
@@ -3215,7 +5507,7 @@ async def show_edit_privacy_menu(update: Update, context: ContextTypes.DEFAULT_T
     """Показывает меню приватности"""
     query = update.callback_query
     user_id = query.from_user.id
-    profile = get_user_profile(user_id)
+    profile = await db_read(get_user_profile, user_id)
     is_public = profile[5] if profile else True
     
     status_text = "🔓 ОТКРЫТ (все могут видеть профиль)" if is_public else "🔒 ЗАКРЫТ (профиль скрыт)"
@@ -3284,7 +5576,7 @@ async def show_top_arts(update: Update, context: ContextTypes.DEFAULT_TYPE, hash
     user_id = update.callback_query.from_user.id
     username = update.callback_query.from_user.username or update.callback_query.from_user.first_name
     
-    top_arts = get_top_arts_by_likes(5, hashtag_filter)
+    top_arts = await db_read(get_top_arts_by_likes, 5, hashtag_filter)
     
     if not top_arts:
         keyboard = [[InlineKeyboardButton("🔙 В меню", callback_data='back_to_menu')]]
@@ -3303,7 +5595,7 @@ async def show_top_arts(update: Update, context: ContextTypes.DEFAULT_TYPE, hash
         )
         return
     
-    user_rank = get_user_rank(user_id, hashtag_filter)
+    user_rank = await db_read(get_user_rank, user_id, hashtag_filter)
     
     context.user_data['top_arts'] = top_arts
     context.user_data['current_top_index'] = 0
@@ -3320,7 +5612,7 @@ async def show_top_artists(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     user_id = query.from_user.id if query else update.effective_user.id
     
-    top_artists = get_top_artists_by_followers(5)
+    top_artists = await db_read(get_top_artists_by_followers, 5)
     
     if not top_artists:
         keyboard = [[InlineKeyboardButton("🔙 В меню", callback_data='back_to_menu')]]
@@ -3367,7 +5659,7 @@ async def show_top_artist_page(update: Update, context: ContextTypes.DEFAULT_TYP
     avatar_file_id = artist[7] if len(artist) > 7 else None
     
     current_user_id = query.from_user.id if query else update.effective_user.id
-    is_following_flag = is_following(current_user_id, user_id_result)
+    is_following_flag = await db_read(is_following, current_user_id, user_id_result)
     
     display_name = nickname or username or "Пользователь"
     safe_name = escape_markdown(display_name)
@@ -3480,12 +5772,12 @@ async def show_top_art_page(update: Update, context: ContextTypes.DEFAULT_TYPE,
     
     art_id, file_id, caption, likes, dislikes, owner_id = top_arts[index]
 
-    owner_profile = get_user_profile(owner_id)
+    owner_profile = await db_read(get_user_profile, owner_id)
     is_owner_profile_public = owner_profile[5] if owner_profile else False
     
-    owner_display_name = get_display_name(owner_id, for_moderator=False, profile_is_public=is_owner_profile_public)
+    owner_display_name = await db_read(get_display_name, owner_id, for_moderator=False, profile_is_public=is_owner_profile_public)
     
-    hashtags = get_art_hashtags(art_id)
+    hashtags = await db_read(get_art_hashtags, art_id)
     hashtags_text = " ".join(hashtags) if hashtags else ""
     
     safe_owner_display_name = escape_markdown(owner_display_name)
@@ -3535,7 +5827,7 @@ async def show_top_art_page(update: Update, context: ContextTypes.DEFAULT_TYPE,
     current_user_id = query.from_user.id if query else update.effective_user.id
     
     if current_user_id and owner_id != current_user_id:
-        owner_profile = get_user_profile(owner_id)
+        owner_profile = await db_read(get_user_profile, owner_id)
         if owner_profile and owner_profile[5]:
             keyboard.append([
                 InlineKeyboardButton("👤 Профиль автора", callback_data=f'view_profile_{owner_id}'),
@@ -3593,17 +5885,18 @@ async def show_complaint_reasons(update: Update, context: ContextTypes.DEFAULT_T
         parse_mode='Markdown'
     )
 
+@in_background_lane
 async def send_complaint_to_support(context, art_id, reporter_id, reason, comment, reporter_username):
-    art = get_art_by_id(art_id)
+    art = await db_read(get_art_by_id, art_id)
     if not art:
         return False
     
-    art_owner_id = get_art_owner(art_id)
+    art_owner_id = await db_read(get_art_owner, art_id)
     
-    owner_display_name = get_display_name(art_owner_id, for_moderator=True)
-    reporter_display_name = get_display_name(reporter_id, for_moderator=True)
+    owner_display_name = await db_read(get_display_name, art_owner_id, for_moderator=True)
+    reporter_display_name = await db_read(get_display_name, reporter_id, for_moderator=True)
     
-    hashtags = get_art_hashtags(art_id) 
+    hashtags = await db_read(get_art_hashtags, art_id) 
     hashtags_text = " ".join(hashtags) if hashtags else "Нет хэштегов"
     safe_owner_name = escape_markdown(owner_display_name)
     safe_reporter_name = escape_markdown(reporter_display_name)
@@ -3647,25 +5940,19 @@ async def send_complaint_to_support(context, art_id, reporter_id, reason, commen
     
 async def send_profile_complaint_to_support(context, profile_user_id, reporter_id, reason, reporter_username):
     """Отправляет жалобу на профиль модераторам с возможностью блокировки"""
-    profile = get_user_profile(profile_user_id)
+    profile = await db_read(get_user_profile, profile_user_id)
     if not profile:
         return False
     
     nickname = profile[2] or "Не указан"
     username = profile[1] or "Не указан"
     avatar_file_id = profile[4]
-    followers_count = get_followers_count(profile_user_id)
-    art_count = get_user_art_count(profile_user_id)
+    followers_count = await db_read(get_followers_count, profile_user_id)
+    art_count = await db_read(get_user_art_count, profile_user_id)
     
-    conn = sqlite3.connect('database.db')
-    cur = conn.cursor()
-    cur.execute('SELECT SUM(likes), SUM(dislikes) FROM arts WHERE owner_id = ?', (profile_user_id,))
-    result = cur.fetchone()
-    total_likes = result[0] or 0
-    total_dislikes = result[1] or 0
-    conn.close()
+    total_likes, total_dislikes = await db_read(get_user_likes_totals, profile_user_id)
     
-    reporter_display_name = get_display_name(reporter_id, for_moderator=True)
+    reporter_display_name = await db_read(get_display_name, reporter_id, for_moderator=True)
     
     safe_nickname = escape_markdown(nickname)
     safe_username = escape_markdown(username)
@@ -3720,7 +6007,7 @@ async def send_profile_complaint_to_support(context, profile_user_id, reporter_i
 async def show_blocked_user_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показывает меню для заблокированного пользователя"""
     user = update.effective_user
-    block_info = get_user_block_status(user.id)
+    block_info = await db_read(get_user_block_status, user.id)
     
     if not block_info:
         return
@@ -3734,17 +6021,7 @@ async def show_blocked_user_menu(update: Update, context: ContextTypes.DEFAULT_T
     )
     
     # Получаем информацию об апелляции
-    conn = sqlite3.connect('database.db')
-    cur = conn.cursor()
-    cur.execute('''
-        SELECT appeal_id, reason, status, submitted_at 
-        FROM appeals 
-        WHERE user_id = ? 
-        ORDER BY submitted_at DESC 
-        LIMIT 1
-    ''', (user.id,))
-    appeal_info = cur.fetchone()
-    conn.close()
+    appeal_info = await db_read(get_latest_appeal, user.id)
     
     if appeal_info:
         appeal_id, appeal_reason, appeal_status_db, submitted_at = appeal_info
@@ -3791,17 +6068,7 @@ async def show_my_appeal(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     
     # Получаем последнюю апелляцию
-    conn = sqlite3.connect('database.db')
-    cur = conn.cursor()
-    cur.execute('''
-        SELECT appeal_id, reason, status, submitted_at 
-        FROM appeals 
-        WHERE user_id = ? 
-        ORDER BY submitted_at DESC 
-        LIMIT 1
-    ''', (user.id,))
-    appeal_info = cur.fetchone()
-    conn.close()
+    appeal_info = await db_read(get_latest_appeal, user.id)
     
     if not appeal_info:
         await update.callback_query.answer("❌ Апелляция не найдена", show_alert=True)
@@ -3859,12 +6126,12 @@ async def show_my_appeal(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    add_user(user.id, user.username)
+    await db_write(add_user, user.id, user.username)
     
     context.user_data.clear()
     
     # Проверяем блокировку пользователя
-    if is_user_blocked(user.id):
+    if await db_read(is_user_blocked, user.id):
         # Показываем меню для заблокированного пользователя
         await show_blocked_user_menu(update, context)
         return
@@ -3912,7 +6179,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     data = query.data
     
     if data == 'upload_art':
-        art_count = get_user_art_count(user_id)
+        art_count = await db_read(get_user_art_count, user_id)
         if art_count >= MAX_ARTS_PER_USER:
             await query.edit_message_text(
                 f"❌ Лимит артов достигнут!\n\n"
@@ -3935,10 +6202,10 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif data.startswith('view_art_'):
         try:
             art_id = int(data.split('_')[2])
-            art = get_art_by_id(art_id)
+            art = await db_read(get_art_by_id, art_id)
             if art:
                 art_id, file_id, caption, likes, dislikes = art
-                hashtags = get_art_hashtags(art_id)
+                hashtags = await db_read(get_art_hashtags, art_id)
                 hashtags_text = " ".join(hashtags) if hashtags else ""
                 
                 text = f"📊 **Статистика вашего арта:**\n❤️ Лайков: {likes} | 👎 Дизлайков: {dislikes}"
@@ -3987,6 +6254,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif data.startswith('filter_'):
         hashtag = data.replace('filter_', '')
         context.user_data['current_hashtag_filter'] = hashtag
+        invalidate_feed_queues(user_id=user_id)
         
         context.user_data['last_art_message'] = query.message
         success = await send_art_to_user(query.message.chat_id, context, user_id, update_message=None, hashtag_filter=hashtag)
@@ -4041,7 +6309,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif data.startswith('follow_'):
         try:
             following_id = int(data.split('_')[1])
-            success, message = follow_user(user_id, following_id)
+            success, message = await db_write(follow_user, user_id, following_id)
             if success:
                 await query.answer(message, show_alert=True)
                 await notify_about_follower(context, following_id)
@@ -4055,7 +6323,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif data.startswith('unfollow_'):
         try:
             following_id = int(data.split('_')[1])
-            success, message = unfollow_user(user_id, following_id)
+            success, message = await db_write(unfollow_user, user_id, following_id)
             if success:
                 await query.answer(message, show_alert=True)
                 await show_other_user_profile(update, context, following_id)
@@ -4100,22 +6368,17 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             art_id = int(data.split('_')[2])
             user_id = query.from_user.id
             
-            conn = sqlite3.connect('database.db')
-            cur = conn.cursor()
-            cur.execute('SELECT owner_id FROM arts WHERE art_id = ?', (art_id,))
-            result = cur.fetchone()
-            conn.close()
+            owner_id = await db_read(get_art_owner, art_id)
             
-            if not result:
+            if not owner_id:
                 await query.answer("❌ Арт не найден", show_alert=True)
                 return
             
-            owner_id = result[0]
             if owner_id != user_id:
                 await query.answer("❌ Вы не можете удалить чужой арт", show_alert=True)
                 return
             
-            delete_result = delete_art_by_id(art_id)
+            delete_result = await db_write(delete_art_by_id, art_id)
             success = delete_result[0]
             message = delete_result[1]
             
@@ -4282,7 +6545,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await show_edit_profile_options(update, context)
     
     elif data == 'toggle_profile_privacy':
-        success, message = toggle_profile_privacy(user_id)
+        success, message = await db_write(toggle_profile_privacy, user_id)
         if success:
             await query.answer(message, show_alert=True)
             await show_edit_privacy_menu(update, context)
@@ -4337,10 +6600,10 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
     
     elif data == 'toggle_privacy':
-        current_settings = get_privacy_settings(user_id)
+        current_settings = await db_read(get_privacy_settings, user_id)
         new_hide_username = not current_settings['hide_username']
         
-        set_privacy_settings(user_id, hide_username=new_hide_username)
+        await db_write(set_privacy_settings, user_id, hide_username=new_hide_username)
         
         await show_edit_privacy_menu(update, context)
         
@@ -4460,7 +6723,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 elif top_type == 'followers':
                     await show_top_artist_page(update, context, context.user_data.get('current_top_index', 0))
                 else:
-                    art = get_art_by_id(art_id)
+                    art = await db_read(get_art_by_id, art_id)
                     if art:
                         current_hashtag = context.user_data.get('current_hashtag_filter')
                         await send_art_to_user(query.message.chat_id, context, user_id, art=art, update_message=None, hashtag_filter=current_hashtag)
@@ -4498,16 +6761,16 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if query.from_user.id not in SUPPORT_USER_IDS:
                 await query.answer("❌ У вас нет прав для удаления артов!", show_alert=True)
                 return
-            art_info = get_art_by_id(art_id)
+            art_info = await db_read(get_art_by_id, art_id)
             if not art_info:
                 await query.answer("❌ Арт не найден!", show_alert=True)
                 return
                 
-            owner_id = get_art_owner(art_id)
+            owner_id = await db_read(get_art_owner, art_id)
             file_id = art_info[1] if art_info else None
             caption = art_info[2] if art_info else None
             
-            success, message = delete_art_by_id(art_id)
+            success, message = await db_write(delete_art_by_id, art_id)
             
             if success:
                 await query.answer("✅ Арт удален!", show_alert=True)
@@ -4545,9 +6808,9 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await query.answer("❌ У вас нет прав для просмотра жалоб!", show_alert=True)
                 return
             
-            art = get_art_by_id(art_id)
+            art = await db_read(get_art_by_id, art_id)
             if art:
-                hashtags = get_art_hashtags(art_id)
+                hashtags = await db_read(get_art_hashtags, art_id)
                 hashtags_text = " ".join(hashtags) if hashtags else ""
                 
                 art_text = f"🖼️ **Арт #{art_id}**\n\nЛайков: {art[3]} | Дизлайков: {art[4]}"
@@ -4574,7 +6837,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await query.answer("❌ У вас нет прав для блокировки профилей!", show_alert=True)
                 return
             
-            success, message = block_user(profile_user_id, "Блокировка модератором за жалобы", query.from_user.id)
+            success, message = await db_write(block_user, profile_user_id, "Блокировка модератором за жалобы", query.from_user.id)
             
             if success:
                 await query.answer("✅ Профиль заблокирован!", show_alert=True)
@@ -4635,7 +6898,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif data.startswith('deleted_arts_next_'):
         try:
             index = int(data.split('_')[3])
-            deleted_arts = get_deleted_arts(limit=100)
+            deleted_arts = await db_read(get_deleted_arts, limit=100)
             context.user_data['deleted_arts_list'] = deleted_arts
             await show_deleted_arts_gallery(update, context, index)
         except (IndexError, ValueError) as e:
@@ -4647,7 +6910,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             index = int(data.split('_')[3])
             if index < 0:
                 index = 0
-            deleted_arts = get_deleted_arts(limit=100)
+            deleted_arts = await db_read(get_deleted_arts, limit=100)
             context.user_data['deleted_arts_list'] = deleted_arts
             await show_deleted_arts_gallery(update, context, index)
         except (IndexError, ValueError) as e:
@@ -4692,11 +6955,11 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await query.answer("❌ У вас нет прав!", show_alert=True)
                 return
         
-            success, message = restore_deleted_art(art_id)
+            success, message = await db_write(restore_deleted_art, art_id)
             await query.answer(message, show_alert=True)
         
             if success:
-                deleted_arts = get_deleted_arts(limit=100)
+                deleted_arts = await db_read(get_deleted_arts, limit=100)
                 context.user_data['deleted_arts_list'] = deleted_arts
             
                 if deleted_arts:
@@ -4720,28 +6983,16 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await query.answer("❌ У вас нет прав!", show_alert=True)
                 return
             
-            conn = sqlite3.connect('database.db')
-            cur = conn.cursor()
-            cur.execute('SELECT user_id FROM appeals WHERE appeal_id = ?', (appeal_id,))
-            result = cur.fetchone()
-            conn.close()
+            blocked_user_id = await db_read(get_appeal_user_id, appeal_id)
             
-            if not result:
+            if not blocked_user_id:
                 await query.answer("❌ Апелляция не найдена", show_alert=True)
                 return
             
-            blocked_user_id = result[0]
-            success, message = unblock_user(blocked_user_id)
+            success, message = await db_write(unblock_user, blocked_user_id)
             
             if success:
-                conn = sqlite3.connect('database.db')
-                cur = conn.cursor()
-                cur.execute(''' 
-                    UPDATE appeals SET status = 'approved', decided_by = ?, decided_at = CURRENT_TIMESTAMP
-                    WHERE appeal_id = ?
-                ''', (query.from_user.id, appeal_id))
-                conn.commit()
-                conn.close()
+                await db_write(set_appeal_decision, appeal_id, 'approved', query.from_user.id)
                 
                 await query.answer("✅ Апелляция одобрена!", show_alert=True)
                 
@@ -4772,20 +7023,10 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if query.from_user.id not in SUPPORT_USER_IDS:
                 await query.answer("❌ У вас нет прав!", show_alert=True)
                 return
-            conn = sqlite3.connect('database.db')
-            cur = conn.cursor()
-            cur.execute('SELECT user_id FROM appeals WHERE appeal_id = ?', (appeal_id,))
-            result = cur.fetchone()
+            blocked_user_id = await db_read(get_appeal_user_id, appeal_id)
             
-            if result:
-                blocked_user_id = result[0]
-                cur.execute('''
-                    UPDATE appeals SET status = 'rejected', decided_by = ?, decided_at = CURRENT_TIMESTAMP
-                    WHERE appeal_id = ?
-                ''', (query.from_user.id, appeal_id))
-            
-            conn.commit()
-            conn.close()
+            if blocked_user_id:
+                await db_write(set_appeal_decision, appeal_id, 'rejected', query.from_user.id)
             
             await query.answer("✅ Апелляция отклонена!", show_alert=True)
             
@@ -4793,7 +7034,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await query.edit_message_text("✅ Апелляция отклонена!")
             except:
                 pass
-            if result:
+            if blocked_user_id:
                 try:
                     await context.bot.send_message(
                         chat_id=blocked_user_id,
@@ -4859,7 +7100,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     elif data.startswith('delete_art_'):
         art_number = int(data.split('_')[-1])
-        success, message = delete_art(user_id, art_number)
+        success, message = await db_write(delete_art, user_id, art_number)
         
         if success:
             await query.answer(message, show_alert=True)
@@ -4871,26 +7112,25 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         art_id = int(data.split('_')[1])
         reaction_type = 'like' if data.startswith('like_') else 'dislike'
 
-        conn = sqlite3.connect('database.db')
-        cur = conn.cursor()
-        cur.execute('SELECT * FROM reactions WHERE user_id = ? AND art_id = ?', (user_id, art_id))
-        existing_reaction = cur.fetchone()
-        conn.close()
+        existing_reaction = await db_read(get_user_reaction, user_id, art_id)
 
         if existing_reaction:
             await query.answer("Вы уже оценили этот арт! ❌", show_alert=True)
         else:
-            add_reaction(user_id, art_id, reaction_type)
+            await db_write(add_reaction, user_id, art_id, reaction_type)
+            # Арт мог быть оценён не из ленты (топ, профиль) и остаться в очереди карточек
+            invalidate_feed_queues(user_id=user_id, art_id=art_id)
             logging.info(f"Пользователь {user_id} поставил {reaction_type} арту {art_id}")
             if reaction_type == 'like':
-                owner_id = get_art_owner(art_id)
+                owner_id = await db_read(get_art_owner, art_id)
                 if owner_id:
                     logging.info(f"Владелец арта {art_id}: {owner_id}. Отправка уведомления о лайке.")
-                    await create_or_update_reaction_notification(context, owner_id)
+                    with background_lane():
+                        await create_or_update_reaction_notification(context, owner_id)
 
             reaction_text = "❤️ Лайк" if reaction_type == 'like' else "👎 Дизлайк"
             await query.answer(f"{reaction_text} засчитан! ✅")
-            await update_art_message_realtime(context, art_id)
+            schedule_art_message_refresh(context, art_id)
             current_hashtag = context.user_data.get('current_hashtag_filter')
             await send_art_to_user(query.message.chat_id, context, user_id, update_message=None, hashtag_filter=current_hashtag)
     
@@ -5001,49 +7241,22 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     if not user:
         return 
-    add_user(user.id, user.username)
+    await db_write(add_user, user.id, user.username)
 
     user_id = user.id
     text = (update.message.text or "").strip()
     
     # Проверяем, не заблокирован ли пользователь - если заблокирован, его сообщение считается апилкой
-    if is_user_blocked(user_id):
+    if await db_read(is_user_blocked, user_id):
         # Если заблокированный пользователь пишет что-либо, это считается апелляцией
         if text and text != "/start" and text != "🔙 В меню":
-            # Проверяем, есть ли уже апелляция в статусе pending
-            conn = sqlite3.connect('database.db')
-            cur = conn.cursor()
-            cur.execute('''
-                SELECT appeal_id, status FROM appeals 
-                WHERE user_id = ? 
-                ORDER BY submitted_at DESC 
-                LIMIT 1
-            ''', (user_id,))
-            appeal_info = cur.fetchone()
-            
-            if appeal_info and appeal_info[1] == 'pending':
-                # Обновляем существующую апелляцию
-                cur.execute('''
-                    UPDATE appeals 
-                    SET reason = ?, submitted_at = CURRENT_TIMESTAMP
-                    WHERE user_id = ? AND status = 'pending'
-                ''', (text, user_id))
-                conn.commit()
-                conn.close()
-                
+            # Если есть апелляция в статусе pending - обновляем ее, иначе создаём новую
+            if await db_write(save_blocked_user_appeal, user_id, text):
                 await update.message.reply_text(
                     "✅ Ваша апелляция обновлена! Модераторы рассмотрят новую информацию.",
                     reply_markup=get_persistent_menu()
                 )
             else:
-                # Создаём новую апелляцию
-                cur.execute('''
-                    INSERT INTO appeals (user_id, reason, submitted_at, status)
-                    VALUES (?, ?, CURRENT_TIMESTAMP, 'pending')
-                ''', (user_id, text))
-                conn.commit()
-                conn.close()
-                
                 await update.message.reply_text(
                     "✅ Апелляция отправлена модераторам! Они рассмотрят вашу просьбу в течение 24 часов.",
                     reply_markup=get_persistent_menu()
@@ -5083,7 +7296,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             comment = "Без комментария"
             username = update.effective_user.username or update.effective_user.first_name
             
-            add_complaint(art_id, user_id, reason, comment)
+            await db_write(add_complaint, art_id, user_id, reason, comment)
             
             success = await send_complaint_to_support(context, art_id, user_id, reason, comment, username)
             
@@ -5113,7 +7326,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
         return
     if context.user_data.get('waiting_for_nickname_edit'):
-        success, message = update_user_nickname(user_id, text)
+        success, message = await db_write(update_user_nickname, user_id, text)
         context.user_data['waiting_for_nickname_edit'] = False
         
         if success:
@@ -5134,7 +7347,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text(message)
         return
     if context.user_data.get('waiting_for_bio_edit'):
-        success, message = update_user_bio(user_id, text)
+        success, message = await db_write(update_user_bio, user_id, text)
         context.user_data['waiting_for_bio_edit'] = False
         
         if success:
@@ -5156,7 +7369,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     if context.user_data.get('waiting_for_profile_search'):
         context.user_data['waiting_for_profile_search'] = False
-        results = search_users_by_nickname(text, limit=10)
+        results = await db_read(search_users_by_nickname, text, limit=10)
         
         if not results:
             keyboard = [
@@ -5196,97 +7409,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if context.user_data.get('waiting_for_art'):
         if update.message.photo:
-            checking_msg = await update.message.reply_text("🔍 Проверяем изображение на безопасность...")
-            
-            file_id = update.message.photo[-1].file_id
-            caption = update.message.caption or ""
-            
-            try:
-                photo_file = await update.message.photo[-1].get_file()
-                photo_bytes = await photo_file.download_as_bytearray()
-                image = Image.open(BytesIO(photo_bytes))
-                
-                basic_safe, basic_message = await validate_image_basic(image)
-                if not basic_safe:
-                    hashtags = extract_hashtags(caption)
-                    clean_caption = re.sub(r'#\w+', '', caption).strip()
-                    pending_id = add_pending_art(user_id, file_id, clean_caption, hashtags)
-                    
-                    keyboard = [
-                        [InlineKeyboardButton("📞 Отправить в поддержку", callback_data=f'send_to_support_{pending_id}')],
-                        [InlineKeyboardButton("🔙 В меню", callback_data='back_to_menu')]
-                    ]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    
-                    await checking_msg.edit_text(
-                        f"{basic_message}\n\n",
-                        reply_markup=reply_markup
-                    )
-                    context.user_data['waiting_for_art'] = False
-                    return
-                
-                is_safe, safety_message = await is_image_safe(image)
-                
-                if not is_safe:
-                    hashtags = extract_hashtags(caption)
-                    clean_caption = re.sub(r'#\w+', '', caption).strip()
-                    pending_id = add_pending_art(user_id, file_id, clean_caption, hashtags)
-                    
-                    keyboard = [
-                        [InlineKeyboardButton("📞 Отправить в поддержку", callback_data=f'send_to_support_{pending_id}')],
-                        [InlineKeyboardButton("🔙 В меню", callback_data='back_to_menu')]
-                    ]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    
-                    await checking_msg.edit_text(
-                        f"{safety_message}",
-                        reply_markup=reply_markup
-                    )
-                    context.user_data['waiting_for_art'] = False
-                    return
-                
-                await checking_msg.edit_text("✅ Изображение безопасно! Добавляем в галерею...")
-                
-            except Exception as e:
-                logging.error(f"Ошибка при проверке изображения: {e}")
-                await checking_msg.edit_text("❌ Ошибка при проверке изображения. Попробуйте еще раз.")
-                return
-            
-            hashtags = extract_hashtags(caption)
-            clean_caption = re.sub(r'#\w+', '', caption).strip()
-            
-            art_id, message = add_art(user_id, file_id, clean_caption, hashtags)
-            
-            if art_id:
-                context.user_data['waiting_for_art'] = False
-                
-                art_count = get_user_art_count(user_id)
-                can_upload_more = art_count < MAX_ARTS_PER_USER
-                
-                hashtags_info = ""
-                if hashtags:
-                    hashtags_info = f"\n🏷️ **Добавленные хэштеги:** {', '.join(hashtags)}"
-                else:
-                    hashtags_info = "\nℹ️ Хэштеги не добавлены. Вы можете добавить их в подпись к фото."
-                
-                keyboard = []
-                if can_upload_more:
-                    keyboard.append([InlineKeyboardButton("📤 Загрузить ещё арт", callback_data='upload_art')])
-                keyboard.append([InlineKeyboardButton("🔙 В главное меню", callback_data='back_to_menu')])
-                
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                await checking_msg.edit_text(
-                    "✅ Твой арт успешно добавлен! "
-                    "Теперь другие пользователи смогут его оценить!" +
-                    hashtags_info +
-                    (f"\n\n🎨 У вас {art_count}/{MAX_ARTS_PER_USER} артов" if can_upload_more else ""),
-                    reply_markup=reply_markup,
-                    parse_mode='Markdown'
-                )
-            else:
-                await checking_msg.edit_text(f"❌ Ошибка: {message}")
-                context.user_data['waiting_for_art'] = False
+            status_msg = await update.message.reply_text(UPLOAD_STAGE_TEXTS['queued'])
+            await enqueue_upload_job(context.bot, user_id, status_msg, update.message.photo, update.message.caption or "")
+            context.user_data['waiting_for_art'] = False
         else:
             await update.message.reply_text(
                 "❌ Пожалуйста, отправьте изображение с подписью или без."
@@ -5300,7 +7425,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             comment = text
             username = update.effective_user.username or update.effective_user.first_name
             
-            add_complaint(art_id, user_id, reason, comment)
+            await db_write(add_complaint, art_id, user_id, reason, comment)
             
             success = await send_complaint_to_support(context, art_id, user_id, reason, comment, username)
             
@@ -5338,17 +7463,18 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         art_id = context.user_data.get('comment_art_id')
         
         if art_id and text:
-            success, message = add_comment(user_id, art_id, text)
+            success, message = await db_write(add_comment, user_id, art_id, text)
             
             if success:
                 await update.message.reply_text(
                     "✅ Комментарий успешно добавлен! 💬"
                 )
                 
-                owner_id = get_art_owner(art_id)
+                owner_id = await db_read(get_art_owner, art_id)
                 if owner_id:
                     logging.info(f"Владелец арта {art_id}: {owner_id}. Отправка уведомления о комментарии.")
-                    await create_or_update_reaction_notification(context, owner_id)
+                    with background_lane():
+                        await create_or_update_reaction_notification(context, owner_id)
             else:
                 await update.message.reply_text(
                     f"❌ Ошибка: {message}"
@@ -5409,11 +7535,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             file_id = update.message.photo[-1].file_id
             
             try:
-                photo_file = await update.message.photo[-1].get_file()
-                photo_bytes = await photo_file.download_as_bytearray()
-                image = Image.open(BytesIO(photo_bytes))
-                
-                is_safe, safety_message = await is_image_safe(image)
+                _, is_safe, safety_message = await moderate_photo(update.message.photo, check_basic=False)
                 
                 if not is_safe:
                     await checking_msg.edit_text(
@@ -5425,7 +7547,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 
                 await checking_msg.edit_text("✅ Изображение безопасно! Обновляем аватар...")
                 
-                success, message = update_user_profile_avatar(user_id, file_id)
+                success, message = await db_write(update_user_profile_avatar, user_id, file_id)
                 
                 if success:
                     await checking_msg.edit_text(
@@ -5447,7 +7569,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
     
     elif context.user_data.get('waiting_for_appeal'):
-        success, message = submit_appeal(user_id, text)
+        success, message = await db_write(submit_appeal, user_id, text)
         
         if success:
             await update.message.reply_text(
@@ -5463,24 +7585,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data['waiting_for_appeal'] = False
     
     elif context.user_data.get('waiting_for_appeal_edit'):
-        conn = sqlite3.connect('database.db')
-        cur = conn.cursor()
-        cur.execute('''
-            SELECT appeal_id FROM appeals 
-            WHERE user_id = ? AND status = 'pending'
-            ORDER BY submitted_at DESC 
-            LIMIT 1
-        ''', (user_id,))
-        appeal_info = cur.fetchone()
-        
-        if appeal_info:
-            appeal_id = appeal_info[0]
-            cur.execute('''
-                UPDATE appeals 
-                SET reason = ?, submitted_at = CURRENT_TIMESTAMP
-                WHERE appeal_id = ?
-            ''', (text, appeal_id))
-            conn.commit()
+        if await db_write(update_pending_appeal, user_id, text):
             await update.message.reply_text(
                 "✅ Ваша апелляция обновлена! Модераторы рассмотрят новую информацию.",
                 reply_markup=get_persistent_menu()
@@ -5491,7 +7596,6 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 reply_markup=get_persistent_menu()
             )
         
-        conn.close()
         context.user_data['waiting_for_appeal_edit'] = False
 
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -5503,24 +7607,18 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         file_id = update.message.photo[-1].file_id
         
         try:
-            photo_file = await update.message.photo[-1].get_file()
-            photo_bytes = await photo_file.download_as_bytearray()
-            image = Image.open(BytesIO(photo_bytes))
-            
-            basic_safe, basic_message = await validate_image_basic(image)
+            basic_safe, is_safe, safety_message = await moderate_photo(update.message.photo)
             if not basic_safe:
-                await checking_msg.edit_text("❌ Аватар не прошел проверку размера\n\n" + basic_message)
+                await checking_msg.edit_text("❌ Аватар не прошел проверку размера\n\n" + safety_message)
                 context.user_data['waiting_for_avatar_edit'] = False
                 return
             
-            is_safe, safety_message = await is_image_safe(image)
-            
             if not is_safe:
                 await checking_msg.edit_text("❌ Аватар содержит запрещенный контент\n\n" + safety_message)
                 context.user_data['waiting_for_avatar_edit'] = False
-                add_profile_violation(user_id, 'avatar', safety_message)
+                await db_write(add_profile_violation, user_id, 'avatar', safety_message)
                 return
-            success, message = update_user_profile_avatar(user_id, file_id)
+            success, message = await db_write(update_user_profile_avatar, user_id, file_id)
             
             await checking_msg.edit_text("✅ Аватар профиля успешно обновлен!")
             context.user_data['waiting_for_avatar_edit'] = False
@@ -5535,100 +7633,235 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     if context.user_data.get('waiting_for_art'):
-        checking_msg = await update.message.reply_text("🔍 Проверяем изображение на безопасность...")
-        
-        file_id = update.message.photo[-1].file_id
-        caption = update.message.caption or ""
-        
-        try:
-            photo_file = await update.message.photo[-1].get_file()
-            photo_bytes = await photo_file.download_as_bytearray()
-            image = Image.open(BytesIO(photo_bytes))
-            
-            basic_safe, basic_message = await validate_image_basic(image)
-            if not basic_safe:
-                hashtags = extract_hashtags(caption)
-                clean_caption = re.sub(r'#\w+', '', caption).strip()
-                pending_id = add_pending_art(user_id, file_id, clean_caption, hashtags)
-                
-                keyboard = [
-                    [InlineKeyboardButton("📞 Отправить в поддержку", callback_data=f'send_to_support_{pending_id}')],
-                    [InlineKeyboardButton("🔙 В меню", callback_data='back_to_menu')]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                await checking_msg.edit_text(
-                    f"{basic_message}\n\n",
-                    reply_markup=reply_markup
-                )
-                context.user_data['waiting_for_art'] = False
-                return
-            
-            is_safe, safety_message = await is_image_safe(image)
-            
-            if not is_safe:
-                hashtags = extract_hashtags(caption)
-                clean_caption = re.sub(r'#\w+', '', caption).strip()
-                pending_id = add_pending_art(user_id, file_id, clean_caption, hashtags)
-                
-                keyboard = [
-                    [InlineKeyboardButton("📞 Отправить в поддержку", callback_data=f'send_to_support_{pending_id}')],
-                    [InlineKeyboardButton("🔙 В меню", callback_data='back_to_menu')]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                await checking_msg.edit_text(
-                    f"{safety_message}",
-                    reply_markup=reply_markup
-                )
-                context.user_data['waiting_for_art'] = False
-                return
-            
-            await checking_msg.edit_text("✅ Изображение безопасно! Добавляем в галерею...")
-            
-        except Exception as e:
-            logging.error(f"Ошибка при проверке изображения: {e}")
-            await checking_msg.edit_text("❌ Ошибка при проверке изображения. Попробуйте еще раз.")
-            return
-        
-        hashtags = extract_hashtags(caption)
-        clean_caption = re.sub(r'#\w+', '', caption).strip()
-        
-        art_id, message = add_art(user_id, file_id, clean_caption, hashtags)
+        status_msg = await update.message.reply_text(UPLOAD_STAGE_TEXTS['queued'])
+        await enqueue_upload_job(context.bot, user_id, status_msg, update.message.photo, update.message.caption or "")
+        context.user_data['waiting_for_art'] = False
+
+# ========== КОНВЕЙЕР ЗАГРУЗКИ АРТОВ ==========
+# Обработчик сообщения только записывает задание в upload_jobs и сразу отвечает.
+# Задание проходит стадии queued -> downloaded -> validated -> classified ->
+# published / pending (или failed), и воркер после каждой стадии правит
+# статусное сообщение. Незавершённые задания перезапускаются при старте бота;
+# вердикт к этому моменту обычно уже в кэше, поэтому повтор дешёвый.
+
+UPLOAD_WORKERS = 4
+UPLOAD_JOB_MAX_ATTEMPTS = 3  # запусков задания, включая перезапуски после рестарта
+UPLOAD_JOB_FINAL_STAGES = ('published', 'pending', 'failed')
+UPLOAD_STAGE_TEXTS = {
+    'queued': "📥 Арт получен и ждёт проверки...",
+    'downloaded': "🔍 Проверяем изображение на безопасность...",
+    'validated': "🔍 Базовая проверка пройдена, проверяем содержимое...",
+}
+_upload_queue = None
+_upload_worker_tasks = []
+upload_stage_stats = {}  # стадия -> {'count': ..., 'total_ms': ...}, время от предыдущей стадии
+
+def create_upload_job(user_id, chat_id, status_message_id, photos, caption):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('''
+        INSERT INTO upload_jobs (user_id, chat_id, status_message_id, photos, caption, stage_timings)
+        VALUES (?, ?, ?, ?, ?, '{}')
+    ''', (user_id, chat_id, status_message_id, photos, caption))
+    job_id = cur.lastrowid
+    conn.commit()
+    conn.close()
+    return job_id
+
+def get_upload_job(job_id):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT job_id, user_id, chat_id, status_message_id, photos, caption, stage, attempts, stage_timings
+        FROM upload_jobs WHERE job_id = ?
+    ''', (job_id,))
+    row = cur.fetchone()
+    conn.close()
+    if row is None:
+        return None
+    return dict(zip(('job_id', 'user_id', 'chat_id', 'status_message_id', 'photos', 'caption',
+                     'stage', 'attempts', 'stage_timings'), row))
+
+def start_upload_job_attempt(job_id):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('UPDATE upload_jobs SET attempts = attempts + 1 WHERE job_id = ?', (job_id,))
+    cur.execute('SELECT attempts FROM upload_jobs WHERE job_id = ?', (job_id,))
+    attempts = cur.fetchone()[0]
+    conn.commit()
+    conn.close()
+    return attempts
+
+def set_upload_job_stage(job_id, stage, stage_timings, error=None):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('''
+        UPDATE upload_jobs SET stage = ?, stage_timings = ?, error = COALESCE(?, error), updated_at = CURRENT_TIMESTAMP
+        WHERE job_id = ?
+    ''', (stage, json.dumps(stage_timings), error, job_id))
+    conn.commit()
+    conn.close()
+
+def get_unfinished_upload_jobs():
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute(f'''
+        SELECT job_id FROM upload_jobs
+        WHERE stage NOT IN ({', '.join('?' * len(UPLOAD_JOB_FINAL_STAGES))})
+        ORDER BY job_id
+    ''', UPLOAD_JOB_FINAL_STAGES)
+    job_ids = [row[0] for row in cur.fetchall()]
+    conn.close()
+    return job_ids
+
+def get_upload_stage_counts():
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('SELECT stage, COUNT(*) FROM upload_jobs GROUP BY stage')
+    counts = dict(cur.fetchall())
+    conn.close()
+    return counts
+
+def get_upload_stage_stats():
+    return {
+        stage: {'count': stats['count'], 'avg_ms': stats['total_ms'] / stats['count']}
+        for stage, stats in upload_stage_stats.items()
+    }
+
+def _ensure_upload_workers():
+    global _upload_queue, _upload_worker_tasks
+    if _upload_worker_tasks and not all(task.done() for task in _upload_worker_tasks):
+        return
+    _upload_queue = asyncio.Queue()
+    _upload_worker_tasks = [asyncio.create_task(_upload_worker()) for _ in range(UPLOAD_WORKERS)]
+
+async def enqueue_upload_job(bot, user_id, status_msg, photos, caption):
+    """Сохраняет задание загрузки арта и ставит его в очередь воркеров"""
+    photos_json = json.dumps([photo.to_dict() for photo in photos])
+    job_id = await db_write(create_upload_job, user_id, status_msg.chat_id, status_msg.message_id,
+                            photos_json, caption)
+    _ensure_upload_workers()
+    _upload_queue.put_nowait((job_id, bot))
+    return job_id
+
+async def resume_upload_jobs(bot):
+    """Ставит в очередь задания, не завершённые до перезапуска бота"""
+    job_ids = await db_read(get_unfinished_upload_jobs)
+    if not job_ids:
+        return
+    _ensure_upload_workers()
+    for job_id in job_ids:
+        _upload_queue.put_nowait((job_id, bot))
+    logging.info(f"Возобновлено заданий загрузки: {len(job_ids)}")
+
+async def _upload_worker():
+    while True:
+        job_id, bot = await _upload_queue.get()
+        try:
+            await process_upload_job(bot, job_id)
+        except Exception:
+            logging.exception(f"Ошибка в задании загрузки {job_id}")
+
+async def _edit_upload_status(bot, job, text, reply_markup=None, parse_mode=None):
+    try:
+        await bot.edit_message_text(
+            text, chat_id=job['chat_id'], message_id=job['status_message_id'],
+            reply_markup=reply_markup, parse_mode=parse_mode
+        )
+    except Exception as e:
+        logging.info(f"Не удалось обновить статус задания загрузки {job['job_id']}: {e}")
+
+async def process_upload_job(bot, job_id):
+    job = await db_read(get_upload_job, job_id)
+    if job is None or job['stage'] in UPLOAD_JOB_FINAL_STAGES:
+        return
+    timings = json.loads(job['stage_timings'] or '{}')
+    last_stage_at = time.perf_counter()
+    
+    async def advance(stage, error=None):
+        nonlocal last_stage_at
+        now = time.perf_counter()
+        elapsed_ms = (now - last_stage_at) * 1000
+        last_stage_at = now
+        timings[stage] = elapsed_ms
+        stats = upload_stage_stats.setdefault(stage, {'count': 0, 'total_ms': 0.0})
+        stats['count'] += 1
+        stats['total_ms'] += elapsed_ms
+        await db_write(set_upload_job_stage, job_id, stage, timings, error)
+        if stage in UPLOAD_STAGE_TEXTS:
+            await _edit_upload_status(bot, job, UPLOAD_STAGE_TEXTS[stage])
+    
+    attempts = await db_write(start_upload_job_attempt, job_id)
+    if attempts > UPLOAD_JOB_MAX_ATTEMPTS:
+        await advance('failed', "превышено число попыток")
+        await _edit_upload_status(bot, job, "❌ Ошибка при проверке изображения. Попробуйте еще раз.")
+        return
+    
+    user_id = job['user_id']
+    photos = [telegram.PhotoSize.de_json(photo, bot) for photo in json.loads(job['photos'])]
+    file_id = photos[-1].file_id
+    caption = job['caption']
+    hashtags = extract_hashtags(caption)
+    clean_caption = re.sub(r'#\w+', '', caption).strip()
+    
+    try:
+        basic_safe, is_safe, safety_message = await moderate_photo(photos, on_stage=advance)
+    except Exception as e:
+        logging.error(f"Ошибка при проверке изображения: {e}")
+        await advance('failed', str(e))
+        await _edit_upload_status(bot, job, "❌ Ошибка при проверке изображения. Попробуйте еще раз.")
+        return
+    
+    if basic_safe:
+        await advance('classified')
+    if not basic_safe or not is_safe:
+        pending_id = await db_write(add_pending_art, user_id, file_id, clean_caption, hashtags, upload_job_id=job_id)
+        await advance('pending')
         
-        if art_id:
-            context.user_data['waiting_for_art'] = False
-            
-            art_count = get_user_art_count(user_id)
-            can_upload_more = art_count < MAX_ARTS_PER_USER
-            
-            hashtags_info = ""
-            if hashtags:
-                hashtags_info = f"\n🏷️ **Добавленные хэштеги:** {', '.join(hashtags)}"
-            else:
-                hashtags_info = "\nℹ️ Хэштеги не добавлены. Вы можете добавить их в подпись к фото."
-            
-            keyboard = []
-            if can_upload_more:
-                keyboard.append([InlineKeyboardButton("📤 Загрузить ещё арт", callback_data='upload_art')])
-            keyboard.append([InlineKeyboardButton("🔙 В главное меню", callback_data='back_to_menu')])
-            
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await checking_msg.edit_text(
-                "✅ Твой арт успешно добавлен! "
-                "Теперь другие пользователи смогут его оценить!" +
-                hashtags_info +
-                (f"\n\n🎨 У вас {art_count}/{MAX_ARTS_PER_USER} артов" if can_upload_more else ""),
-                reply_markup=reply_markup,
-                parse_mode='Markdown'
-            )
-        else:
-            await checking_msg.edit_text(
-                f"{message}\n\n"
-                "Перейди в профиль чтобы удалить старые арты.",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("👤 Профиль", callback_data='profile')]])
-            )
+        keyboard = [
+            [InlineKeyboardButton("📞 Отправить в поддержку", callback_data=f'send_to_support_{pending_id}')],
+            [InlineKeyboardButton("🔙 В меню", callback_data='back_to_menu')]
+        ]
+        await _edit_upload_status(bot, job, f"{safety_message}", reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+    
+    await _edit_upload_status(bot, job, "✅ Изображение безопасно! Добавляем в галерею...")
+    art_id, message = await db_write(add_art, user_id, file_id, clean_caption, hashtags, upload_job_id=job_id)
+    
+    if not art_id:
+        await advance('failed', message)
+        await _edit_upload_status(
+            bot, job,
+            f"{message}\n\n"
+            "Перейди в профиль чтобы удалить старые арты.",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("👤 Профиль", callback_data='profile')]])
+        )
+        return
+    
+    await advance('published')
+    art_count = await db_read(get_user_art_count, user_id)
+    can_upload_more = art_count < MAX_ARTS_PER_USER
+    
+    hashtags_info = ""
+    if hashtags:
+        hashtags_info = f"\n🏷️ **Добавленные хэштеги:** {', '.join(hashtags)}"
+    else:
+        hashtags_info = "\nℹ️ Хэштеги не добавлены. Вы можете добавить их в подпись к фото."
+    
+    keyboard = []
+    if can_upload_more:
+        keyboard.append([InlineKeyboardButton("📤 Загрузить ещё арт", callback_data='upload_art')])
+    keyboard.append([InlineKeyboardButton("🔙 В главное меню", callback_data='back_to_menu')])
+    
+    await _edit_upload_status(
+        bot, job,
+        "✅ Твой арт успешно добавлен! "
+        "Теперь другие пользователи смогут его оценить!" +
+        hashtags_info +
+        (f"\n\n🎨 У вас {art_count}/{MAX_ARTS_PER_USER} артов" if can_upload_more else ""),
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode='Markdown'
+    )
 
 # ========== КОМАНДЫ ДЛЯ МОДЕРАТОРОВ ==========
 
@@ -5639,7 +7872,7 @@ async def deleted_arts_command(update: Update, context: ContextTypes.DEFAULT_TYP
     if user_id not in SUPPORT_USER_IDS:
         await update.message.reply_text("❌ У вас нет доступа к этой команде!")
         return
-    deleted_arts = get_deleted_arts(limit=100)
+    deleted_arts = await db_read(get_deleted_arts, limit=100)
     
     if not deleted_arts:
         await update.message.reply_text("📭 Нет удалённых артов за последний день")
@@ -5648,10 +7881,10 @@ async def deleted_arts_command(update: Update, context: ContextTypes.DEFAULT_TYP
     context.user_data['deleted_arts_current_index'] = 0
     index = 0
     deleted_id, art_id, owner_id, file_id, caption, deleted_at, reason = deleted_arts[index]
-    owner_profile = get_user_profile(owner_id)
+    owner_profile = await db_read(get_user_profile, owner_id)
     is_owner_profile_public = owner_profile[5] if owner_profile else False
     
-    owner_name = get_display_name(owner_id, profile_is_public=is_owner_profile_public)
+    owner_name = await db_read(get_display_name, owner_id, profile_is_public=is_owner_profile_public)
     gallery_text = f"🗑️ **Удалённый арт** ({index + 1}/{len(deleted_arts)})\n\n"
     gallery_text += f"🎨 Арт #{art_id}\n"
     gallery_text += f"👤 Автор: {escape_markdown(owner_name)}\n"
@@ -5705,7 +7938,7 @@ async def appeals_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ У вас нет доступа к этой команде!")
         return
     
-    appeals = get_pending_appeals()
+    appeals = await db_read(get_pending_appeals)
     
     if not appeals:
         await update.message.reply_text("📭 Нет ожидающих апеляций")
@@ -5715,7 +7948,7 @@ async def appeals_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = []
     
     for appeal_id, user_id_appeal, reason, submitted_at in appeals:
-        user_name = get_display_name(user_id_appeal, for_moderator=True)
+        user_name = await db_read(get_display_name, user_id_appeal, for_moderator=True)
         reason_preview = (reason[:50] + "...") if len(reason) > 50 else reason
         
         message_text += f"👤 {escape_markdown(user_name)} (ID: {user_id_appeal})\n"
@@ -5734,19 +7967,784 @@ async def appeals_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=reply_markup,
         parse_mode='Markdown'
     )
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /stats - показывает внутренние метрики бота для модераторов"""
+    user_id = update.effective_user.id
+    
+    if user_id not in SUPPORT_USER_IDS:
+        await update.message.reply_text("❌ У вас нет доступа к этой команде!")
+        return
+    
+    lines = ["📈 Метрики бота", ""]
+    lines.append("🗄 Доступ к базе данных:")
+    for kind, title in (('read', 'чтение'), ('write', 'запись')):
+        stats = get_db_executor_stats()[kind]
+        lines.append(
+            f"  {title}: в очереди {stats['queued']}, выполняется {stats['running']}, "
+            f"готово {stats['completed']}, ошибок {stats['failed']}"
+        )
+        lines.append(
+            f"    ожидание ср. {stats['avg_wait_ms']:.1f} мс / макс. {stats['max_wait_ms']:.1f} мс, "
+            f"выполнение ср. {stats['avg_run_ms']:.1f} мс"
+        )
+    
+    stats = get_inference_stats()
+    lines.append("")
+    lines.append("🧠 Проверка изображений:")
+    lines.append(f"  модели: {get_models_status()}")
+    lines.append(
+        f"  в очереди {stats['queued']}, пачек в работе {stats['running']} "
+        f"(процессов {stats['workers'] or 'нет, в потоке бота'})"
+    )
+    lines.append(
+        f"  изображений {stats['images']} в {stats['batches']} пачках, "
+        f"ошибок {stats['failed']}"
+    )
+    lines.append(
+        f"    пачка ср. {stats['avg_batch']:.1f} / макс. {stats['max_batch']}, "
+        f"ожидание ср. {stats['avg_wait_ms']:.1f} мс, пачка ср. {stats['avg_batch_ms']:.1f} мс"
+    )
+    lines.append(
+        f"    classifier ср. {stats['avg_classifier_ms']:.1f} мс, CLIP нужен для {stats['clip_images']} "
+        f"из {stats['images']} изображений, ср. {stats['avg_clip_ms']:.1f} мс"
+    )
+    
+    stats = get_verdict_cache_stats()
+    lines.append(
+        f"  кэш вердиктов: по файлу {stats['exact_hits']}, по похожим {stats['similar_hits']}, "
+        f"промахов {stats['misses']} (попаданий {stats['hit_rate']:.0%})"
+    )
+    
+    counts = await db_read(get_upload_stage_counts)
+    lines.append("")
+    lines.append("📤 Загрузки артов:")
+    lines.append(
+        f"  в очереди {_upload_queue.qsize() if _upload_queue else 0}, "
+        f"по стадиям: {', '.join(f'{stage} {count}' for stage, count in sorted(counts.items())) or 'нет'}"
+    )
+    for stage, stats in get_upload_stage_stats().items():
+        lines.append(f"    {stage}: {stats['count']} раз, ср. {stats['avg_ms']:.0f} мс от предыдущей стадии")
+    
+    progress = await db_read(get_reminder_progress)
+    lines.append("")
+    if progress:
+        owners_done, owners_total, failed, started_at, finished_at = progress
+        state = "завершён" if finished_at else "идёт"
+        lines.append(f"🔔 Напоминания: последний проход {state}, авторов {owners_done}/{owners_total}, ошибок {failed}")
+    else:
+        lines.append("🔔 Напоминания: проходов ещё не было")
+    lines.append(
+        f"  проходов {reminder_stats['runs']} (продолжено после перезапуска {reminder_stats['resumed']}), "
+        f"последний: {reminder_stats['last_owners']} авторов за {reminder_stats['last_duration']:.1f}с"
+    )
+    
+    stats = outbound_rate_limiter.get_stats()
+    lines.append("")
+    lines.append(f"📡 Запросы к Telegram (чатов {stats['chats']}, пауза {stats['paused_for']:.0f}с):")
+    for lane, title in (('interactive', 'ответы'), ('background', 'фоновые')):
+        lane_stats = stats[lane]
+        lines.append(
+            f"  {title}: ждут {lane_stats['waiting']}, отправлено {lane_stats['sent']}, "
+            f"ошибок {lane_stats['failed']}, 429 {lane_stats['retry_after']}"
+        )
+        lines.append(f"    ожидание ср. {lane_stats['avg_wait_ms']:.1f} мс / макс. {lane_stats['max_wait_ms']:.1f} мс")
+    
+    await update.message.reply_text("\n".join(lines))
+
+async def reload_prompts_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /reload_prompts - перечитывает описания NSFW-категорий и пересчитывает их признаки"""
+    user_id = update.effective_user.id
+    
+    if user_id not in SUPPORT_USER_IDS:
+        await update.message.reply_text("❌ У вас нет доступа к этой команде!")
+        return
+    
+    if not moderation_models_ready():
+        await update.message.reply_text(f"❌ CLIP модель не готова: {get_models_status()}")
+        return
+    
+    try:
+        if MODERATION_WORKERS > 0:
+            # Процессы пула читают описания при запуске, поэтому пул перезапускается
+            descriptions, _ = load_nsfw_prompts()
+            reset_moderation_pool()
+            start_loading_moderation_models()
+            count = len(descriptions)
+        else:
+            # В потоке инференса: текущая пачка доработает со старыми признаками
+            count = await asyncio.get_running_loop().run_in_executor(_inference_executor, reload_clip_text_features)
+    except Exception as e:
+        logging.error(f"Ошибка при обновлении описаний NSFW: {e}")
+        await update.message.reply_text(f"❌ Не удалось обновить описания: {e}")
+        return
+    
+    # Сохранённые вердикты получены со старыми описаниями
+    await db_write(clear_verdict_cache)
+    await update.message.reply_text(f"✅ Описания NSFW-категорий обновлены ({count} шт.)")
+
+# ========== БЕНЧМАРКИ ==========
+# Запуск: python artpeakbot.py --bench <имя>. Бенчмарки работают на временной
+# базе с синтетическими данными и не трогают рабочую database.db.
+
+BENCHMARK_HASHTAGS = ['#art', '#anime', '#sketch', '#digital', '#portrait', '#landscape',
+                      '#fanart', '#pixelart', '#oc', '#traditional', '#3d', '#comic']
+
+def use_benchmark_database():
+    """Переключает пул соединений на новую временную базу"""
+    global DB_PATH
+    close_db_pool()
+    reset_feed_cursors()
+    DB_PATH = os.path.join(tempfile.mkdtemp(prefix='artpeakbot-bench-'), 'bench.db')
+    return DB_PATH
+
+def populate_benchmark_data(users=2000, arts=50000, reactions=200000, follows=20000, seed=42):
+    """Заполняет базу синтетическими пользователями, артами, хэштегами и реакциями"""
+    rnd = random.Random(seed)
+    conn = get_db_connection()
+    cur = conn.cursor()
+    base_time = datetime(2024, 1, 1)
+    
+    cur.executemany('INSERT INTO users (user_id, username, nickname) VALUES (?, ?, ?)',
+                    ((user_id, f'user{user_id}', f'Artist {user_id}') for user_id in range(1, users + 1)))
+    cur.executemany(
+        'INSERT INTO arts (art_id, owner_id, file_id, caption, likes, dislikes, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?)',
+        ((art_id, rnd.randint(1, users), f'file{art_id}', f'caption {art_id}',
+          rnd.randint(0, 500), rnd.randint(0, 100),
+          (base_time + timedelta(minutes=art_id)).strftime('%Y-%m-%d %H:%M:%S'))
+         for art_id in range(1, arts + 1))
+    )
+    art_hashtags = ((art_id, hashtag) for art_id in range(1, arts + 1)
+                    for hashtag in rnd.sample(BENCHMARK_HASHTAGS, rnd.randint(1, 3)))
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'art_tags'")
+    if cur.fetchone():
+        cur.executemany('INSERT OR IGNORE INTO all_hashtags (hashtag_text) VALUES (?)',
+                        ((hashtag,) for hashtag in BENCHMARK_HASHTAGS))
+        cur.executemany(
+            'INSERT INTO art_tags (art_id, tag_id) SELECT ?, tag_id FROM all_hashtags WHERE hashtag_text = ?',
+            art_hashtags
+        )
+    else:
+        # Схема до миграции 13: связи в таблице hashtags, счётчики вели вручную
+        cur.executemany('INSERT INTO hashtags (art_id, hashtag) VALUES (?, ?)', art_hashtags)
+        cur.executemany(
+            'INSERT OR IGNORE INTO all_hashtags (hashtag_text, usage_count) VALUES (?, ?)',
+            ((hashtag, arts // 5) for hashtag in BENCHMARK_HASHTAGS)
+        )
+    cur.executemany(
+        'INSERT OR IGNORE INTO reactions (user_id, art_id, type) VALUES (?, ?, ?)',
+        ((rnd.randint(1, users), rnd.randint(1, arts), 'like' if rnd.random() < 0.8 else 'dislike')
+         for _ in range(reactions))
+    )
+    cur.executemany(
+        'INSERT OR IGNORE INTO comments (user_id, art_id, text) VALUES (?, ?, ?)',
+        ((rnd.randint(1, users), rnd.randint(1, arts), 'nice') for _ in range(reactions // 20))
+    )
+    cur.executemany(
+        'INSERT OR IGNORE INTO profile_followers (follower_id, following_id) VALUES (?, ?)',
+        ((rnd.randint(1, users), rnd.randint(1, users)) for _ in range(follows))
+    )
+    cur.executemany(
+        'INSERT OR IGNORE INTO active_messages (message_id, chat_id, art_id, user_id) VALUES (?, ?, ?, ?)',
+        ((message_id, rnd.randint(1, users), rnd.randint(1, arts), rnd.randint(1, users))
+         for message_id in range(1, users * 10))
+    )
+    conn.commit()
+    conn.close()
+
+def profile_db_function(func, *args, repeat=5):
+    """Выполняет функцию доступа к БД и возвращает среднее время и выполненные SELECT-запросы"""
+    close_db_pool()
+    conn = get_db_connection()
+    statements = []
+    conn.set_trace_callback(statements.append)
+    conn.close()
+    
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func(*args)
+    elapsed_ms = (time.perf_counter() - started) * 1000 / repeat
+    
+    conn = get_db_connection()
+    conn.set_trace_callback(None)
+    conn.close()
+    
+    selects = []
+    for statement in statements:
+        if statement.lstrip().upper().startswith('SELECT') and statement not in selects:
+            selects.append(statement)
+    return elapsed_ms, selects
+
+def explain_query_plan(statement):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('EXPLAIN QUERY PLAN ' + statement)
+    plan = [row[3] for row in cur.fetchall()]
+    conn.close()
+    return plan
+
+def print_profiled_calls(title, calls, repeat=5):
+    print(f"\n===== {title} =====")
+    for name, func, args in calls:
+        elapsed_ms, selects = profile_db_function(func, *args, repeat=repeat)
+        print(f"\n--- {name}: {elapsed_ms:.2f} мс")
+        for statement in selects:
+            for line in explain_query_plan(statement):
+                print(f"    {line}")
+
+def benchmark_indexes():
+    """Планы и время горячих запросов до и после миграции с индексами"""
+    use_benchmark_database()
+    init_db(schema_version=2)
+    populate_benchmark_data()
+    
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('SELECT owner_id FROM arts GROUP BY owner_id ORDER BY COUNT(*) DESC LIMIT 1')
+    owner_id = cur.fetchone()[0]
+    cur.execute('SELECT user_id FROM reactions GROUP BY user_id ORDER BY COUNT(*) DESC LIMIT 1')
+    viewer_id = cur.fetchone()[0]
+    cur.execute('SELECT art_id FROM active_messages GROUP BY art_id ORDER BY COUNT(*) DESC LIMIT 1')
+    art_id = cur.fetchone()[0]
+    conn.close()
+    
+    # Текущие функции читают таблицы более поздних миграций (feed_scores, reaction_inbox,
+    # hashtag_top), поэтому до миграции выполняются запросы в том виде, какими они были
+    legacy_queries = [
+        ("get_unseen_art", '''
+            SELECT art_id, file_id, caption, likes, dislikes
+            FROM arts
+            WHERE art_id NOT IN (SELECT art_id FROM reactions WHERE user_id = ?)
+            AND owner_id != ?
+            ORDER BY timestamp DESC
+            LIMIT 1
+        ''', (viewer_id, viewer_id)),
+        ("get_unseen_art с хэштегом", '''
+            SELECT a.art_id, a.file_id, a.caption, a.likes, a.dislikes
+            FROM arts a
+            JOIN hashtags h ON a.art_id = h.art_id
+            WHERE a.art_id NOT IN (SELECT art_id FROM reactions WHERE user_id = ?)
+            AND a.owner_id != ?
+            AND LOWER(h.hashtag) = LOWER(?)
+            ORDER BY a.timestamp DESC
+            LIMIT 1
+        ''', (viewer_id, viewer_id, '#anime')),
+        ("get_unviewed_reactions_count", '''
+            SELECT COUNT(*) FROM reactions r
+            JOIN arts a ON r.art_id = a.art_id
+            WHERE a.owner_id = ? AND r.type = 'like'
+            AND NOT EXISTS (
+                SELECT 1 FROM viewed_reactions vr
+                WHERE vr.user_id = ? AND vr.reaction_type = 'like' AND vr.reaction_id = r.reaction_id
+            )
+        ''', (owner_id, owner_id)),
+        ("get_top_arts", '''
+            SELECT art_id, file_id, caption, likes, dislikes, owner_id
+            FROM arts
+            ORDER BY likes DESC, timestamp DESC
+            LIMIT ?
+        ''', (5,)),
+        ("get_top_arts с хэштегом", '''
+            SELECT a.art_id, a.file_id, a.caption, a.likes, a.dislikes, a.owner_id
+            FROM arts a
+            JOIN hashtags h ON a.art_id = h.art_id
+            WHERE LOWER(h.hashtag) = LOWER(?)
+            ORDER BY a.likes DESC, a.timestamp DESC
+            LIMIT ?
+        ''', ('#anime', 5)),
+        ("get_user_arts", '''
+            SELECT art_id, file_id, caption, likes, dislikes, timestamp
+            FROM arts
+            WHERE owner_id = ?
+            ORDER BY timestamp DESC
+        ''', (owner_id,)),
+        ("get_followers (show_followers)", '''
+            SELECT u.user_id, u.username, u.nickname
+            FROM profile_followers pf
+            JOIN users u ON pf.follower_id = u.user_id
+            WHERE pf.following_id = ?
+            ORDER BY pf.timestamp DESC
+        ''', (owner_id,)),
+        ("get_active_messages_for_art",
+         'SELECT message_id, chat_id, user_id FROM active_messages WHERE art_id = ?', (art_id,)),
+    ]
+    
+    def run_query(statement, params):
+        conn = get_db_connection()
+        result = conn.execute(statement, params).fetchall()
+        conn.close()
+        return result
+    
+    print_profiled_calls("До миграции индексов", [
+        (name, run_query, (statement, params)) for name, statement, params in legacy_queries
+    ])
+    init_db()
+    print_profiled_calls("После миграции индексов", [
+        ("get_unseen_art", get_unseen_art, (viewer_id,)),
+        ("get_unseen_art с хэштегом", get_unseen_art, (viewer_id, '#anime')),
+        ("get_unviewed_reactions_count", get_unviewed_reactions_count, (owner_id,)),
+        ("get_top_arts", get_top_arts, (5,)),
+        ("get_top_arts с хэштегом", get_top_arts, (5, '#anime')),
+        ("get_user_arts", get_user_arts, (owner_id,)),
+        ("get_followers (show_followers)", get_followers, (owner_id,)),
+        ("get_active_messages_for_art", get_active_messages_for_art, (art_id,)),
+    ])
+    close_db_pool()
+
+def benchmark_feed(sizes=(10_000, 100_000, 1_000_000), steps=200):
+    """Задержка выдачи следующего арта при росте таблиц arts и reactions"""
+    legacy_query = '''
+        SELECT art_id, file_id, caption, likes, dislikes
+        FROM arts
+        WHERE art_id NOT IN (SELECT art_id FROM reactions WHERE user_id = ?)
+        AND owner_id != ?
+        ORDER BY timestamp DESC
+        LIMIT 1
+    '''
+    for size in sizes:
+        use_benchmark_database()
+        init_db()
+        populate_benchmark_data(users=1000, arts=size, reactions=size, follows=1000)
+        viewer_id = 1001
+        
+        conn = get_db_connection()
+        cur = conn.cursor()
+        cur.execute('INSERT INTO users (user_id, username) VALUES (?, ?)', (viewer_id, 'viewer'))
+        # Зритель уже оценил половину ленты - самый тяжёлый случай для старого запроса
+        cur.execute('''
+            INSERT INTO reactions (user_id, art_id, type)
+            SELECT ?, art_id, 'like' FROM arts ORDER BY timestamp DESC LIMIT ?
+        ''', (viewer_id, size // 2))
+        conn.commit()
+        
+        started = time.perf_counter()
+        cur.execute(legacy_query, (viewer_id, viewer_id))
+        cur.fetchone()
+        legacy_ms = (time.perf_counter() - started) * 1000
+        conn.close()
+        
+        timings = []
+        for _ in range(steps):
+            started = time.perf_counter()
+            art = get_unseen_art(viewer_id)
+            timings.append((time.perf_counter() - started) * 1000)
+            add_reaction(viewer_id, art[0], 'like')
+        
+        # Первый вызов проходит уже оценённую часть ленты один раз, дальше работает сохранённая позиция
+        steady = timings[1:]
+        print(f"arts={size}: NOT IN + сортировка {legacy_ms:.2f} мс, "
+              f"get_unseen_art первый вызов {timings[0]:.2f} мс, "
+              f"далее ср. {sum(steady) / len(steady):.3f} мс / макс. {max(steady):.3f} мс")
+    close_db_pool()
+
+def _legacy_get_user_rank(user_id, hashtag_filter=None):
+    """Прежний get_user_rank: все арты по убыванию лайков и проход по ним в Python"""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    if hashtag_filter:
+        cur.execute('''
+            SELECT a.owner_id, a.likes
+            FROM arts a
+            JOIN hashtags h ON a.art_id = h.art_id
+            WHERE LOWER(h.hashtag) = LOWER(?)
+            ORDER BY a.likes DESC, a.timestamp DESC
+        ''', (hashtag_filter,))
+    else:
+        cur.execute('SELECT owner_id, likes FROM arts ORDER BY likes DESC, timestamp DESC')
+    all_arts = cur.fetchall()
+    conn.close()
+    
+    user_max_likes = max((likes for owner_id, likes in all_arts if owner_id == user_id), default=0)
+    if user_max_likes == 0:
+        return None
+    rank_counter, last_likes = 0, -1
+    for owner_id, likes in all_arts:
+        if likes != last_likes:
+            rank_counter += 1
+            last_likes = likes
+        if owner_id == user_id and likes == user_max_likes:
+            return rank_counter
+    return None
+
+def benchmark_rank(sizes=(100_000, 1_000_000), users=50):
+    """Время get_user_rank против прежнего прохода по всем артам, с проверкой совпадения мест"""
+    for size in sizes:
+        use_benchmark_database()
+        init_db()
+        populate_benchmark_data(users=10_000, arts=size, reactions=size // 10, follows=1000)
+        owners = random.Random(7).sample(range(1, 10_001), users)
+        
+        for hashtag_filter in (None, '#anime'):
+            legacy_ms, ranks = [], []
+            for owner_id in owners[:3]:
+                started = time.perf_counter()
+                ranks.append(_legacy_get_user_rank(owner_id, hashtag_filter))
+                legacy_ms.append((time.perf_counter() - started) * 1000)
+            
+            timings = []
+            for owner_id in owners:
+                started = time.perf_counter()
+                rank = get_user_rank(owner_id, hashtag_filter)
+                timings.append((time.perf_counter() - started) * 1000)
+                if owner_id in owners[:3]:
+                    assert rank == ranks[owners.index(owner_id)], (owner_id, rank)
+            
+            title = f"хэштег {hashtag_filter}" if hashtag_filter else "все арты"
+            print(f"arts={size}, {title}: проход в Python ср. {sum(legacy_ms) / len(legacy_ms):.1f} мс, "
+                  f"get_user_rank ср. {sum(timings) / len(timings):.3f} мс / макс. {max(timings):.3f} мс")
+    close_db_pool()
+
+def _legacy_block_user(user_id, reason, moderator_id):
+    """Прежний block_user: каждый арт копируется отдельно, хэштеги читаются через другое соединение"""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('INSERT OR REPLACE INTO user_blocks (user_id, reason, moderator_id) VALUES (?, ?, ?)',
+                (user_id, reason, moderator_id))
+    cur.execute('SELECT art_id FROM arts WHERE owner_id = ?', (user_id,))
+    for (art_id,) in cur.fetchall():
+        cur.execute('SELECT file_id, caption, likes, dislikes FROM arts WHERE art_id = ?', (art_id,))
+        file_id, caption, likes, dislikes = cur.fetchone()
+        hashtags_text = ",".join(get_art_hashtags(art_id))
+        cur.execute('''
+            INSERT OR IGNORE INTO deleted_arts (art_id, owner_id, file_id, caption, likes, dislikes, hashtags, reason)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (art_id, user_id, file_id, caption, likes, dislikes, hashtags_text, "User blocked"))
+    for table in ART_DEPENDENT_TABLES:
+        cur.execute(f'DELETE FROM {table} WHERE art_id IN (SELECT art_id FROM arts WHERE owner_id = ?)', (user_id,))
+    cur.execute('DELETE FROM arts WHERE owner_id = ?', (user_id,))
+    conn.commit()
+    conn.close()
+    return True, "Пользователь заблокирован!"
+
+def benchmark_bulk_block(art_counts=(MAX_ARTS_PER_USER, 100, 500), reactions_per_art=300):
+    """Блокировка и разблокировка автора с множеством артов и реакций: построчно против set-based"""
+    artist_id = 1
+    for art_count in art_counts:
+        timings = {}
+        # Прежний вариант - на схеме без индексов по art_id в complaints и viewed_reactions
+        for title, block, schema_version in (('построчно', _legacy_block_user, 13), ('set-based', block_user, None)):
+            use_benchmark_database()
+            init_db(schema_version=schema_version)
+            populate_benchmark_data(users=2000, arts=20_000, reactions=50_000, follows=2000)
+            rnd = random.Random(art_count)
+            conn = get_db_connection()
+            cur = conn.cursor()
+            first_art_id = cur.execute('SELECT MAX(art_id) FROM arts').fetchone()[0] + 1
+            art_ids = range(first_art_id, first_art_id + art_count)
+            cur.executemany('INSERT INTO arts (art_id, owner_id, file_id, likes) VALUES (?, ?, ?, ?)',
+                            ((art_id, artist_id, f'file{art_id}', reactions_per_art) for art_id in art_ids))
+            cur.executemany(
+                'INSERT INTO art_tags (art_id, tag_id) SELECT ?, tag_id FROM all_hashtags WHERE hashtag_text = ?',
+                ((art_id, hashtag) for art_id in art_ids for hashtag in rnd.sample(BENCHMARK_HASHTAGS, 2))
+            )
+            cur.executemany(
+                'INSERT INTO reactions (user_id, art_id, type) VALUES (?, ?, ?)',
+                ((user_id, art_id, 'like') for art_id in art_ids
+                 for user_id in rnd.sample(range(2, 2001), reactions_per_art))
+            )
+            cur.executemany('INSERT INTO comments (art_id, user_id, text) VALUES (?, ?, ?)',
+                            ((art_id, rnd.randint(2, 2000), 'benchmark') for art_id in art_ids))
+            # Авторы успели просмотреть примерно половину реакций
+            cur.execute('''
+                INSERT INTO viewed_reactions (user_id, reaction_type, reaction_id, art_id)
+                SELECT a.owner_id, 'like', r.reaction_id, r.art_id
+                FROM reactions r
+                JOIN arts a ON a.art_id = r.art_id
+                WHERE r.reaction_id % 2 = 0
+            ''')
+            conn.commit()
+            # Иначе в замер попадёт автоматический checkpoint данных подготовки
+            cur.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+            conn.close()
+            
+            started = time.perf_counter()
+            ok, message = block(artist_id, 'benchmark', 0)
+            timings[title] = (time.perf_counter() - started) * 1000
+            assert ok, message
+        
+        started = time.perf_counter()
+        ok, message = unblock_user(artist_id)
+        unblock_ms = (time.perf_counter() - started) * 1000
+        assert ok, message
+        assert get_user_art_count(artist_id) >= art_count
+        print(f"arts={art_count}, реакций={art_count * reactions_per_art}: "
+              f"блокировка построчно {timings['построчно']:.1f} мс, set-based {timings['set-based']:.1f} мс, "
+              f"разблокировка {unblock_ms:.1f} мс")
+    close_db_pool()
+
+def benchmark_tag_migration(arts=200_000, seed=3):
+    """Миграция 13 на базе со старой таблицей hashtags: прерванный шаг откатывается, повторный даёт те же счётчики"""
+    use_benchmark_database()
+    init_db(schema_version=12)
+    rnd = random.Random(seed)
+    hashtags = BENCHMARK_HASHTAGS + [hashtag.upper() for hashtag in BENCHMARK_HASHTAGS] + ['#Небо', '#небо']
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.executemany('INSERT INTO arts (art_id, owner_id, file_id, likes) VALUES (?, ?, ?, ?)',
+                    ((art_id, art_id % 1000 + 1, f'file{art_id}', rnd.randint(0, 500)) for art_id in range(1, arts + 1)))
+    links = {(art_id, hashtag) for art_id in range(1, arts + 1) for hashtag in rnd.sample(hashtags, rnd.randint(0, 3))}
+    cur.executemany('INSERT INTO hashtags (art_id, hashtag) VALUES (?, ?)', sorted(links))
+    # Счётчики, которые вели вручную, расходятся с фактическими связями
+    cur.executemany('INSERT OR IGNORE INTO all_hashtags (hashtag_text, usage_count) VALUES (?, ?)',
+                    ((hashtag.lower(), rnd.randint(1, arts)) for hashtag in hashtags))
+    conn.commit()
+    conn.close()
+    expected = {}
+    for art_id, hashtag in {(art_id, hashtag.lower()) for art_id, hashtag in links}:
+        expected[hashtag] = expected.get(hashtag, 0) + 1
+    
+    def read_counts():
+        conn = get_db_connection()
+        counts = dict(conn.execute('SELECT hashtag_text, usage_count FROM all_hashtags').fetchall())
+        version = get_schema_version(conn.cursor())
+        conn.close()
+        return version, counts
+    
+    step = next(index for index, (version, _, _) in enumerate(SCHEMA_MIGRATIONS) if version == 13)
+    version, description, migrate = SCHEMA_MIGRATIONS[step]
+    
+    def interrupted(cur):
+        migrate(cur)
+        raise sqlite3.OperationalError("миграция прервана")
+    
+    SCHEMA_MIGRATIONS[step] = (version, description, interrupted)
+    try:
+        init_db(schema_version=13)
+        raise AssertionError("прерванная миграция не выбросила ошибку")
+    except sqlite3.OperationalError:
+        pass
+    finally:
+        SCHEMA_MIGRATIONS[step] = (version, description, migrate)
+    conn = get_db_connection()
+    leftovers = conn.execute("SELECT name FROM sqlite_master WHERE name = 'all_hashtags_new'").fetchall()
+    conn.close()
+    assert read_counts()[0] == 12 and not leftovers, leftovers
+    
+    started = time.perf_counter()
+    init_db()
+    migrate_ms = (time.perf_counter() - started) * 1000
+    version, counts = read_counts()
+    assert version == SCHEMA_MIGRATIONS[-1][0], version
+    assert counts == expected, (counts, expected)
+    print(f"arts={arts}, связей={len(links)}: прерванная миграция 13 откатилась, "
+          f"повторный запуск {migrate_ms:.0f} мс, счётчики {len(counts)} тегов совпали")
+    close_db_pool()
+
+def benchmark_search(sizes=(10_000, 100_000, 1_000_000), queries=10):
+    """Поиск профилей и хэштегов: LIKE '%q%' против индексов FTS5 при росте числа пользователей"""
+    for size in sizes:
+        use_benchmark_database()
+        # Пользователи добавляются до миграции 12: она строит users_fts одним rebuild,
+        # а построчные вставки через триггер на миллионе строк идут десятки минут
+        init_db(schema_version=11)
+        rnd = random.Random(size)
+        
+        def word():
+            return ''.join(rnd.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rnd.randint(5, 9)))
+        
+        nicknames = [word().capitalize() for _ in range(size)]
+        conn = get_db_connection()
+        cur = conn.cursor()
+        cur.executemany(
+            'INSERT INTO users (user_id, username, nickname) VALUES (?, ?, ?)',
+            ((user_id, f'{word()}{user_id}', nicknames[user_id - 1]) for user_id in range(1, size + 1))
+        )
+        conn.commit()
+        conn.close()
+        init_db()
+        
+        conn = get_db_connection()
+        cur = conn.cursor()
+        cur.executemany(
+            'INSERT OR IGNORE INTO all_hashtags (hashtag_text, usage_count) VALUES (?, ?)',
+            ((f'#{word()}', rnd.randint(1, 1000)) for _ in range(size // 10))
+        )
+        conn.commit()
+        
+        # Половина запросов - начало существующего ника, половина - то же с переставленными буквами
+        samples = [nickname[:5].lower() for nickname in rnd.sample(nicknames, queries // 2)]
+        samples += [sample[:2] + sample[3] + sample[2] + sample[4:] for sample in samples]
+        
+        legacy_ms = []
+        for query in samples:
+            started = time.perf_counter()
+            cur.execute('''
+                SELECT user_id FROM users
+                WHERE (nickname LIKE ? OR username LIKE ?) AND is_profile_public = 1
+                LIMIT 10
+            ''', (f'%{query}%', f'%{query}%'))
+            cur.fetchall()
+            cur.execute(
+                'SELECT hashtag_text FROM all_hashtags WHERE hashtag_text LIKE ? ORDER BY usage_count DESC LIMIT 10',
+                (f'%{query}%',)
+            )
+            cur.fetchall()
+            legacy_ms.append((time.perf_counter() - started) * 1000)
+        conn.close()
+        
+        timings, found_typos = [], 0
+        for index, query in enumerate(samples):
+            started = time.perf_counter()
+            users = search_users_by_nickname(query)
+            search_hashtags(query)
+            timings.append((time.perf_counter() - started) * 1000)
+            if index >= len(samples) // 2:
+                found_typos += any((nickname or '').lower().startswith(samples[index - len(samples) // 2])
+                                   for _, nickname, _, _ in users)
+        
+        print(f"users={size}: LIKE ср. {sum(legacy_ms) / len(legacy_ms):.2f} мс, "
+              f"FTS5 ср. {sum(timings) / len(timings):.2f} мс / макс. {max(timings):.2f} мс, "
+              f"запросов с опечаткой нашли нужный ник: {found_typos}/{len(samples) // 2}")
+    close_db_pool()
+
+MODERATION_SAMPLES_DIR = 'moderation_samples'  # подкаталоги safe/ и unsafe/ с изображениями
+
+def _load_moderation_samples():
+    samples = []
+    for label in ('safe', 'unsafe'):
+        folder = os.path.join(MODERATION_SAMPLES_DIR, label)
+        if os.path.isdir(folder):
+            for name in sorted(os.listdir(folder)):
+                samples.append((os.path.join(folder, name), label == 'safe'))
+    return samples
+
+def _measure_inference_backend(backend, paths):
+    """Выполняется в отдельном процессе, чтобы бэкенды не делили память и потоки"""
+    global INFERENCE_BACKEND
+    INFERENCE_BACKEND = backend
+    logging.getLogger().setLevel(logging.WARNING)
+    started = time.perf_counter()
+    if not load_moderation_models():
+        return None
+    load_seconds = time.perf_counter() - started
+    
+    images = []
+    for path in paths:
+        image = Image.open(path)
+        image.load()
+        images.append(image)
+    run_nsfw_models(images[:1])  # прогрев
+    latencies, scores = [], []
+    for image in images:
+        started = time.perf_counter()
+        scores.append(run_nsfw_models([image])[0])
+        latencies.append((time.perf_counter() - started) * 1000)
+    return {'backend': active_inference_backend, 'load_seconds': load_seconds,
+            'latencies': latencies, 'scores': scores}
+
+def benchmark_moderation(backends=("torch", "torch-int8", "onnx")):
+    """Задержка и решения бэкендов инференса на размеченных образцах MODERATION_SAMPLES_DIR"""
+    samples = _load_moderation_samples()
+    if not samples:
+        print(f"Нет образцов: положите изображения в {MODERATION_SAMPLES_DIR}/safe и {MODERATION_SAMPLES_DIR}/unsafe")
+        return
+    paths = [path for path, _ in samples]
+    logging.getLogger().setLevel(logging.WARNING)
+    
+    reference_backend, reference = None, None
+    for backend in backends:
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            result = pool.submit(_measure_inference_backend, backend, paths).result()
+        if result is None:
+            print(f"{backend}: модели не загрузились")
+            continue
+        
+        decisions = [decide_image_safety(scores)[0] for scores in result['scores']]
+        if reference is None:
+            reference_backend, reference = backend, decisions
+        accuracy = sum(decision == is_safe for decision, (_, is_safe) in zip(decisions, samples)) / len(samples)
+        agreement = sum(a == b for a, b in zip(decisions, reference)) / len(samples)
+        latencies = sorted(result['latencies'])
+        print(f"{backend} (фактически {result['backend']}): загрузка {result['load_seconds']:.1f} с, "
+              f"задержка ср. {sum(latencies) / len(latencies):.0f} мс / p95 {latencies[int(len(latencies) * 0.95)]:.0f} мс, "
+              f"точность по разметке {accuracy:.1%}, совпадение решений с {reference_backend} {agreement:.1%}")
+        for path, decision, expected in zip(paths, decisions, reference):
+            if decision != expected:
+                print(f"    решение расходится: {path}")
+
+def benchmark_leaderboards():
+    """Топ художников и топ хэштега: запросы по arts и подпискам против таблиц лидеров"""
+    legacy_queries = {
+        'get_top_artists_by_followers': '''
+            SELECT u.user_id, u.username, u.nickname, COUNT(pf.follower_id) as followers_count,
+                   (SELECT COUNT(*) FROM arts WHERE owner_id = u.user_id) as art_count,
+                   (SELECT SUM(likes) FROM arts WHERE owner_id = u.user_id) as total_likes,
+                   u.bio, u.profile_avatar_file_id
+            FROM users u
+            LEFT JOIN profile_followers pf ON u.user_id = pf.following_id
+            WHERE u.user_id IN (SELECT owner_id FROM arts)
+            GROUP BY u.user_id
+            ORDER BY followers_count DESC, total_likes DESC
+            LIMIT 5
+        ''',
+        'get_top_arts с хэштегом': '''
+            SELECT a.art_id, a.file_id, a.caption, a.likes, a.dislikes, a.owner_id
+            FROM arts a
+            JOIN hashtags h ON a.art_id = h.art_id
+            WHERE LOWER(h.hashtag) = LOWER('#anime')
+            ORDER BY a.likes DESC, a.timestamp DESC
+            LIMIT 5
+        ''',
+    }
+    
+    def run_query(statement):
+        conn = get_db_connection()
+        result = conn.execute(statement).fetchall()
+        conn.close()
+        return result
+    
+    use_benchmark_database()
+    init_db(schema_version=9)
+    populate_benchmark_data()
+    print_profiled_calls("Запросы по arts и profile_followers", [
+        (name, run_query, (statement,)) for name, statement in legacy_queries.items()
+    ])
+    init_db()
+    print_profiled_calls("Таблицы лидеров", [
+        ("get_top_artists_by_followers", get_top_artists_by_followers, (5,)),
+        ("get_top_arts с хэштегом", get_top_arts, (5, '#anime')),
+    ])
+    close_db_pool()
+
+BENCHMARKS = {
+    'indexes': benchmark_indexes,
+    'feed': benchmark_feed,
+    'moderation': benchmark_moderation,
+    'leaderboards': benchmark_leaderboards,
+    'rank': benchmark_rank,
+    'search': benchmark_search,
+    'bulk_block': benchmark_bulk_block,
+    'tag_migration': benchmark_tag_migration,
+}
+
+def run_benchmark(name):
+    benchmark = BENCHMARKS.get(name)
+    if benchmark is None:
+        print(f"Неизвестный бенчмарк '{name}'. Доступные: {', '.join(sorted(BENCHMARKS))}")
+        return
+    benchmark()
+
 # ========== ЗАПУСК БОТА ==========
 
+async def post_init(application: Application):
+    # Бот начинает отвечать сразу, модели догружаются в фоне
+    start_loading_moderation_models()
+    await resume_upload_jobs(application.bot)
+
 def main():
     # Инициализация базы данных
     init_db()
+    load_hashtag_index()
     
     # Создание приложения
-    application = Application.builder().token(BOT_TOKEN).build()
+    application = Application.builder().token(BOT_TOKEN).rate_limiter(outbound_rate_limiter).post_init(post_init).build()
     
     # Добавление обработчиков команд
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("deleted_arts", deleted_arts_command))
     application.add_handler(CommandHandler("appeals", appeals_command))
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("reload_prompts", reload_prompts_command))
     
     # Добавление обработчиков кнопок
     application.add_handler(CallbackQueryHandler(button_handler))
@@ -5776,6 +8774,12 @@ def main():
     # Запуск бота
     logging.info("Бот запускается...")
     application.run_polling(allowed_updates=Update.ALL_TYPES)
+    reset_moderation_pool()
+    shutdown_db_executors()
+    close_db_pool()
 
 if __name__ == '__main__':
-    main()
+    if len(sys.argv) > 2 and sys.argv[1] == '--bench':
+        run_benchmark(sys.argv[2])
+    else:
+        main()